@@ -0,0 +1,167 @@
+'''
+asyncio mirror of database.py's read API, for the async serving mode (see asgi.py).
+
+Every function here awaits the same statement database.py builds for it (feed_query, wall_query,
+viewer_context_queries, ...) and returns the same views, through SQLAlchemy's asyncio extension over aiosqlite.
+The engine uses the same URL and profile as database.engine, with the same pragmas and BEGIN handling, so both
+modes read the same data the same way. A query waiting on SQLite only parks a coroutine rather than a thread.
+
+Writes aren't mirrored: asgi.py hands every route that writes to the Flask app, which uses database.py
+'''
+from sqlalchemy import select, func
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from typing import List, Tuple, Dict, Iterable
+
+import os
+from contextlib import asynccontextmanager
+from contextvars import ContextVar, Token
+
+import database
+import metrics
+from database import (Page, WallView, PostView, ViewerContext, UserSidebarInfo, GroupSidebarInfo,
+    User, Wall, Group, NameChange, FEED_PAGE_SIZE, COMMENT_PAGE_SIZE)
+
+import logging
+log = logging.getLogger("aiodatabase")
+
+def make_engine(url: str | None = None, profile: str | None = None) -> AsyncEngine:
+    '''
+    Creates the async engine. url and profile default to database.engine's URL and the SOCIALITE_DB_PROFILE
+    environment variable, with the sqlite driver swapped for aiosqlite
+    '''
+    url = make_url(url or database.engine.url).set(drivername = "sqlite+aiosqlite")
+    profile = profile or os.environ.get("SOCIALITE_DB_PROFILE", "development")
+    settings = database.profile_settings(profile)
+    pool = dict(settings["pool"])
+    if pool.get("poolclass") is QueuePool:
+        pool["poolclass"] = AsyncAdaptedQueuePool
+
+    new_engine = create_async_engine(url, **pool)
+    database.configure_connections(new_engine.sync_engine, settings)
+
+    log.info(f"Using database {url} with the {profile} profile")
+    return new_engine
+
+def use_engine(url: str | None = None, profile: str | None = None) -> AsyncEngine:
+    '''Points every function in this module at a different database. Call before serving anything'''
+    global engine
+    engine = make_engine(url, profile)
+    return engine
+
+engine = make_engine()
+
+# The session shared by every function in this module for the rest of the current request, if there is one
+unit_of_work: ContextVar[AsyncSession | None] = ContextVar("async_unit_of_work", default = None)
+
+def begin_unit_of_work() -> Token:
+    '''Starts a read only unit of work: until end_unit_of_work, every function here reads from one snapshot'''
+    return unit_of_work.set(AsyncSession(engine))
+
+async def end_unit_of_work(token: Token):
+    '''Ends the current unit of work, releasing its connection'''
+    session = unit_of_work.get()
+    try:
+        if session is not None:
+            await session.close()
+    finally:
+        unit_of_work.reset(token)
+
+@asynccontextmanager
+async def session_scope():
+    '''The current unit of work's session, or a session of its own when called outside of one'''
+    shared = unit_of_work.get()
+    if shared is not None:
+        yield shared
+        return
+
+    async with AsyncSession(engine) as session:
+        yield session
+
+async def grab_info_for(id: int) -> Tuple[str, bool] | None:
+    '''See database.grab_info_for'''
+    async with session_scope() as session:
+        result = (await session.execute(select(User.name, User.is_teacher).where(User.id == id))).one_or_none()
+        return None if result is None else (result.name, result.is_teacher)
+
+async def generate_feed(user_id: int, cursor: str | None = None, limit: int = FEED_PAGE_SIZE) -> Page:
+    '''See database.generate_feed'''
+    async with session_scope() as session:
+        rows = (await session.execute(database.feed_query(user_id, database.decode_cursor(cursor), limit))).all()
+        return database.post_page(rows, limit)
+
+async def posts_to_wall(wall_id: int, cursor: str | None = None, limit: int = FEED_PAGE_SIZE) -> Page:
+    '''See database.posts_to_wall'''
+    async with session_scope() as session:
+        rows = (await session.execute(database.wall_query(wall_id, database.decode_cursor(cursor), limit))).all()
+        return database.post_page(rows, limit)
+
+async def visible_wall_ids(user_id: int) -> List[int]:
+    '''See database.visible_wall_ids'''
+    async with session_scope() as session:
+        return list(await session.scalars(database.visible_walls(user_id)))
+
+async def find_wall(condition) -> WallView | None:
+    '''See database.find_wall'''
+    async with session_scope() as session:
+        row = (await session.execute(select(*database.wall_columns()).where(condition))).one_or_none()
+        return database.one_view(row, WallView)
+
+async def get_wall(wall_id: int) -> WallView | None:
+    return await find_wall(Wall.id == wall_id)
+
+async def get_post(id: int) -> PostView | None:
+    '''See database.get_post'''
+    async with session_scope() as session:
+        return database.one_view((await session.execute(database.post_query(id))).one_or_none(), PostView)
+
+async def get_post_comments(post_id: int, cursor: str | None = None, limit: int = COMMENT_PAGE_SIZE) -> Page:
+    '''See database.get_post_comments'''
+    async with session_scope() as session:
+        rows = (await session.execute(database.comments_query(post_id, database.decode_cursor(cursor), limit))).all()
+        return database.comment_page(rows, limit)
+
+async def load_viewer_context(user_id: int) -> ViewerContext | None:
+    '''See database.load_viewer_context'''
+    membership_stmt, friendship_stmt = database.viewer_context_queries(user_id)
+    async with session_scope() as session:
+        memberships = (await session.execute(membership_stmt)).all()
+        if not memberships:
+            return None
+
+        return database.build_viewer_context(user_id, memberships, (await session.execute(friendship_stmt)).all())
+
+async def get_sidebar_user_infos(users: Iterable[int]) -> Dict[int, UserSidebarInfo]:
+    '''See database.get_sidebar_user_infos'''
+    users = set(users)
+    if not users:
+        return {}
+
+    async with session_scope() as session:
+        rows = await session.execute(select(User.id, User.name).where(User.id.in_(users)))
+        return {row.id: UserSidebarInfo(name = row.name) for row in rows}
+
+async def get_sidebar_group_infos(groups: Iterable[int]) -> Dict[int, GroupSidebarInfo]:
+    '''See database.get_sidebar_group_infos'''
+    groups = set(groups)
+    if not groups:
+        return {}
+
+    async with session_scope() as session:
+        rows = await session.execute(select(Group.id, Group.name).where(Group.id.in_(groups)))
+        return {row.id: GroupSidebarInfo(group_id = row.id, name = row.name) for row in rows}
+
+async def latest_name_change() -> int:
+    '''See database.latest_name_change'''
+    async with session_scope() as session:
+        return await session.scalar(select(func.coalesce(func.max(NameChange.seq), 0)))
+
+async def name_changes_since(seq: int) -> list:
+    '''See database.name_changes_since'''
+    stmt = select(NameChange.seq, NameChange.kind, NameChange.entity_id).where(NameChange.seq > seq).order_by(NameChange.seq)
+    async with session_scope() as session:
+        return (await session.execute(stmt)).all()
+
+# Time every function here that talks to the database, per request (see metrics.py)
+metrics.instrument(globals(), __name__)
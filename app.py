@@ -1,17 +1,35 @@
-from flask import Flask, render_template, redirect, make_response, request
+from flask import Flask, Response, render_template, redirect, make_response, request, g, stream_with_context
+from flask import before_render_template, template_rendered, got_request_exception
+from markupsafe import Markup, escape
 from flask_login import current_user
 
-from functools import lru_cache
-
 import forms
 
 import flask_login
 
 import database
-
-from typing import Self
+import events
+import fragments
+import metrics
+import migrations
+import namecache
+import passwords
+import provisioning
+import sqldebug
+
+import click
+
+from typing import Self, Set, Tuple
+import hmac
+import io
+import json
+import os
+import re
+import sys
+import time
 
 from time import strftime, localtime
+from urllib.parse import urlencode
 
 app = Flask(__name__)
 
@@ -22,34 +40,94 @@ login_manager = flask_login.LoginManager()
 login_manager.init_app(app)
 
 @app.template_filter('get_sidebar_user_info')
-@lru_cache(maxsize = 1024)
-def get_sidebar_user_info(user: int):
-    return database.get_sidebar_user_info(user)
+def sidebar_user_info_filter(user: int):
+    '''Reads from the names prefetched for this request, only going to the database for ids that were missed'''
+    prefetched = g.get("user_info", {})
+    if user in prefetched:
+        metrics.name_lookups.inc("user", "prefetched")
+        return prefetched[user]
+    metrics.name_lookups.inc("user", "cache")
+    return namecache.users.get(user)
 
 @app.template_filter('get_sidebar_group_info')
-@lru_cache(maxsize = 1024)
-def get_sidebar_group_info(group: int):
-    return database.get_sidebar_group_info(group)
+def sidebar_group_info_filter(group: int):
+    '''Reads from the names prefetched for this request, only going to the database for ids that were missed'''
+    prefetched = g.get("group_info", {})
+    if group in prefetched:
+        metrics.name_lookups.inc("group", "prefetched")
+        return prefetched[group]
+    metrics.name_lookups.inc("group", "cache")
+    return namecache.groups.get(group)
+
+def referenced_names(posts = (), comments = (), friends = (), groups = ()) -> Tuple[Set[int], Set[int]]:
+    '''The ids of every user and group whose name a page showing these will render'''
+    user_ids = {friend[0] for friend in friends}
+    group_ids = set(groups)
+
+    for post in posts:
+        user_ids.add(post.author_id)
+        user_ids.add(post.wall_owner_id)
+        group_ids.add(post.group_id)
+
+    for comment in comments:
+        user_ids.add(comment.author_id)
+
+    user_ids.discard(None)
+    group_ids.discard(None)
+    return user_ids, group_ids
+
+def prefetch_names(posts = (), comments = (), friends = (), groups = ()):
+    '''
+    Resolves every user and group name a page will reference with at most one query per entity type
+    (for the names that aren't already cached), so rendering the page doesn't run a query per post author,
+    wall owner and group
+    '''
+    user_ids, group_ids = referenced_names(posts, comments, friends, groups)
+    user_info = g.setdefault("user_info", {})
+    group_info = g.setdefault("group_info", {})
+    user_info.update(namecache.users.get_many(user_ids.difference(user_info)))
+    group_info.update(namecache.groups.get_many(group_ids.difference(group_info)))
+
+@app.template_global()
+def cached_post(post: database.PostView):
+    '''macros.post_template's HTML for a post, reused from the fragment cache while it is still current'''
+    return fragments.render(post, app.jinja_env.get_template("macros.html").module.post_template)
 
 @app.template_filter('timestamp_to_datetime')
 def timestamp_to_datetime(timestamp: int):
     return strftime("%A %d %B %Y %I:%M %P", localtime(timestamp / 1000000000)) 
 
+# A matched term in a snippet, between a SNIPPET_START and the SNIPPET_END that closes it
+SNIPPET_MATCH = re.compile(f"{database.SNIPPET_START}([^{database.SNIPPET_START}{database.SNIPPET_END}]*){database.SNIPPET_END}")
+
+@app.template_filter('highlight')
+def highlight(snippet: str):
+    '''Escapes a SearchHit snippet and marks the matched terms in it. Markers that don't pair up are dropped'''
+    # split alternates between the text around matches and the matched terms
+    parts = SNIPPET_MATCH.split(snippet)
+    for index, part in enumerate(parts):
+        part = escape(database.storable_content(part))
+        parts[index] = Markup("<mark>") + part + Markup("</mark>") if index % 2 else part
+    return Markup("").join(parts)
+
 class LoginDummy:
-    def __init__(self, id: str):
+    def __init__(self, id: str, identity: Tuple[str, bool] | None = None):
         self.id = int(id)
-        database_result = database.grab_info_for(id)
-        if database_result is None:
+        if identity is None:
+            identity = namecache.identities.get(self.id)
+        if identity is None:
             raise TypeError("Expected data from the database for user {id}, got None")
-        self._username, self._is_teacher = database_result
+        self._username, self._is_teacher = identity
         self.is_authenticated = True
         self.is_active = True
 
     @classmethod
     def create(cls, id: str) -> Self | None:
-        if not database.user_exists(id):
+        '''Builds the user for an authenticated request. Costs no queries while their identity is cached'''
+        identity = namecache.identities.get(int(id))
+        if identity is None:
             return None
-        return cls(id)
+        return cls(id, identity)
 
     def get_id(self) -> str:
         return str(self.id)
@@ -58,24 +136,270 @@ class LoginDummy:
 def load_user(id: str):
     return LoginDummy.create(id)
 
-def get_shared_logged_in_template_values(user: int):
+@app.cli.command("migrate")
+def migrate():
+    '''Upgrades the database schema in place to the version this code expects, or creates the database'''
+    old, new = migrations.migrate(database.engine.url.database)
+    print(f"Database migrated from schema version {old} to {new}")
+
+before_render_template.connect(metrics.template_started, app)
+template_rendered.connect(metrics.template_finished, app)
+
+@app.before_request
+def begin_timings():
+    '''Times everything the request does from here on (see metrics.py). Registered first, so it runs first'''
+    g.timings = metrics.begin_request()
+
+@app.after_request
+def finish_timings(response):
+    '''Registered first, so it runs after every other after_request hook, including the commit'''
+    timings = metrics.finish_request(request.endpoint, request.method)
+    if timings is not None and metrics.SERVER_TIMING:
+        response.headers["Server-Timing"] = timings.server_timing()
+    return response
+
+@app.teardown_request
+def end_timings(error):
+    token = g.pop("timings", None)
+    if token is not None:
+        metrics.end_request(token)
+
+@app.before_request
+def begin_sql_debug():
+    '''Records every statement of the request in development (see sqldebug.py)'''
+    if app.debug or sqldebug.ENABLED:
+        g.sql_statements = sqldebug.begin_request()
+
+@app.after_request
+def finish_sql_debug(response):
+    if "sql_statements" in g:
+        sqldebug.finish_request(f"{request.method} {request.full_path.rstrip('?')} -> {response.status_code}")
+    return response
+
+@app.teardown_request
+def end_sql_debug(error):
+    token = g.pop("sql_statements", None)
+    if token is not None:
+        sqldebug.end_request(token)
+
+schema_checked = False
+
+@app.before_request
+def refuse_unmigrated_database():
+    '''Cold start check: don't serve anything from a database that is missing migrations'''
+    global schema_checked
+    if schema_checked:
+        return None
+
+    path = database.engine.url.database
+    try:
+        current = migrations.is_current(path)
+    except FileNotFoundError:
+        app.logger.error(f"There is no database at {path}. Create one with `flask --app app migrate`")
+        return make_response("Database not found", 503)
+    if not current:
+        app.logger.error("Database schema is out of date. Run `flask --app app migrate`")
+        return make_response("Database schema is out of date", 503)
+
+    namecache.warm()
+    schema_checked = True
+    # Finish reclaiming any walls a previous process detached but didn't get to delete
+    database.reclaim_in_background()
+    return None
+
+# Endpoints that spend most of their time hashing passwords. They don't get a unit of work, so each database
+# call makes its own short transaction and no lock is held while hashing
+HASHING_ENDPOINTS = {"login", "register", "import_users"}
+
+# Endpoints that stay open for minutes, which mustn't hold a connection and snapshot for all of that time
+STREAMING_ENDPOINTS = {"events_stream"}
+
+# Endpoints whose writes go through the write queue when it is on (see writequeue.py). The writer has to take the
+# write lock, so they mustn't hold it in a unit of work of their own while they wait for it
+QUEUED_WRITE_ENDPOINTS = {"post_handler", "comment_handler"}
+
+@app.before_request
+def begin_unit_of_work():
+    '''Every database call made while handling the request shares one session (see database.begin_unit_of_work)'''
+    if request.endpoint in HASHING_ENDPOINTS or request.endpoint in STREAMING_ENDPOINTS:
+        return None
+    if database.write_queue is not None and request.endpoint in QUEUED_WRITE_ENDPOINTS:
+        return None
+    g.unit_of_work = database.begin_unit_of_work(write = request.method != "GET")
+
+@app.after_request
+def commit_unit_of_work(response):
+    '''Commits the request's writes once, before the response is sent, so a failed commit is reported as one'''
+    if "unit_of_work" in g:
+        try:
+            database.commit_unit_of_work()
+        except database.sql_error:
+            app.logger.exception("Failed to commit the request's unit of work")
+            return make_response("Failed", 500)
+    return response
+
+@got_request_exception.connect_via(app)
+def roll_back_unit_of_work(sender, exception, **extra):
+    '''The view raised. Flask still runs after_request for the 500 it sends, which mustn't commit what the view wrote'''
+    token = g.pop("unit_of_work", None)
+    if token is not None:
+        database.end_unit_of_work(token)
+
+@app.teardown_appcontext
+def end_unit_of_work(error):
+    '''Rolls back anything left uncommitted (e.g. the view raised) and releases the connection'''
+    token = g.pop("unit_of_work", None)
+    if token is not None:
+        database.end_unit_of_work(token)
+
+@app.before_request
+def sync_name_cache():
+    '''Picks up renames made by other workers before anything on this request reads a name'''
+    if schema_checked:
+        namecache.sync()
+
+@app.cli.command("calibrate-argon2")
+@click.option("--target-ms", default = 250.0, help = "Longest acceptable time for one password verification")
+def calibrate_argon2(target_ms: float):
+    '''Picks argon2 parameters for this host and saves them for the next start'''
+    params = passwords.calibrate(target_ms)
+    passwords.save_params(params)
+    print(f"Saved argon2 parameters {params} to {passwords.PARAMS_FILE}. Restart the app to use them")
+
+@app.cli.command("import-users")
+@click.argument("csv_file", type = click.File("r", encoding = "utf-8-sig"))
+@click.option("--report", type = click.File("w"), default = "-", help = "Where to write the names and initial passwords")
+def import_users_command(csv_file, report):
+    '''Creates an account for every name in a CSV (name[,teacher]) and reports their initial passwords'''
+    results = provisioning.import_users(csv_file)
+    provisioning.write_report(results, report)
+    failed = sum(1 for result in results if result.error)
+    print(f"Created {len(results) - failed} accounts, {failed} rows failed", file = sys.stderr)
+
+@app.errorhandler(passwords.HashingOverloaded)
+def hashing_overloaded(error):
+    '''Too many logins / registrations are queued for hashing: ask the client to retry rather than piling up'''
+    response = make_response("Too many people are logging in right now, please try again in a moment", 503)
+    response.headers["Retry-After"] = "2"
+    return response
+
+@app.cli.command("generate-dataset")
+@click.argument("path")
+@click.option("--scale", default = "small", help = "small, medium or large (see datagen.SCALES)")
+@click.option("--seed", default = 0, help = "The same seed and scale always generate the same database")
+def generate_dataset(path: str, scale: str, seed: int):
+    '''Writes a synthetic database for benchmarking to PATH'''
+    # Only the benchmarking commands need datagen and bench, so the web app doesn't import them
+    import datagen
+    if scale not in datagen.SCALES:
+        raise click.BadParameter(f"must be one of {', '.join(datagen.SCALES)}", param_hint = "--scale")
+    datagen.generate(path, scale, seed)
+    print(f"Generated a {scale} database at {path}. Every password is {datagen.PASSWORD!r}")
+
+@app.cli.command("benchmark")
+@click.argument("path")
+@click.option("--iterations", type = int, default = None, help = "Timed calls per case (slow cases make fewer), 50 by default")
+@click.option("--only", default = None, help = "Only run the cases whose name contains this")
+@click.option("--baseline", type = click.Path(exists = True), default = None, help = "Results to compare against")
+@click.option("--save", type = click.Path(), default = None, help = "Where to save these results as a baseline")
+@click.option("--threshold", default = 0.25, help = "How much slower a median may get before it is a regression")
+def benchmark(path: str, iterations: int | None, only: str | None, baseline: str | None, save: str | None, threshold: float):
+    '''Benchmarks every route and database function against a copy of the database at PATH'''
+    import bench
+    results = bench.run(path, iterations or bench.ITERATIONS, only)
+    previous = bench.load_baseline(baseline) if baseline else None
+    regressions = bench.compare(results, previous, threshold) if previous else []
+    print(bench.report(results, previous, regressions))
+    if save:
+        bench.save_baseline(results, save)
+
+    failed = [name for name, result in results.items() if "error" in result]
+    if failed:
+        print(f"{len(failed)} cases failed: {', '.join(failed)}", file = sys.stderr)
+    if regressions:
+        print(f"{len(regressions)} regressions against {baseline}: {', '.join(regressions)}", file = sys.stderr)
+    if failed or regressions:
+        sys.exit(1)
+
+@app.cli.command("rebuild-search")
+def rebuild_search():
+    '''Rebuilds the full text search indexes from the posts and comments tables'''
+    database.rebuild_search_index()
+    print("Rebuilt search indexes")
+
+@app.cli.command("delete-account")
+@click.argument("name")
+def delete_account(name: str):
+    '''Deletes the account called NAME, with everything they posted and everything posted to their wall'''
+    user_id = database.get_user_id_by_name(name)
+    if user_id is None or not database.delete_user(user_id):
+        print(f"Couldn't delete {name!r}", file = sys.stderr)
+        sys.exit(1)
+    # The reclaimer is a daemon thread, so it would stop when the command does
+    database.wait_for_reclaim()
+    print(f"Deleted {name!r}")
+
+@app.cli.command("reclaim-deleted")
+def reclaim_deleted():
+    '''Deletes the posts of every group or account wall that was too big to delete straight away'''
+    print(f"Reclaimed {database.reclaim_deleted_walls()} posts")
+
+@app.cli.command("rebuild-timeline")
+def rebuild_timeline():
+    '''Regenerates the materialized home feed timeline from the post, friendship and membership tables'''
+    print(f"Rebuilt timeline with {database.rebuild_timeline()} entries")
+
+def viewer() -> database.ViewerContext:
+    '''The logged in user's friends, groups and teacher flag, loaded at most once per request'''
+    if "viewer" not in g:
+        g.viewer = database.load_viewer_context(current_user.id)
+    return g.viewer
+
+def get_shared_logged_in_template_values(user: int, posts = (), comments = ()):
+    '''Sidebar values every logged in page needs. Also prefetches the names of everything the page shows'''
+    friends = viewer().friend_list
+    groups = list(viewer().groups)
+    prefetch_names(posts, comments, friends, groups)
     return {
-            "friends": database.get_friends_of(user),
-            "groups": database.get_groups_of(user)
+            "friends": friends,
+            "groups": groups
     }
 
 @app.route("/")
 def index():
     '''Homepage route'''
     if current_user.is_authenticated:
+        page = database.generate_feed(current_user.id)
         return render_template("index.html",
-            posts = database.generate_feed(current_user.id),
+            posts = page.items,
+            next_page = next_page_url("/feed", page),
+            events_url = "/events",
+            wall_id = viewer().wall_id,
             form = forms.PostForm(),
-            **get_shared_logged_in_template_values(current_user.id)
+            **get_shared_logged_in_template_values(current_user.id, posts = page.items)
         )
     else:
         return render_template("index.html")
-        
+
+def next_page_url(route: str, page: database.Page) -> str | None:
+    '''URL that fetches the page after page from route, or None if page is the last one'''
+    if page.cursor is None:
+        return None
+    return f"{route}?cursor={page.cursor}"
+
+@app.route("/feed")
+def feed():
+    '''AJAX endpoint returning the next page of the home feed as rendered html'''
+    if not current_user.is_authenticated:
+        return make_response("Failed", 401)
+
+    page = database.generate_feed(current_user.id, request.args.get("cursor"))
+    prefetch_names(posts = page.items)
+    return {
+        "elem": render_template("feed_items.html", posts=page.items),
+        "next": next_page_url("/feed", page)
+    }
+
 @app.route("/login", methods=["GET","POST"])
 def login():
     '''Login website page / API route'''
@@ -116,8 +440,20 @@ def register():
 
     return render_template("register.html", form=form, user=current_user)
 
-def has_permission_to_access_wall(user: int, wall: int):
-    return user==wall or database.are_friends(user, wall)
+def has_permission_to_access_wall(owner_id: int):
+    return viewer().can_see_wall(owner_id)
+
+def can_see(wall: database.WallView | database.PostView | None) -> bool:
+    '''Checks if the viewer can see a wall, or a post (and so post / comment on it). Same rules as database.can_see_detail_on_post'''
+    if wall is None:
+        return False
+    return viewer().can_see(*wall.owner())
+
+def is_post_admin(post: database.PostView | None) -> bool:
+    '''Checks if the viewer can delete a post: they own the wall / administrate the group, or are a teacher'''
+    if post is None:
+        return False
+    return viewer().can_admin(*post.owner())
 
 @app.route("/wall/<int:id>")
 def render_wall(id: int):
@@ -125,14 +461,22 @@ def render_wall(id: int):
     if not current_user.is_authenticated:
         return redirect("/", 400)
     
-    if not has_permission_to_access_wall(current_user.id, id):
+    if not has_permission_to_access_wall(id):
         return redirect("/", 403)
     
+    wall = database.get_user_wall(id)
+    if wall is None:
+        return redirect("/", 404)
+
+    page = database.posts_to_wall(wall.id)
     return render_template("wall.html",
-                posts=database.posts_to_wall(id),
+                posts=page.items,
+                next_page=next_page_url(f"/walls/{wall.id}/posts", page),
+                events_url=f"/events?wall={wall.id}",
+                wall=wall,
                 wall_owner=database.get_user_by_id(id),
                 form=forms.PostForm(),
-                **get_shared_logged_in_template_values(current_user.id)
+                **get_shared_logged_in_template_values(current_user.id, posts = page.items)
             )
 
 @app.route("/group/<int:id>")
@@ -141,114 +485,213 @@ def render_group(id: int):
     if not current_user.is_authenticated:
         return redirect("/", 400)
     
-    if not database.is_group_member(current_user.id, id):
+    if not viewer().is_group_member(id):
         return redirect("/", 403)
     
+    wall = database.get_group_wall(id)
+    if wall is None:
+        return redirect("/", 404)
+
+    page = database.posts_to_wall(wall.id)
     return render_template("group.html",
-    posts=database.posts_to_group(id),
-                group=database.get_sidebar_group_info(id),
+                posts=page.items,
+                next_page=next_page_url(f"/walls/{wall.id}/posts", page),
+                events_url=f"/events?wall={wall.id}",
+                wall=wall,
+                group=namecache.groups.get(id),
                 form=forms.PostForm(),
-                is_admin=database.is_group_admin(current_user.id, id),
-                **get_shared_logged_in_template_values(current_user.id)
+                is_admin=viewer().is_group_admin(id),
+                **get_shared_logged_in_template_values(current_user.id, posts = page.items)
             )
 
-@app.route("/post/<string:target_t>/<int:id>", methods=["POST"])
-def post_handler(target_t: str, id: int):
+@app.route("/walls/<int:wall_id>/posts")
+def more_wall_posts(wall_id: int):
+    '''AJAX endpoint returning the next page of a user's or group's wall as rendered html'''
+    if not current_user.is_authenticated:
+        return make_response("Failed", 401)
+
+    if not can_see(database.get_wall(wall_id)):
+        return make_response("Failed", 403)
+
+    page = database.posts_to_wall(wall_id, request.args.get("cursor"))
+    prefetch_names(posts = page.items)
+    return {
+        "elem": render_template("feed_items.html", posts=page.items),
+        "next": next_page_url(f"/walls/{wall_id}/posts", page)
+    }
+
+@app.route("/post/<int:wall_id>", methods=["POST"])
+def post_handler(wall_id: int):
     '''POST endpoint to make a post'''
     if not current_user.is_authenticated:
         return redirect("/", 401)
 
-    post = None
     form = forms.PostForm()
     if form.validate_on_submit():
-        if target_t == "wall":
-            if not has_permission_to_access_wall(current_user.id, id):
-                return make_response("Failed", 403)
-            
-            post = database.post_to_wall(current_user.id, form.content.data, id)
-        elif target_t == "group":
-            if not database.is_group_member(current_user.id, id):
-                return make_response("Failed", 403)
-
-            post = database.post_to_group(current_user.id, form.content.data, id)
-
-        else:
-            return make_response("Failed", 400)
-        
+        wall = database.get_wall(wall_id)
+        if not can_see(wall):
+            return make_response("Failed", 403)
+
+        post = database.post_to_wall(current_user.id, form.content.data, wall)
         if post is not None:
+            prefetch_names(posts = [post])
             return { "elem" : render_template("post.html", post=post) }
     
     return make_response("Failed", 400)
 
-@app.route("/comment/<string:target_t>/<int:id>", methods=["POST"])
-def comment_handler(target_t: str, id: int):
+@app.route("/comment/<int:id>", methods=["POST"])
+def comment_handler(id: int):
     '''POST endpoint to create comments on a post'''
     if not current_user.is_authenticated:
         return redirect("/", 401)
 
-    post = None
     form = forms.PostForm()
     if form.validate_on_submit():
-        if target_t == "wall":
-            print(f"{current_user.id=} {id=}")
-            if not database.can_comment_on_wall_post(current_user.id, id):
-                return make_response("Failed", 403)
-            
-            post = database.comment_to_wall(current_user.id, form.content.data, id)
-        elif target_t == "group":
-            if not database.can_comment_on_group_post(current_user.id, id):
-                return make_response("Failed", 403)
-
-            post = database.comment_to_group(current_user.id, form.content.data, id)
-
-        else:
-            return make_response("Failed", 400)
-        
-        if post is not None:
-            return { "elem" : render_template("comment.html", comment=post) }
+        if not can_see(database.get_post(id)):
+            return make_response("Failed", 403)
+
+        comment = database.comment_on_post(current_user.id, form.content.data, id)
+        if comment is not None:
+            prefetch_names(comments = [comment])
+            return { "elem" : render_template("comment.html", comment=comment) }
     
     return make_response("Failed", 400)
 
-@app.route("/posts/<string:target_t>/<int:id>")
-def detailed_post(target_t: str, id: int):
+@app.route("/posts/<int:id>")
+def detailed_post(id: int):
     '''Renders detailed view of a post'''
-    if current_user.is_authenticated and database.can_see_detail_on_post(target_t, current_user.id, id):
-        comments = None
-        post = None
-        is_admin = None
-
-        if target_t == "wall":
-            post = database.get_wall_post(id)
-            comments = database.get_wall_post_comments(id)
-            is_admin = database.is_wall_post_admin(current_user.id, id)
-        else:
-            post = database.get_group_post(id)
-            comments = database.get_group_post_comments(id)
-            is_admin = database.is_group_admin(current_user.id, id)
-
-        if post is None:
-            print(f"{comments=} {post=}")
-            return redirect("/")
+    if not current_user.is_authenticated:
+        return redirect("/", 401)
 
-        print(f"{post=}")
+    post = database.get_post(id)
+    if not can_see(post):
+        return redirect("/", 401)
 
-        return render_template("post_detail.html",
-            post = post,
-            comments = comments,
-            form = forms.PostForm(),
-            target_t = target_t,
-            is_admin = is_admin,
-            **get_shared_logged_in_template_values(current_user.id)
-        )
-    else:
-        print(f"{target_t=}")
-        if target_t == "wall":
-            print(f"{current_user.id=} {id=}")
-            print(f"{has_permission_to_access_wall(current_user.id, id)=}")
-        else:
-            print(f"{database.is_group_member(current_user.id, id)=}")
+    page = database.get_post_comments(id)
+    return render_template("post_detail.html",
+        post = post,
+        comments = page.items,
+        next_page = next_page_url(f"/posts/{id}/comments", page),
+        events_url = f"/events?post={id}",
+        form = forms.PostForm(),
+        is_admin = is_post_admin(post),
+        **get_shared_logged_in_template_values(current_user.id, posts = [post], comments = page.items)
+    )
+
+@app.route("/posts/<int:id>/comments")
+def more_comments(id: int):
+    '''AJAX endpoint returning the next page of a post's comments as rendered html'''
+    if not current_user.is_authenticated:
+        return make_response("Failed", 401)
+
+    post = database.get_post(id)
+    if not can_see(post):
+        return make_response("Failed", 403)
+
+    page = database.get_post_comments(id, request.args.get("cursor"))
+    prefetch_names(comments = page.items)
+    return {
+        "elem": render_template("comment_items.html", comments=page.items, is_admin=is_post_admin(post)),
+        "next": next_page_url(f"/posts/{id}/comments", page)
+    }
+
+def search_page_url(terms: str, page: database.Page) -> str | None:
+    '''URL that fetches the search results after page, or None if page is the last one'''
+    if page.cursor is None:
+        return None
+    return "/search/results?" + urlencode({"q": terms, "cursor": page.cursor})
+
+@app.route("/search")
+def search():
+    '''Full text search over the posts and comments the viewer can see'''
+    if not current_user.is_authenticated:
         return redirect("/", 401)
 
+    form = forms.SearchForm(request.args)
+    terms = form.q.data or ""
+    page = database.search(current_user.id, terms)
+    return render_template("search.html",
+        form = form,
+        terms = terms,
+        hits = page.items,
+        next_page = search_page_url(terms, page),
+        **get_shared_logged_in_template_values(current_user.id, comments = page.items)
+    )
+
+@app.route("/search/results")
+def more_search_results():
+    '''AJAX endpoint returning the next page of search results as rendered html'''
+    if not current_user.is_authenticated:
+        return make_response("Failed", 401)
+
+    terms = request.args.get("q", "")
+    page = database.search(current_user.id, terms, request.args.get("cursor"))
+    prefetch_names(comments = page.items)
+    return {
+        "elem": render_template("search_items.html", hits=page.items),
+        "next": search_page_url(terms, page)
+    }
+
+# Streams are closed after this many seconds. The browser reconnects straight away, which re-checks what the
+# viewer may see (e.g. after a friendship ends)
+EVENT_STREAM_LIFETIME = 300
+EVENT_KEEPALIVE = 15
+
+@app.route("/events")
+def events_stream():
+    '''
+    Server sent events stream of new posts (as feed_items.html fragments) on the walls the viewer can see, or just
+    ?wall=<wall id>, or of new comments (as comment_items.html fragments) on ?post=<post id>
+    '''
+    if not current_user.is_authenticated:
+        return make_response("Failed", 401)
+
+    is_admin = False
+    if "post" in request.args:
+        post = database.get_post(request.args.get("post", type = int))
+        if not can_see(post):
+            return make_response("Failed", 403)
+        topics = [events.post_topic(post.id)]
+        is_admin = is_post_admin(post)
+    elif "wall" in request.args:
+        wall = database.get_wall(request.args.get("wall", type = int))
+        if not can_see(wall):
+            return make_response("Failed", 403)
+        topics = [events.wall_topic(wall.id)]
+    else:
+        topics = [events.wall_topic(wall_id) for wall_id in database.visible_wall_ids(current_user.id)]
+
+    viewer_id = current_user.id
+    subscription = events.subscribe(topics)
+
+    def render(event: events.Event) -> str:
+        if event.kind == "post":
+            prefetch_names(posts = [event.item])
+            return render_template("feed_items.html", posts = [event.item])
+        prefetch_names(comments = [event.item])
+        return render_template("comment_items.html", comments = [event.item], is_admin = is_admin)
+
+    def stream():
+        try:
+            # WSGI servers only send the headers along with the first chunk, so send one straight away
+            yield ": open\n\n"
+            deadline = time.monotonic() + EVENT_STREAM_LIFETIME
+            while not subscription.closed and time.monotonic() < deadline:
+                event = subscription.get(timeout = EVENT_KEEPALIVE)
+                if event is None:
+                    # Lets the server notice clients that went away
+                    yield ": keepalive\n\n"
+                elif event.item.author_id != viewer_id:
+                    # Authors already got their own posts and comments back from the form
+                    yield f"data: {json.dumps({'elem': render(event)})}\n\n"
+        finally:
+            subscription.close()
+
+    response = Response(stream_with_context(stream()), mimetype = "text/event-stream", headers = {"Cache-Control": "no-cache"})
+    # stream's finally only runs once it has started, and a client can go away before that
+    response.call_on_close(subscription.close)
+    return response
+
 @app.route("/friend_request", methods=["POST", "GET"])
 def friend_request():
     '''Handles page for making a friend request and provides POST endpoint to add request into model'''
@@ -270,14 +713,13 @@ def friend_request_splash(id: int):
     if not current_user.is_authenticated:
         return redirect("/")
    
-    other = database.requester(current_user.id, id) 
-    if other is None:
+    requester = viewer().requester(id)
+    if requester is None:
         return redirect("/")
 
-    other = other[0]
-    made = other == current_user.id
+    made = requester == current_user.id
 
-    return render_template("friend_request_splash.html", made = made, other = other, **get_shared_logged_in_template_values(current_user.id))
+    return render_template("friend_request_splash.html", made = made, other = id, **get_shared_logged_in_template_values(current_user.id))
 
 @app.route("/accept_friendship/<int:id>")
 def accept_friend_request(id: int):
@@ -320,7 +762,7 @@ def join_group():
 def delete_group():
     '''POST endpoint to handle group deletion'''
     if current_user.is_authenticated:
-        if database.is_group_admin(current_user.id, request.json['id']):
+        if viewer().is_group_admin(request.json['id']):
             if database.delete_group(request.json['id']):
                 return make_response("SUCCESS", 200) 
 
@@ -334,8 +776,8 @@ def rename():
 
     form = forms.RenameForm()
     if form.validate_on_submit():
+        # The rename is logged in name_changes, so every worker's name cache (this one's too) picks it up once it commits
         database.rename(current_user.id, form.name.data)
-        get_sidebar_user_info.cache_clear()
         return redirect("/")
 
     return render_template("rename.html", form=form, **get_shared_logged_in_template_values(current_user.id))
@@ -344,6 +786,57 @@ def rename():
 def delete_post():
     '''POST endpoint for an admin / wall owner to delete a post'''
     if current_user.is_authenticated:
-        if database.delete_post(request.json['target_t'], request.json['post_id']):
+        post_id = request.json['post_id']
+        if is_post_admin(database.get_post(post_id)) and database.delete_post(post_id):
+            fragments.posts.invalidate(post_id)
             return make_response("SUCCESS", 200)
     return make_response("FAILED", 500) 
+
+@app.route("/cache_stats")
+def cache_stats():
+    '''Teacher only JSON endpoint reporting this worker's name, identity and fragment cache hit rates'''
+    if not current_user.is_authenticated or not current_user._is_teacher:
+        return make_response("Failed", 403)
+    return {**namecache.stats(), "fragments": fragments.stats()}
+
+# Lets a Prometheus scraper read /metrics with `Authorization: Bearer <token>`. Teachers can always read it
+METRICS_TOKEN = os.environ.get("SOCIALITE_METRICS_TOKEN")
+
+@app.route("/metrics")
+def metrics_endpoint():
+    '''This worker's request timings and cache counters, in Prometheus text format'''
+    authorization = request.headers.get("Authorization", "")
+    scraper = METRICS_TOKEN is not None and hmac.compare_digest(authorization, f"Bearer {METRICS_TOKEN}")
+    if not scraper and (not current_user.is_authenticated or not current_user._is_teacher):
+        return make_response("Failed", 403)
+    caches = {**namecache.stats(), "fragments": fragments.stats()}
+    return Response(metrics.exposition(caches), mimetype = "text/plain; version=0.0.4")
+
+@app.route("/delete_comment", methods = ["POST"])
+def delete_comment():
+    '''POST endpoint for a comment's author or an admin of its post to delete it'''
+    if current_user.is_authenticated:
+        comment_id = request.json['comment_id']
+        comment = database.get_comment(comment_id)
+        if comment is not None and (comment.author_id == current_user.id or is_post_admin(database.get_post(comment.post_id))):
+            if database.delete_comment(comment_id):
+                return make_response("SUCCESS", 200)
+    return make_response("FAILED", 500)
+
+@app.route("/import_users", methods = ["GET", "POST"])
+def import_users():
+    '''Teacher only page / POST endpoint to create accounts in bulk from a CSV. Responds with a CSV of initial passwords'''
+    if not current_user.is_authenticated or not current_user._is_teacher:
+        return redirect("/")
+
+    form = forms.ImportUsersForm()
+    if form.validate_on_submit():
+        results = provisioning.import_users(io.TextIOWrapper(form.file.data.stream, encoding = "utf-8-sig", newline = ""))
+        report = io.StringIO()
+        provisioning.write_report(results, report)
+        response = make_response(report.getvalue(), 200)
+        response.headers["Content-Type"] = "text/csv"
+        response.headers["Content-Disposition"] = "attachment; filename=new_accounts.csv"
+        return response
+
+    return render_template("import_users.html", form=form, **get_shared_logged_in_template_values(current_user.id))
@@ -0,0 +1,312 @@
+'''
+ASGI entry point for the async serving mode: `uvicorn asgi:app`.
+
+The endpoints that spend their time waiting are served natively on the event loop: /events streams, and the
+next page endpoints of the feed, walls and comments (/feed, /walls/<id>/posts, /posts/<id>/comments). They await
+aiodatabase.py instead of blocking a thread, so open streams and slow queries don't need a thread each. They are
+the same handlers as in app.py with awaits added, and run inside a Flask request context for the request, with
+the user loaded by flask-login, so they render the same templates with the same permission checks.
+
+Every other request is handed to the Flask app in app.py, which asgiref runs on a thread pool. So are native
+requests that flask-login can't log in from the session alone (e.g. remember me logins, or ones session protection
+flags), since only the Flask app sends cookies, and everything until the Flask app has done its cold start schema
+check. Routes, templates and forms therefore behave the same
+in both modes, and writes only ever go through database.py
+'''
+from flask import Response, render_template, make_response, request, session, g
+from flask_login import current_user
+from asgiref.wsgi import WsgiToAsgi
+
+from typing import AsyncIterator
+import asyncio
+import io
+import json
+import re
+import sys
+import time
+
+import aiodatabase
+import app as webapp
+import events
+import metrics
+import namecache
+import sqldebug
+
+import logging
+log = logging.getLogger("asgi")
+
+flask_app = webapp.app
+wsgi = WsgiToAsgi(flask_app)
+
+class Stream:
+    '''A streamed text/event-stream response from a native handler'''
+    def __init__(self, chunks: AsyncIterator[str]):
+        self.chunks = chunks
+
+def wsgi_environ(scope) -> dict:
+    '''The WSGI environ for a bodiless ASGI request, as asgiref would build it for the Flask app'''
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "SERVER_NAME": scope["server"][0] if scope.get("server") else "localhost",
+        "SERVER_PORT": str(scope["server"][1]) if scope.get("server") else "80",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = f"HTTP_{name}"
+        environ[name] = f"{environ[name]},{value.decode('latin-1')}" if name in environ else value.decode("latin-1")
+    return environ
+
+async def authenticate() -> bool:
+    '''
+    Logs in the current request's user through flask-login, as the Flask app would, and checks it's one a native
+    handler can serve: logged in by the session alone, and without flask-login changing the session (e.g. a
+    remember me login, or session protection), because only the Flask app sends session cookies. Their identity
+    is loaded without blocking first, so the user_loader finds it cached
+    '''
+    user_id = session.get("_user_id")
+    if user_id is None:
+        return False
+
+    if namecache.identities.lookup(int(user_id)) is None:
+        identity = await aiodatabase.grab_info_for(int(user_id))
+        if identity is None:
+            return False
+        namecache.identities.put(int(user_id), identity)
+
+    return current_user.is_authenticated and not session.modified
+
+async def sync_name_cache():
+    '''namecache.sync, without blocking the event loop'''
+    changes = await aiodatabase.name_changes_since(namecache.watermark)
+    if changes:
+        with namecache.watermark_lock:
+            namecache.apply_changes(changes)
+
+async def viewer():
+    '''app.viewer, without blocking the event loop. app.can_see and friends use what this loads'''
+    if "viewer" not in g:
+        g.viewer = await aiodatabase.load_viewer_context(current_user.id)
+    return g.viewer
+
+async def prefetch_names(posts = (), comments = ()):
+    '''app.prefetch_names, without blocking the event loop'''
+    user_ids, group_ids = webapp.referenced_names(posts, comments)
+    user_info = g.setdefault("user_info", {})
+    group_info = g.setdefault("group_info", {})
+    for cache, ids, info, load_many in (
+        (namecache.users, user_ids, user_info, aiodatabase.get_sidebar_user_infos),
+        (namecache.groups, group_ids, group_info, aiodatabase.get_sidebar_group_infos)
+    ):
+        found, missing = cache.lookup(ids.difference(info))
+        if missing:
+            loaded = await load_many(missing)
+            cache.put_many(loaded)
+            found.update(loaded)
+        info.update(found)
+
+async def feed():
+    '''app.feed'''
+    page = await aiodatabase.generate_feed(current_user.id, request.args.get("cursor"))
+    await prefetch_names(posts = page.items)
+    return {
+        "elem": render_template("feed_items.html", posts=page.items),
+        "next": webapp.next_page_url("/feed", page)
+    }
+
+async def more_wall_posts(wall_id: int):
+    '''app.more_wall_posts'''
+    await viewer()
+    if not webapp.can_see(await aiodatabase.get_wall(wall_id)):
+        return make_response("Failed", 403)
+
+    page = await aiodatabase.posts_to_wall(wall_id, request.args.get("cursor"))
+    await prefetch_names(posts = page.items)
+    return {
+        "elem": render_template("feed_items.html", posts=page.items),
+        "next": webapp.next_page_url(f"/walls/{wall_id}/posts", page)
+    }
+
+async def more_comments(id: int):
+    '''app.more_comments'''
+    await viewer()
+    post = await aiodatabase.get_post(id)
+    if not webapp.can_see(post):
+        return make_response("Failed", 403)
+
+    page = await aiodatabase.get_post_comments(id, request.args.get("cursor"))
+    await prefetch_names(comments = page.items)
+    return {
+        "elem": render_template("comment_items.html", comments=page.items, is_admin=webapp.is_post_admin(post)),
+        "next": webapp.next_page_url(f"/posts/{id}/comments", page)
+    }
+
+async def events_stream():
+    '''app.events_stream'''
+    await viewer()
+    is_admin = False
+    if "post" in request.args:
+        post = await aiodatabase.get_post(request.args.get("post", type = int))
+        if not webapp.can_see(post):
+            return make_response("Failed", 403)
+        topics = [events.post_topic(post.id)]
+        is_admin = webapp.is_post_admin(post)
+    elif "wall" in request.args:
+        wall = await aiodatabase.get_wall(request.args.get("wall", type = int))
+        if not webapp.can_see(wall):
+            return make_response("Failed", 403)
+        topics = [events.wall_topic(wall.id)]
+    else:
+        topics = [events.wall_topic(wall_id) for wall_id in await aiodatabase.visible_wall_ids(current_user.id)]
+
+    viewer_id = current_user.id
+    subscription = events.subscribe_async(topics)
+
+    async def render(event: events.Event) -> str:
+        if event.kind == "post":
+            await prefetch_names(posts = [event.item])
+            return render_template("feed_items.html", posts = [event.item])
+        await prefetch_names(comments = [event.item])
+        return render_template("comment_items.html", comments = [event.item], is_admin = is_admin)
+
+    async def stream():
+        try:
+            yield ": open\n\n"
+            deadline = time.monotonic() + webapp.EVENT_STREAM_LIFETIME
+            while not subscription.closed and time.monotonic() < deadline:
+                event = await subscription.get(timeout = webapp.EVENT_KEEPALIVE)
+                if event is None:
+                    yield ": keepalive\n\n"
+                elif event.item.author_id != viewer_id:
+                    yield f"data: {json.dumps({'elem': await render(event)})}\n\n"
+        finally:
+            subscription.close()
+
+    return Stream(stream())
+
+# (path pattern, handler, whether it reads in a unit of work) of every GET endpoint served natively
+NATIVE_ROUTES = [
+    (re.compile(r"/feed"), feed, True),
+    (re.compile(r"/walls/(?P<wall_id>\d+)/posts"), more_wall_posts, True),
+    (re.compile(r"/posts/(?P<id>\d+)/comments"), more_comments, True),
+    # Streams stay open for minutes, so like in app.py they don't hold a snapshot
+    (re.compile(r"/events"), events_stream, False),
+]
+
+def match_native_route(scope):
+    if scope["method"] != "GET":
+        return None
+    for pattern, handler, unit_of_work in NATIVE_ROUTES:
+        match = pattern.fullmatch(scope["path"])
+        if match is not None:
+            return handler, {name: int(value) for name, value in match.groupdict().items()}, unit_of_work
+    return None
+
+async def send_response(send, response: Response):
+    await send({
+        "type": "http.response.start",
+        "status": response.status_code,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in response.headers.items()]
+    })
+    await send({"type": "http.response.body", "body": response.get_data()})
+
+async def send_stream(receive, send, stream: Stream):
+    '''Sends a Stream until it ends or the client goes away, whichever is first'''
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream; charset=utf-8"), (b"cache-control", b"no-cache")]
+    })
+
+    async def pump():
+        async for chunk in stream.chunks:
+            await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def wait_for_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(wait_for_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when = asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+
+async def serve_native(scope, receive, send, handler, kwargs: dict, unit_of_work: bool) -> bool:
+    '''Serves a request with a native handler. Returns False, having sent nothing, if Flask has to serve it instead'''
+    if not webapp.schema_checked:
+        return False
+
+    with flask_app.request_context(wsgi_environ(scope)):
+        await sync_name_cache()
+        if not await authenticate():
+            return False
+
+        timings_token = metrics.begin_request()
+        statements_token = sqldebug.begin_request() if flask_app.debug or sqldebug.ENABLED else None
+        try:
+            token = aiodatabase.begin_unit_of_work() if unit_of_work else None
+            try:
+                result = await handler(**kwargs)
+            except Exception:
+                flask_app.logger.exception(f"Exception on {scope['path']} [GET]")
+                result = make_response("Internal Server Error", 500)
+            finally:
+                if token is not None:
+                    await aiodatabase.end_unit_of_work(token)
+
+            # Native handlers are named after the Flask endpoints they mirror
+            timings = metrics.finish_request(handler.__name__, "GET")
+            if statements_token is not None:
+                query = "?" + scope["query_string"].decode("latin-1") if scope["query_string"] else ""
+                sqldebug.finish_request(f"GET {scope['path']}{query} (native)")
+            if isinstance(result, Stream):
+                await send_stream(receive, send, result)
+            else:
+                response = flask_app.make_response(result)
+                if metrics.SERVER_TIMING:
+                    response.headers["Server-Timing"] = timings.server_timing()
+                await send_response(send, response)
+        finally:
+            if statements_token is not None:
+                sqldebug.end_request(statements_token)
+            metrics.end_request(timings_token)
+    return True
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await aiodatabase.engine.dispose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    '''The ASGI application'''
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    if scope["type"] == "http":
+        route = match_native_route(scope)
+        if route is not None and await serve_native(scope, receive, send, *route):
+            return
+
+    await wsgi(scope, receive, send)
@@ -0,0 +1,377 @@
+'''
+Benchmarks of every app.py route (through the Flask test client) and of database.py's reads and writes (called
+directly), run against a copy of a datagen.py database so that writes never touch the original.
+
+Each case reports latency percentiles in milliseconds, SQL statements per call, and the peak memory one call
+allocates. Memory is measured in a separate tracemalloc pass, since tracing slows everything else down.
+Results can be saved as a baseline and compared against later:
+
+    flask generate-dataset bench.db --scale medium
+    flask benchmark bench.db --save bench_baseline.json
+    flask benchmark bench.db --baseline bench_baseline.json
+
+A case is a regression when it runs more queries than its baseline, or its median is slower by more than the
+threshold (and by more than NOISE_FLOOR_MS, so sub-millisecond jitter doesn't count)
+'''
+from contextlib import redirect_stdout
+from typing import Callable, Dict, List
+import contextvars
+import io
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from sqlalchemy import event, select, func
+
+import database
+import datagen
+import fragments
+import namecache
+
+import logging
+log = logging.getLogger("bench")
+
+ITERATIONS = 50
+WARMUP = 3
+NOISE_FLOOR_MS = 0.2
+BURST_WRITERS = 32
+
+class Case:
+    '''
+    One thing to benchmark. run(fixture, i) is timed, once per iteration i. prepare(fixture, iterations), if
+    given, runs first and untimed, and whatever it returns is passed to run as fixture.prepared
+    '''
+    def __init__(self, name: str, run: Callable, prepare: Callable | None = None, iterations: int | None = None):
+        self.name = name
+        self.run = run
+        self.prepare = prepare
+        self.iterations = iterations
+
+class Fixture:
+    '''The ids and clients cases work with, picked from the benchmark database with a fixed seed'''
+    def __init__(self, app, seed: int = 0):
+        rng = random.Random(seed)
+        with database.session_scope() as session:
+            # The best connected user, whose feed and sidebar are the most expensive to build
+            self.user_id = session.scalar(
+                select(database.Friendship.first).group_by(database.Friendship.first).order_by(func.count().desc(), database.Friendship.first).limit(1))
+            self.teacher_id = session.scalar(select(database.User.id).where(database.User.is_teacher == True).order_by(database.User.id).limit(1))
+            self.user_name = session.scalar(select(database.User.name).where(database.User.id == self.user_id))
+            user_ids = list(session.scalars(select(database.User.id).order_by(database.User.id)))
+            self.strangers = [id for id in rng.sample(user_ids, min(len(user_ids), 400)) if id != self.user_id]
+
+        self.context = database.load_viewer_context(self.user_id)
+        self.wall_id = self.context.wall_id
+        self.friend_id = min(self.context.friends)
+        self.friend_wall_id = database.get_user_wall(self.friend_id).id
+        self.group_id = min(self.context.groups)
+        self.group_wall_id = database.get_group_wall(self.group_id).id
+
+        feed = database.generate_feed(self.user_id)
+        self.feed_cursor = feed.cursor
+        self.wall_cursor = database.posts_to_wall(self.group_wall_id).cursor
+        # The most commented post the user can see
+        self.post = max(feed.items, key = lambda post: post.comment_count)
+        self.comment_cursor = database.get_post_comments(self.post.id).cursor
+        self.search_terms = "school work"
+        self.search_cursor = database.search(self.user_id, self.search_terms).cursor
+
+        self.app = app
+        self.client = self.login(app, self.user_id)
+        self.teacher = self.login(app, self.teacher_id)
+        self.prepared = None
+
+    @property
+    def anonymous(self):
+        '''A new client that isn't logged in (logging in with it would log every later request in)'''
+        return self.app.test_client()
+
+    @staticmethod
+    def login(app, user_id: int):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(user_id)
+            session["_fresh"] = True
+        return client
+
+def get(path: str, client: str = "client", status: int = 200) -> Callable:
+    '''A run function GETting path with one of the fixture's clients and checking the status'''
+    def run(fixture: Fixture, i: int):
+        response = getattr(fixture, client).get(path.format(f = fixture, i = i))
+        check(response, status)
+    return run
+
+def check(response, status: int):
+    if response.status_code != status:
+        raise AssertionError(f"Expected status {status}, got {response.status_code}: {response.data[:200]!r}")
+
+def own_posts(fixture: Fixture, iterations: int) -> List[int]:
+    wall = database.get_wall(fixture.wall_id)
+    return [database.post_to_wall(fixture.user_id, f"Benchmark post {i}", wall).id for i in range(iterations)]
+
+def own_comments(fixture: Fixture, iterations: int) -> List[int]:
+    return [database.comment_on_post(fixture.user_id, f"Benchmark comment {i}", fixture.post.id).id for i in range(iterations)]
+
+def own_groups(fixture: Fixture, iterations: int) -> List[int]:
+    for i in range(iterations):
+        database.create_group(fixture.user_id, f"Benchmark group {i}")
+    stmt = select(database.GroupMembership.group_id) \
+        .where(database.GroupMembership.member_id == fixture.user_id, database.GroupMembership.is_admin == True) \
+        .order_by(database.GroupMembership.group_id.desc()).limit(iterations)
+    with database.session_scope() as session:
+        return list(session.scalars(stmt))
+
+def requests_to_user(fixture: Fixture, iterations: int) -> List[int]:
+    '''Strangers who have sent the user a friend request'''
+    requesters = [id for id in fixture.strangers if not database.are_friends(id, fixture.user_id)
+                  and database.requester(id, fixture.user_id) is None][:iterations]
+    for id in requesters:
+        database.friend_request(id, fixture.user_name)
+    return requesters
+
+def stream_opened(fixture: Fixture, i: int):
+    '''Opens an /events stream and closes it as soon as it is set up'''
+    response = fixture.client.get("/events", buffered = False)
+    check(response, 200)
+    response.close()
+
+def post_form(path: str, data: Callable, client: str = "client", status: int = 200) -> Callable:
+    def run(fixture: Fixture, i: int):
+        check(getattr(fixture, client).post(path.format(f = fixture, i = i), data = data(fixture, i)), status)
+    return run
+
+def post_json(path: str, data: Callable, status: int = 200) -> Callable:
+    def run(fixture: Fixture, i: int):
+        check(fixture.client.post(path, json = data(fixture, i)), status)
+    return run
+
+def post_burst(fixture: Fixture, i: int):
+    '''BURST_WRITERS people posting to the same group at once, as when a class is asked to post their answers'''
+    wall = database.get_wall(fixture.group_wall_id)
+    posted = []
+    def post(n: int):
+        posted.append(database.post_to_wall(fixture.user_id, f"Benchmark burst {i} {n}", wall))
+    threads = [threading.Thread(target = post, args = (n,)) for n in range(BURST_WRITERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if None in posted or len(posted) != BURST_WRITERS:
+        raise AssertionError(f"{posted.count(None)} of {BURST_WRITERS} posts in a burst failed")
+
+def import_csv(fixture: Fixture, i: int):
+    csv = io.BytesIO("".join(f"Benchmark import {i} {n}\n" for n in range(20)).encode())
+    check(fixture.teacher.post("/import_users", data = {"file": (csv, "names.csv")}), 200)
+
+ROUTE_CASES = [
+    Case("GET /", get("/")),
+    Case("GET /feed", get("/feed?cursor={f.feed_cursor}")),
+    Case("GET /wall/<id>", get("/wall/{f.friend_id}")),
+    Case("GET /group/<id>", get("/group/{f.group_id}")),
+    Case("GET /walls/<id>/posts", get("/walls/{f.group_wall_id}/posts?cursor={f.wall_cursor}")),
+    Case("GET /posts/<id>", get("/posts/{f.post.id}")),
+    Case("GET /posts/<id>/comments", get("/posts/{f.post.id}/comments?cursor={f.comment_cursor}")),
+    Case("GET /search", get("/search?q={f.search_terms}")),
+    Case("GET /search/results", get("/search/results?q={f.search_terms}&cursor={f.search_cursor}")),
+    Case("GET /events", stream_opened),
+    Case("GET /friend_request", get("/friend_request")),
+    Case("GET /friend_request/<id>", get("/friend_request/{f.prepared[0]}"), prepare = lambda f, n: requests_to_user(f, 1)),
+    Case("GET /group_join", get("/group_join")),
+    Case("GET /rename", get("/rename")),
+    Case("GET /import_users", get("/import_users", client = "teacher")),
+    Case("GET /cache_stats", get("/cache_stats", client = "teacher")),
+    Case("GET /metrics", get("/metrics", client = "teacher")),
+    Case("GET /login", get("/login", client = "anonymous")),
+    Case("GET /register", get("/register", client = "anonymous")),
+    Case("POST /post/<wall id>", post_form("/post/{f.friend_wall_id}", lambda f, i: {"content": f"Benchmark post {i}"})),
+    Case("POST /comment/<id>", post_form("/comment/{f.post.id}", lambda f, i: {"content": f"Benchmark comment {i}"})),
+    Case("POST /friend_request", post_form("/friend_request", lambda f, i: {"name": f"Nobody {i}"}, status = 302)),
+    Case("GET /accept_friendship/<id>", lambda f, i: check(f.client.get(f"/accept_friendship/{f.prepared[i]}"), 302), prepare = requests_to_user, iterations = 20),
+    Case("GET /end_friendship/<id>", lambda f, i: check(f.client.get(f"/end_friendship/{f.prepared[i]}"), 302), prepare = requests_to_user, iterations = 20),
+    Case("POST /group_join", post_form("/group_join", lambda f, i: {"name": f"Benchmark group {i}"}, status = 302)),
+    # Renames the teacher, since the cases that log in need the user's name
+    Case("POST /rename", post_form("/rename", lambda f, i: {"name": f"Benchmark teacher {i}"}, client = "teacher", status = 302)),
+    Case("POST /delete_post", post_json("/delete_post", lambda f, i: {"post_id": f.prepared[i]}), prepare = own_posts),
+    Case("POST /delete_comment", post_json("/delete_comment", lambda f, i: {"comment_id": f.prepared[i]}), prepare = own_comments),
+    Case("POST /delete_group", post_json("/delete_group", lambda f, i: {"id": f.prepared[i]}), prepare = own_groups, iterations = 20),
+    Case("POST /login", post_form("/login", lambda f, i: {"username": f.user_name, "password": datagen.PASSWORD}, client = "anonymous", status = 302), iterations = 5),
+    Case("POST /register", post_form("/register", lambda f, i: {"username": f"Benchmark {i}", "password": "p", "confirmed_password": "p"}, client = "anonymous", status = 302), iterations = 5),
+    Case("POST /import_users", import_csv, iterations = 2),
+    Case("GET /logout", lambda f, i: check(f.prepared[i].get("/logout"), 302), prepare = lambda f, n: [Fixture.login(f.app, f.user_id) for _ in range(n)]),
+]
+
+DATABASE_CASES = [
+    Case("generate_feed", lambda f, i: database.generate_feed(f.user_id)),
+    Case("generate_feed (page 2)", lambda f, i: database.generate_feed(f.user_id, f.feed_cursor)),
+    Case("posts_to_wall", lambda f, i: database.posts_to_wall(f.group_wall_id)),
+    Case("get_post", lambda f, i: database.get_post(f.post.id)),
+    Case("get_post_comments", lambda f, i: database.get_post_comments(f.post.id)),
+    Case("get_wall", lambda f, i: database.get_wall(f.friend_wall_id)),
+    Case("load_viewer_context", lambda f, i: database.load_viewer_context(f.user_id)),
+    Case("visible_wall_ids", lambda f, i: database.visible_wall_ids(f.user_id)),
+    Case("get_sidebar_user_infos (100)", lambda f, i: database.get_sidebar_user_infos(f.strangers[:100])),
+    Case("get_sidebar_group_infos", lambda f, i: database.get_sidebar_group_infos(f.context.groups)),
+    Case("grab_info_for", lambda f, i: database.grab_info_for(f.user_id)),
+    Case("get_friends_of", lambda f, i: database.get_friends_of(f.user_id)),
+    Case("get_groups_of", lambda f, i: database.get_groups_of(f.user_id)),
+    Case("are_friends", lambda f, i: database.are_friends(f.user_id, f.friend_id)),
+    Case("can_see_detail_on_post", lambda f, i: database.can_see_detail_on_post(f.user_id, f.post.id)),
+    Case("is_group_admin", lambda f, i: database.is_group_admin(f.user_id, f.group_id)),
+    Case("search", lambda f, i: database.search(f.user_id, f.search_terms)),
+    Case("name_changes_since", lambda f, i: database.name_changes_since(0)),
+    Case("post_to_wall", lambda f, i: database.post_to_wall(f.user_id, f"Benchmark post {i}", database.get_wall(f.group_wall_id))),
+    Case("comment_on_post", lambda f, i: database.comment_on_post(f.user_id, f"Benchmark comment {i}", f.post.id)),
+    Case(f"post_to_wall (burst of {BURST_WRITERS})", post_burst, iterations = 10),
+    Case("friend_request", lambda f, i: database.friend_request(f.prepared[i], f.user_name), prepare = lambda f, n: f.strangers[-n:], iterations = 20),
+    Case("accept_friend_request", lambda f, i: database.accept_friend_request(f.user_id, f.prepared[i]), prepare = requests_to_user, iterations = 20),
+    Case("end_friendship", lambda f, i: database.end_friendship(f.user_id, f.prepared[i]), prepare = requests_to_user, iterations = 20),
+    Case("create_group", lambda f, i: database.create_group(f.user_id, f"Benchmark group {i}")),
+    Case("join_group", lambda f, i: database.join_group(f.prepared[i], f.group_id), prepare = lambda f, n: f.strangers[:n], iterations = 20),
+    Case("rename", lambda f, i: database.rename(f.teacher_id, f"Benchmark teacher rename {i}")),
+    Case("delete_comment", lambda f, i: database.delete_comment(f.prepared[i]), prepare = own_comments),
+    Case("delete_post", lambda f, i: database.delete_post(f.prepared[i]), prepare = own_posts),
+    Case("delete_group", lambda f, i: database.delete_group(f.prepared[i]), prepare = own_groups, iterations = 20),
+    Case("authenticate", lambda f, i: database.authenticate(f.user_name, datagen.PASSWORD), iterations = 5),
+    Case("rebuild_search_index", lambda f, i: database.rebuild_search_index(), iterations = 2),
+    Case("rebuild_timeline", lambda f, i: database.rebuild_timeline(), iterations = 2),
+]
+
+def percentile(samples: List[float], percent: float) -> float:
+    '''Nearest rank percentile of already sorted samples'''
+    return samples[max(0, math.ceil(percent / 100 * len(samples)) - 1)]
+
+class QueryCounter:
+    '''Counts the statements database.engine executes'''
+    def __init__(self):
+        self.count = 0
+        event.listen(database.engine, "before_cursor_execute", self.count_query)
+
+    def count_query(self, *args):
+        self.count += 1
+
+def measure(case: Case, fixture: Fixture, iterations: int, queries: QueryCounter) -> Dict[str, float]:
+    iterations = min(iterations, case.iterations or iterations)
+    # Iterations 0 to iterations - 1 are timed, the next WARMUP run first, and the one after that is traced
+    fixture.prepared = case.prepare(fixture, iterations + WARMUP + 1) if case.prepare else None
+
+    with redirect_stdout(io.StringIO()):
+        for i in range(WARMUP):
+            case.run(fixture, iterations + i)
+
+        samples = []
+        before = queries.count
+        for i in range(iterations):
+            start = time.perf_counter()
+            case.run(fixture, i)
+            samples.append((time.perf_counter() - start) * 1000)
+        query_count = queries.count - before
+
+        tracemalloc.start()
+        try:
+            case.run(fixture, iterations + WARMUP)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    samples.sort()
+    return {
+        "iterations": iterations,
+        "p50": percentile(samples, 50),
+        "p90": percentile(samples, 90),
+        "p99": percentile(samples, 99),
+        "max": samples[-1],
+        "queries": query_count / iterations,
+        "peak_kib": peak / 1024,
+    }
+
+def reset_caches():
+    '''Forgets everything cached from whichever database was in use before'''
+    for cache in (namecache.users, namecache.groups, namecache.identities, fragments.posts):
+        cache.clear()
+    namecache.forget_versions()
+    namecache.watermark = None
+
+def run(db_path: str, iterations: int = ITERATIONS, only: str | None = None, seed: int = 0) -> Dict[str, Dict[str, float]]:
+    '''Runs every case whose name contains only (or all of them) against a copy of the database at db_path'''
+    # Flask CLI commands run inside an app context, which every test client request would then share instead of
+    # pushing its own (and with it g, the logged in user and the unit of work). So run in a context of our own
+    return contextvars.Context().run(run_cases, db_path, iterations, only, seed)
+
+def run_cases(db_path: str, iterations: int, only: str | None, seed: int) -> Dict[str, Dict[str, float]]:
+    import app
+
+    with tempfile.TemporaryDirectory() as directory:
+        copy = os.path.join(directory, "bench.db")
+        shutil.copy(db_path, copy)
+        database.use_engine(f"sqlite:///{copy}")
+        reset_caches()
+        app.schema_checked = False
+        app.app.config["WTF_CSRF_ENABLED"] = False
+
+        queries = QueryCounter()
+        fixture = Fixture(app.app, seed)
+        results = {}
+        for case in ROUTE_CASES + DATABASE_CASES:
+            if only and only not in case.name:
+                continue
+            try:
+                results[case.name] = measure(case, fixture, iterations, queries)
+            except Exception as error:
+                log.error(f"{case.name} failed: {error!r}")
+                results[case.name] = {"error": repr(error)}
+
+        database.engine.dispose()
+
+    results["process"] = {"max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    return results
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    '''The names of the cases that regressed against baseline'''
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None or "p50" not in result or "p50" not in before:
+            continue
+        slower = result["p50"] - before["p50"]
+        if result["queries"] > before["queries"] + 0.01 or (slower > NOISE_FLOOR_MS and slower > before["p50"] * threshold):
+            regressions.append(name)
+    return regressions
+
+def report(results: dict, baseline: dict | None = None, regressions: List[str] = ()) -> str:
+    '''A table of the results, with changes against baseline if there is one'''
+    lines = [f"{'case':34} {'n':>4} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'queries':>8} {'peak KiB':>9}"
+             + (f" {'p50 vs baseline':>16} {'queries vs':>11}" if baseline else "")]
+    for name, result in results.items():
+        if name == "process":
+            continue
+        if "error" in result:
+            lines.append(f"{name:34} failed: {result['error']}")
+            continue
+
+        line = (f"{name:34} {result['iterations']:>4} {result['p50']:>8.2f} {result['p90']:>8.2f} {result['p99']:>8.2f} "
+                f"{result['max']:>8.2f} {result['queries']:>8.1f} {result['peak_kib']:>9.0f}")
+        before = (baseline or {}).get(name)
+        if before and "p50" in before:
+            change = (result["p50"] - before["p50"]) / before["p50"] * 100 if before["p50"] else 0.0
+            line += f" {change:>+15.0f}% {result['queries'] - before['queries']:>+11.1f}"
+            if name in regressions:
+                line += "  REGRESSION"
+        lines.append(line)
+
+    lines.append(f"Peak process memory: {results['process']['max_rss_kib'] / 1024:.0f} MiB")
+    return "\n".join(lines)
+
+def load_baseline(path: str) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+def save_baseline(results: dict, path: str):
+    with open(path, "w") as f:
+        json.dump(results, f, indent = 1)
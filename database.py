@@ -1,22 +1,216 @@
-from sqlalchemy import create_engine, select
+from sqlalchemy import create_engine, select, event, Engine
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, Session
-from sqlalchemy import UniqueConstraint, ForeignKey, or_, and_, case, union, text
+from sqlalchemy import UniqueConstraint, CheckConstraint, ForeignKey, Index, or_, and_, text, literal, literal_column, true
+from sqlalchemy import table, column, union_all
+from sqlalchemy import insert, delete, update, func
 from sqlalchemy.exc import DBAPIError as sql_error
-from typing import List, Tuple
+from typing import Callable, List, Tuple, Dict, Iterable
 import enum
 
+import os
+import re
+import threading
 import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar, Token
 
-from argon2 import PasswordHasher
-import argon2.exceptions as exceptions
+import events
+import metrics
+import passwords
+import writequeue
 
 import logging
 logging.basicConfig()
 log = logging.getLogger("database")
 
-ph = PasswordHasher()
+# Settings applied to every new connection, and pool options, for each deployment profile
+ENGINE_PROFILES = {
+    # Plain sqlite defaults, apart from waiting on a lock instead of failing straight away, and enforcing
+    # foreign keys, which deletes rely on to cascade
+    "development": {
+        "pragmas": {
+            "busy_timeout": 5000,
+            "foreign_keys": "ON",
+        },
+        "pool": {},
+    },
+    # Readers don't block the writer (or each other) under WAL, and synchronous=NORMAL only fsyncs at
+    # checkpoints, which is still durable against application crashes
+    "production": {
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": 5000,
+            "cache_size": -64000,
+            "mmap_size": 268435456,
+            "temp_store": "MEMORY",
+            "foreign_keys": "ON",
+        },
+        "pool": {
+            "poolclass": QueuePool,
+            "pool_size": 8,
+            "max_overflow": 8,
+            "pool_timeout": 10,
+        },
+    },
+}
+
+def profile_settings(profile: str) -> dict:
+    '''The ENGINE_PROFILES entry for profile'''
+    if profile not in ENGINE_PROFILES:
+        raise ValueError(f"Unknown database profile {profile!r}, expected one of {list(ENGINE_PROFILES)}")
+    return ENGINE_PROFILES[profile]
+
+def configure_connections(new_engine: Engine, settings: dict):
+    '''Applies a profile's pragmas to every new connection of an engine and takes over BEGIN from the driver'''
+    @event.listens_for(new_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        # Take transaction control away from pysqlite, which never BEGINs before a SELECT, so that reads
+        # inside a transaction share a snapshot. The begin listener below issues BEGIN itself
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma, value in settings["pragmas"].items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+        cursor.close()
+
+    @event.listens_for(new_engine, "begin")
+    def begin(connection):
+        connection.exec_driver_sql(connection.get_execution_options().get("sqlite_begin", "BEGIN"))
+
+def make_engine(url: str | None = None, profile: str | None = None) -> Engine:
+    '''
+    Creates the database engine. url and profile default to the SOCIALITE_DATABASE_URL and SOCIALITE_DB_PROFILE
+    environment variables, and failing that to main.db with the development profile
+    '''
+    url = url or os.environ.get("SOCIALITE_DATABASE_URL", "sqlite:///main.db")
+    profile = profile or os.environ.get("SOCIALITE_DB_PROFILE", "development")
+    settings = profile_settings(profile)
+    new_engine = create_engine(url, **settings["pool"])
+    configure_connections(new_engine, settings)
+
+    log.info(f"Using database {url} with the {profile} profile")
+    return new_engine
+
+def use_engine(url: str | None = None, profile: str | None = None) -> Engine:
+    '''Points every function in this module at a different database, e.g. a generated benchmark database'''
+    global engine
+    engine.dispose()
+    engine = make_engine(url, profile)
+    return engine
+
+engine = make_engine()
+
+# The session shared by every function in this module for the rest of the current request, if there is one
+unit_of_work: ContextVar[Session | None] = ContextVar("unit_of_work", default = None)
+
+def begin_unit_of_work(write: bool = False) -> Token:
+    '''
+    Starts a unit of work: until end_unit_of_work, every function in this module uses the same session and so
+    reads from one consistent snapshot. Writes are flushed, and only committed by commit_unit_of_work.
+    write takes the write lock up front, so a request that reads before writing can't fail to upgrade its
+    snapshot when another worker commits in between
+    '''
+    return unit_of_work.set(write_session() if write else Session(engine))
+
+def write_session() -> Session:
+    '''A new session that has already taken the write lock'''
+    session = Session(engine)
+    session.connection(execution_options = {"sqlite_begin": "BEGIN IMMEDIATE"})
+    return session
+
+def commit_unit_of_work():
+    '''Commits everything written during the current unit of work'''
+    session = unit_of_work.get()
+    if session is not None:
+        session.commit()
+
+def end_unit_of_work(token: Token):
+    '''Rolls back anything left uncommitted in the current unit of work and releases its connection'''
+    session = unit_of_work.get()
+    try:
+        if session is not None:
+            session.rollback()
+            session.close()
+    finally:
+        unit_of_work.reset(token)
+
+@contextmanager
+def session_scope():
+    '''The current unit of work's session, or a session of its own when called outside of one (e.g. from the CLI)'''
+    shared = unit_of_work.get()
+    if shared is not None:
+        yield shared
+        return
+
+    with Session(engine) as session:
+        yield session
+
+def commit(session: Session):
+    '''
+    Commits a session from session_scope. Inside a unit of work this only flushes, so constraint errors still
+    surface here, and the commit happens once when the request ends. A failed flush rolls the unit of work back
+    '''
+    if session is not unit_of_work.get():
+        session.commit()
+        return
 
-engine = create_engine("sqlite:///main.db")
+    try:
+        session.flush()
+    except Exception:
+        session.rollback()
+        raise
+
+# Inserts lots of people make at once go through one writer, which commits them in batches (see writequeue.py)
+write_queue = writequeue.WriteQueue(write_session) if writequeue.ENABLED else None
+
+def write(job: Callable[[Session], object]):
+    '''
+    Runs job(session) and commits it, returning what it returned. Goes through the write queue when it is on,
+    unless there is a unit of work, which may already hold the write lock the writer would need
+    '''
+    shared = unit_of_work.get()
+    if shared is None and write_queue is not None:
+        return write_queue.submit(job)
+
+    # On its own, take the write lock up front: a deferred BEGIN that reads first can't wait for a writer to
+    # finish, because its snapshot would be stale by then, so sqlite fails it with "database is locked" instead
+    with (nullcontext(shared) if shared is not None else write_session()) as session:
+        try:
+            result = job(session)
+            commit(session)
+        except Exception:
+            session.rollback()
+            raise
+        return result
+
+def publish_after_commit(session: Session, topic: str, kind: str, item):
+    '''Publishes an event (see events.py) once the session's current transaction commits, and never if it rolls back'''
+    session.info.setdefault("events", []).append((topic, kind, item))
+
+def call_after_commit(session: Session, callback: Callable[[], None]):
+    '''Calls callback once the session's current transaction commits, and never if it rolls back'''
+    callbacks = session.info.setdefault("after_commit", [])
+    if callback not in callbacks:
+        callbacks.append(callback)
+
+# Savepoints committing or rolling back fire these too, but leave it to their transaction whether anything happens
+
+@event.listens_for(Session, "after_commit")
+def publish_events(session: Session):
+    if session.in_nested_transaction():
+        return
+    for topic, kind, item in session.info.pop("events", ()):
+        events.publish(topic, kind, item)
+    for callback in session.info.pop("after_commit", ()):
+        callback()
+
+@event.listens_for(Session, "after_rollback")
+def discard_events(session: Session):
+    if session.in_nested_transaction():
+        return
+    session.info.pop("events", None)
+    session.info.pop("after_commit", None)
 
 class Base(DeclarativeBase):
     pass
@@ -34,268 +228,486 @@ class User(Base):
     # In future I will likely use this
     # email: Mapped[str]
 
-    wall_posts: Mapped[List["WallPost"]] = relationship(foreign_keys = "WallPost.author_id", cascade = "all, delete-orphan")
-    wall_comments: Mapped[List["WallPostComment"]] = relationship(cascade = "all, delete-orphan")
+    # Every foreign key to a user is ON DELETE CASCADE, so deleting one leaves the rest to the database
+    wall: Mapped["Wall"] = relationship(cascade = "all, delete-orphan", passive_deletes = True, back_populates = "user")
+    posts: Mapped[List["Post"]] = relationship(cascade = "all, delete-orphan", passive_deletes = True, back_populates = "author")
+    comments: Mapped[List["Comment"]] = relationship(cascade = "all, delete-orphan", passive_deletes = True, back_populates = "author")
 
-    groups: Mapped[List["GroupMembership"]] = relationship(cascade="all, delete-orphan")
-    group_posts: Mapped[List["GroupPost"]] = relationship(cascade = "all, delete-orphan")
-    group_comments: Mapped[List["GroupPostComment"]] = relationship(cascade = "all, delete-orphan")
+    groups: Mapped[List["GroupMembership"]] = relationship(cascade="all, delete-orphan", passive_deletes = True)
 
     __table_args__ = (UniqueConstraint("name"),)
 
-class WallPost(Base):
-    '''ORM mapping of the WallPost table'''
-    __tablename__ = "wall_posts"
+class Wall(Base):
+    '''
+    ORM mapping of the walls table. Every user and every group has exactly one wall, which is where posts
+    to them go. type is "user" or "group", and says which of user_id and group_id is set. A wall too big to
+    delete in one go is DELETED_WALL, with neither set, until reclaim_wall has deleted its posts
+    '''
+    __tablename__ = "walls"
+    id: Mapped[int] = mapped_column(primary_key = True)
+    type: Mapped[str]
+    user_id: Mapped[int | None] = mapped_column(ForeignKey("users.id", ondelete = "CASCADE"), unique = True)
+    group_id: Mapped[int | None] = mapped_column(ForeignKey("groups.id", ondelete = "CASCADE"), unique = True)
+
+    user: Mapped["User"] = relationship(back_populates = "wall")
+    group: Mapped["Group"] = relationship(back_populates = "wall")
+
+    posts: Mapped[List["Post"]] = relationship(cascade = "all, delete-orphan", passive_deletes = True, back_populates = "wall")
+
+    __table_args__ = (CheckConstraint(
+        "(type = 'user' AND user_id IS NOT NULL AND group_id IS NULL) OR "
+        "(type = 'group' AND group_id IS NOT NULL AND user_id IS NULL) OR "
+        "(type = 'deleted' AND user_id IS NULL AND group_id IS NULL)",
+        name = "ck_walls_owner"
+    ),)
+
+class Post(Base):
+    '''ORM mapping of the posts table. Posts to users' walls and to groups are the same, apart from their wall'''
+    __tablename__ = "posts"
     id: Mapped[int] = mapped_column(primary_key = True)
     content: Mapped[str]
-    author_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    wall_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    author_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete = "CASCADE"))
+    wall_id: Mapped[int] = mapped_column(ForeignKey("walls.id", ondelete = "CASCADE"))
     publish_datetime: Mapped[int]
-    
-    author: Mapped["User"] = relationship(foreign_keys = [author_id], back_populates = "wall_posts")
-    wall_owner: Mapped["User"] = relationship(foreign_keys = [wall_id])
+    # Kept up to date by comment_on_post / delete_comment so listings never have to count
+    comment_count: Mapped[int] = mapped_column(default = 0, server_default = "0")
 
-    comments: Mapped[List["WallPostComment"]] = relationship(cascade = "all, delete-orphan")
+    author: Mapped["User"] = relationship(back_populates = "posts")
+    wall: Mapped["Wall"] = relationship(back_populates = "posts")
 
-class WallPostComment(Base):
-    '''ORM mapping of the WallPostComment table'''
-    __tablename__ = "wall_post_comments"
+    comments: Mapped[List["Comment"]] = relationship(cascade = "all, delete-orphan", passive_deletes = True, back_populates = "post")
+
+    __table_args__ = (Index("ix_posts_wall", "wall_id", "publish_datetime"), Index("ix_posts_author", "author_id"))
+
+class Comment(Base):
+    '''ORM mapping of the comments table'''
+    __tablename__ = "comments"
     id: Mapped[int] = mapped_column(primary_key = True)
     content: Mapped[str]
-    author_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    post_id: Mapped[int] = mapped_column(ForeignKey("wall_posts.id"))
+    author_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete = "CASCADE"))
+    post_id: Mapped[int] = mapped_column(ForeignKey("posts.id", ondelete = "CASCADE"))
     publish_datetime: Mapped[int]
 
-    author: Mapped["User"] = relationship(back_populates = "wall_comments")
-    post: Mapped["WallPost"] = relationship(back_populates = "comments")
+    author: Mapped["User"] = relationship(back_populates = "comments")
+    post: Mapped["Post"] = relationship(back_populates = "comments")
+
+    __table_args__ = (Index("ix_comments_post", "post_id", "publish_datetime"), Index("ix_comments_author", "author_id"))
 
 class Friendship(Base):
-    '''ORM mapping of the Friendship table'''
+    '''
+    ORM mapping of the Friendship table. Each pair of users is stored once in canonical order (first < second,
+    see friendship_key) so any lookup of a pair is a single primary key probe
+    '''
     __tablename__ = "friendships"
-    first: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key = True)
-    second: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key = True)
+    first: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete = "CASCADE"), primary_key = True)
+    second: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete = "CASCADE"), primary_key = True)
+    requester_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete = "CASCADE"))
     is_request: Mapped[bool]
 
+    __table_args__ = (
+        CheckConstraint("first < second"),
+        Index("ix_friendships_second", "second", "first"),
+        Index("ix_friendships_requester", "requester_id")
+    )
+
 class PrivateMessage(Base):
     '''ORM mapping of the PrivateMessage table'''
     __tablename__ = "private_messages"
     id: Mapped[int] = mapped_column(primary_key = True)
-    author_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    recipient_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    author_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete = "CASCADE"))
+    recipient_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete = "CASCADE"))
     content: Mapped[str]
 
     author: Mapped["User"] = relationship(foreign_keys = [author_id])
     recipient: Mapped["User"] = relationship(foreign_keys = [recipient_id])
 
+    __table_args__ = (
+        Index("ix_private_messages_author", "author_id"),
+        Index("ix_private_messages_recipient", "recipient_id")
+    )
+
 class Group(Base):
     '''ORM mapping of the Group table'''
     __tablename__ = "groups"
     id: Mapped[int] = mapped_column(primary_key = True)
     name: Mapped[str]
 
-    members: Mapped[List["GroupMembership"]] = relationship(cascade = "all, delete-orphan")
-    posts: Mapped[List["GroupPost"]] = relationship(cascade = "all, delete-orphan")
+    members: Mapped[List["GroupMembership"]] = relationship(cascade = "all, delete-orphan", passive_deletes = True)
+    wall: Mapped["Wall"] = relationship(cascade = "all, delete-orphan", passive_deletes = True, back_populates = "group")
 
 class GroupMembership(Base):
     '''ORM mapping of the GroupMembership table'''
     __tablename__ = "group_memberships"
-    member_id: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key = True)
-    group_id: Mapped[int] = mapped_column(ForeignKey("groups.id"), primary_key = True)
+    member_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete = "CASCADE"), primary_key = True)
+    group_id: Mapped[int] = mapped_column(ForeignKey("groups.id", ondelete = "CASCADE"), primary_key = True)
     is_admin: Mapped[bool]
 
     group: Mapped["Group"] = relationship(back_populates="members")
     member: Mapped["User"] = relationship(back_populates="groups")
 
-class GroupPost(Base):
-    '''ORM mapping of the GroupPost table'''
-    __tablename__ = "group_posts"
-    id: Mapped[int] = mapped_column(primary_key = True) 
-    author_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    group_id: Mapped[int] = mapped_column(ForeignKey("groups.id"))
-    content: Mapped[str]
-    publish_datetime: Mapped[int]
+    __table_args__ = (Index("ix_group_memberships_group", "group_id", "member_id"),)
+
+class TimelineEntry(Base):
+    '''ORM mapping of the materialized home feed. One row per (reader, post) the reader can see'''
+    __tablename__ = "timeline_entries"
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete = "CASCADE"), primary_key = True)
+    publish_datetime: Mapped[int] = mapped_column(primary_key = True)
+    post_id: Mapped[int] = mapped_column(ForeignKey("posts.id", ondelete = "CASCADE"), primary_key = True)
+
+    __table_args__ = (Index("ix_timeline_entries_post", "post_id"),)
+
+class NameChange(Base):
+    '''ORM mapping of the name_changes log, which keeps every worker's name cache coherent (see namecache.py)'''
+    __tablename__ = "name_changes"
+    __table_args__ = {"sqlite_autoincrement": True}
+    seq: Mapped[int] = mapped_column(primary_key = True)
+    kind: Mapped[str]
+    entity_id: Mapped[int]
+
+# How many name changes are kept for workers to catch up on. Workers that fall further behind clear their cache
+NAME_CHANGE_HISTORY = 10000
+
+# The timeline is only read and maintained when enabled. Run `flask rebuild-timeline` before turning it on
+# so it catches up with posts written while it was off
+TIMELINE_ENABLED = os.environ.get("SOCIALITE_TIMELINE", "0") == "1"
+# How many readers' timelines rebuild_timeline regenerates per transaction
+TIMELINE_REBUILD_CHUNK = int(os.environ.get("SOCIALITE_TIMELINE_REBUILD_CHUNK", 50))
+
+# The type of a wall whose user or group has been deleted, but which had too many posts to delete along with
+# them. Nobody can see it, and reclaim_wall deletes its posts a chunk of RECLAIM_CHUNK at a time, then the wall
+DELETED_WALL = "deleted"
+RECLAIM_CHUNK = int(os.environ.get("SOCIALITE_RECLAIM_CHUNK", 200))
+
+# How long jobs that write in many short transactions (rebuild_timeline, reclaim_wall) wait between them,
+# so writers queued on the lock get it before the next transaction does. A waiting connection's busy handler
+# only retries every 100 ms once it has waited a while, and would miss a shorter gap
+CHUNK_PAUSE = 0.1
+
+FEED_PAGE_SIZE = 20
+
+class Page:
+    '''A single page of a keyset paginated listing. cursor is None when there is nothing older'''
+    def __init__(self, items: list, cursor: str | None):
+        self.items = items
+        self.cursor = cursor
+
+class WallView:
+    '''Read model of a wall, built straight from a column select'''
+    __slots__ = ("id", "type", "user_id", "group_id")
+
+    def __init__(self, id: int, type: str, user_id: int | None, group_id: int | None):
+        self.id = id
+        self.type = type
+        self.user_id = user_id
+        self.group_id = group_id
 
-    author: Mapped["User"] = relationship(back_populates = "group_posts")
-    group: Mapped["Group"] = relationship(back_populates = "posts")
+    def owner(self) -> Tuple[str, int | None, int | None]:
+        '''The (type, user id, group id) of whoever the wall belongs to'''
+        return self.type, self.user_id, self.group_id
 
-    comments: Mapped[List["GroupPostComment"]] = relationship(cascade = "all, delete-orphan")
+class PostView:
+    '''
+    Read model of a post as every listing shows it, built straight from a post_columns select (in that order)
+    rather than hydrating ORM entities that are only ever rendered once
+    '''
+    __slots__ = ("id", "content", "author_id", "wall_id", "wall_owner_id", "group_id", "publish_datetime", "comment_count", "type")
+
+    def __init__(self, id: int, content: str, author_id: int, wall_id: int, wall_owner_id: int | None,
+                 group_id: int | None, publish_datetime: int, comment_count: int, type: str):
+        self.id = id
+        self.content = content
+        self.author_id = author_id
+        self.wall_id = wall_id
+        self.wall_owner_id = wall_owner_id
+        self.group_id = group_id
+        self.publish_datetime = publish_datetime
+        self.comment_count = comment_count
+        self.type = type
+
+    def owner(self) -> Tuple[str, int | None, int | None]:
+        '''The (type, user id, group id) of whoever the post's wall belongs to'''
+        return self.type, self.wall_owner_id, self.group_id
+
+class CommentView:
+    '''Read model of a comment, built straight from a comment_columns select (in that order)'''
+    __slots__ = ("id", "post_id", "content", "author_id", "publish_datetime")
+
+    def __init__(self, id: int, post_id: int, content: str, author_id: int, publish_datetime: int):
+        self.id = id
+        self.post_id = post_id
+        self.content = content
+        self.author_id = author_id
+        self.publish_datetime = publish_datetime
+
+def encode_cursor(publish_datetime: int, id: int) -> str:
+    '''Turns the (publish_datetime, id) position of the last row on a page into an opaque cursor'''
+    return f"{publish_datetime}-{id}"
+
+def decode_cursor(cursor: str | None) -> Tuple[int, int] | None:
+    '''Inverse of encode_cursor. Returns None for a missing or malformed cursor (i.e. start from the newest row)'''
+    if not cursor:
+        return None
+    try:
+        publish_datetime, id = cursor.split("-", 1)
+        return int(publish_datetime), int(id)
+    except ValueError:
+        return None
+
+def older_than(publish_datetime_column, id_column, cursor: Tuple[int, int] | None):
+    '''Keyset condition selecting rows strictly after cursor in (publish_datetime DESC, id DESC) order'''
+    if cursor is None:
+        return true()
+    return or_(
+        publish_datetime_column < cursor[0],
+        and_(publish_datetime_column == cursor[0], id_column < cursor[1])
+    )
 
-class GroupPostComment(Base):
-    '''ORM mapping of the GroupPostComment table'''
-    __tablename__ = "group_post_comments"
-    id: Mapped[int] = mapped_column(primary_key = True)
-    content: Mapped[str]
-    author_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    post_id: Mapped[int] = mapped_column(ForeignKey("group_posts.id"))
-    publish_datetime: Mapped[int]
+def make_page(rows: list, limit: int, convert = lambda row: row) -> Page:
+    '''Builds a Page from rows fetched with limit + 1, using the extra row only to detect a next page'''
+    items = [convert(row) for row in rows[:limit]]
+    if len(rows) <= limit:
+        return Page(items, None)
 
-    author: Mapped["User"] = relationship(back_populates = "group_comments")
-    post: Mapped["GroupPost"] = relationship(back_populates = "comments")
+    last = rows[limit - 1]
+    return Page(items, encode_cursor(last.publish_datetime, last.id))
 
-def generate_feed(user_id: int) -> List[dict]:
-    '''Returns a list of posts that populate a user's main feed on the home page'''
-    group_post_query = select(GroupPost, 2).where(GroupPost.group_id.in_(
-        select(GroupMembership.group_id).where(GroupMembership.member_id == user_id))
+def post_columns():
+    '''
+    The columns every post listing returns: the post, plus who its wall belongs to. wall_owner_id is the user
+    for posts to a user's wall and group_id the group for posts to a group, as given by type
+    '''
+    return (
+        Post.id,
+        Post.content,
+        Post.author_id,
+        Post.wall_id,
+        Wall.user_id.label("wall_owner_id"),
+        Wall.group_id,
+        Post.publish_datetime,
+        Post.comment_count,
+        Wall.type
     )
 
-    wall_post_query = select(WallPost, 1).where(or_(
-        WallPost.wall_id == user_id,
-        WallPost.wall_id.in_(
-            select(case(
-                (Friendship.first == user_id, Friendship.second),
-                else_ = Friendship.first
-            ).label("friend_id")).where(
-                and_(or_(
-                    Friendship.first == user_id,
-                    Friendship.second == user_id
-                ), Friendship.is_request != True))
-        )
+def comment_columns():
+    '''The columns CommentView is built from'''
+    return (Comment.id, Comment.post_id, Comment.content, Comment.author_id, Comment.publish_datetime)
+
+def wall_columns():
+    '''The columns WallView is built from'''
+    return (Wall.id, Wall.type, Wall.user_id, Wall.group_id)
+
+def visible_walls(user_id: int):
+    '''Subquery selecting the ids of every wall a user's feed shows: their own, their friends' walls and their groups'''
+    return select(Wall.id).where(or_(
+        Wall.user_id == user_id,
+        Wall.user_id.in_(friend_ids(user_id)),
+        Wall.group_id.in_(select(GroupMembership.group_id).where(GroupMembership.member_id == user_id))
     ))
 
-    # TODO: Come up with a better solution.
-    # This is really sketchy and only works because of the precise layout of my testing database
-    def conv(post):
-        if post[-1]==1:
-            ret = dict(zip(("id", "content", "author_id", "wall_id", "publish_datetime"),post))
-            ret["type"] = "wall"
-            return ret
-        else:
-            ret = dict(zip(("id", "author_id", "group_id", "content", "publish_datetime"),post))
-            ret["type"] = "group"
-            return ret
-        
-    joined_query = union(group_post_query, wall_post_query).order_by(text('publish_datetime DESC'))
+def feed_query(user_id: int, position: Tuple[int, int] | None, limit: int):
+    '''The statement behind generate_feed. Fetches limit + 1 rows for make_page'''
+    if TIMELINE_ENABLED:
+        return timeline_query(user_id, position, limit)
 
-    with Session(engine) as session:
-        return [conv(post) for post in session.execute(joined_query)]
+    return select(*post_columns()).join(Wall, Wall.id == Post.wall_id).where(and_(
+        Post.wall_id.in_(visible_walls(user_id)),
+        older_than(Post.publish_datetime, Post.id, position)
+    )).order_by(Post.publish_datetime.desc(), Post.id.desc()).limit(limit + 1)
+
+def post_page(rows: list, limit: int) -> Page:
+    return make_page(rows, limit, lambda row: PostView(*row))
+
+def generate_feed(user_id: int, cursor: str | None = None, limit: int = FEED_PAGE_SIZE) -> Page:
+    '''
+    Returns a page of the posts that populate a user's main feed on the home page, newest first.
+    cursor is the cursor of the previous page, or None for the first page
+    '''
+    with session_scope() as session:
+        return post_page(session.execute(feed_query(user_id, decode_cursor(cursor), limit)).all(), limit)
+
+def friendship_key(a_id: int, b_id: int) -> Tuple[int, int]:
+    '''The (first, second) primary key a friendship between two users is stored under'''
+    return (a_id, b_id) if a_id < b_id else (b_id, a_id)
+
+def friend_ids(user_id: int):
+    '''Subquery selecting the ids of a user's (accepted) friends. One index range scan per side of the pair'''
+    return select(Friendship.second.label("friend_id")).where(
+        and_(Friendship.first == user_id, Friendship.is_request != True)
+    ).union_all(select(Friendship.first).where(
+        and_(Friendship.second == user_id, Friendship.is_request != True)
+    ))
+
+def timeline_query(user_id: int, position: Tuple[int, int] | None, limit: int):
+    '''feed_query backed by the materialized timeline: a single range scan of the reader's entries'''
+    return select(*post_columns()) \
+    .select_from(TimelineEntry) \
+    .join(Post, Post.id == TimelineEntry.post_id) \
+    .join(Wall, Wall.id == Post.wall_id) \
+    .where(and_(
+        TimelineEntry.user_id == user_id,
+        Wall.type != DELETED_WALL,
+        older_than(TimelineEntry.publish_datetime, TimelineEntry.post_id, position)
+    )).order_by(TimelineEntry.publish_datetime.desc(), TimelineEntry.post_id.desc()).limit(limit + 1)
+
+def user_wall(user_id: int):
+    '''Scalar subquery of the id of a user's wall'''
+    return select(Wall.id).where(Wall.user_id == user_id).scalar_subquery()
+
+def group_wall(group_id: int):
+    '''Scalar subquery of the id of a group's wall'''
+    return select(Wall.id).where(Wall.group_id == group_id).scalar_subquery()
+
+def wall_readers(wall: WallView):
+    '''Subquery selecting everyone whose feed shows posts to a wall: its owner and their friends, or the group's members'''
+    if wall.type == "group":
+        return select(GroupMembership.member_id.label("user_id")).where(GroupMembership.group_id == wall.group_id)
+    return select(User.id.label("user_id")).where(or_(User.id == wall.user_id, User.id.in_(friend_ids(wall.user_id))))
+
+def fan_out_post(session: Session, post: Post, wall: WallView):
+    '''Adds a freshly flushed post to the timeline of everyone who can see it'''
+    readers = wall_readers(wall).subquery()
+    session.execute(insert(TimelineEntry).from_select(
+        ["user_id", "publish_datetime", "post_id"],
+        select(readers.c.user_id, literal(post.publish_datetime), literal(post.id))
+    ))
 
-def post_to_wall(author_id: int, content: str, wall_id: int) -> bool:
+def backfill_wall(session: Session, user_id: int, wall_id):
+    '''
+    Copies every post on a wall (an id or a user_wall / group_wall subquery) into a user's timeline,
+    e.g. when they become friends with its owner or join its group
     '''
-    Publish a post to a wall. Assumes the person creating the post is authorised to post on behalf
-    of the account referenced by author_id, and that account can post to the wall referenced by wall_id
-    Returns true if the post was successfully made
+    session.execute(insert(TimelineEntry).from_select(
+        ["user_id", "publish_datetime", "post_id"],
+        select(literal(user_id), Post.publish_datetime, Post.id).where(Post.wall_id == wall_id)
+    ).prefix_with("OR IGNORE"))
+
+def prune_wall(session: Session, user_id: int, wall_id):
+    '''Removes every post on a wall from a user's timeline, e.g. when they stop being friends with its owner'''
+    session.execute(delete(TimelineEntry).where(and_(
+        TimelineEntry.user_id == user_id,
+        TimelineEntry.post_id.in_(select(Post.id).where(Post.wall_id == wall_id))
+    )))
+
+def rebuild_timeline_of(session: Session, user_ids: List[int]) -> int:
+    '''Regenerates the timelines of some readers from the base tables. Returns how many entries they now have'''
+    friend_pairs = select(Friendship.first.label("user_id"), Friendship.second.label("friend_id")) \
+        .where(and_(Friendship.first.in_(user_ids), Friendship.is_request != True)) \
+        .union_all(
+            select(Friendship.second, Friendship.first).where(and_(Friendship.second.in_(user_ids), Friendship.is_request != True)),
+            select(User.id, User.id).where(User.id.in_(user_ids))
+        ).subquery()
+
+    session.execute(delete(TimelineEntry).where(TimelineEntry.user_id.in_(user_ids)))
+    written = session.execute(insert(TimelineEntry).from_select(
+        ["user_id", "publish_datetime", "post_id"],
+        select(friend_pairs.c.user_id, Post.publish_datetime, Post.id)
+            .join(Wall, Wall.user_id == friend_pairs.c.friend_id)
+            .join(Post, Post.wall_id == Wall.id)
+    )).rowcount
+    written += session.execute(insert(TimelineEntry).from_select(
+        ["user_id", "publish_datetime", "post_id"],
+        select(GroupMembership.member_id, Post.publish_datetime, Post.id)
+            .join(Wall, Wall.group_id == GroupMembership.group_id)
+            .join(Post, Post.wall_id == Wall.id)
+            .where(GroupMembership.member_id.in_(user_ids))
+    )).rowcount
+    return written
+
+def rebuild_timeline() -> int:
     '''
-    post = WallPost(
+    Regenerates the whole materialized timeline from the base tables, TIMELINE_REBUILD_CHUNK readers per
+    transaction, so writers only ever wait for one chunk rather than the whole rebuild.
+    Returns how many entries it wrote
+    '''
+    written = 0
+    last_id = 0
+    while True:
+        with write_session() as session:
+            user_ids = list(session.scalars(
+                select(User.id).where(User.id > last_id).order_by(User.id).limit(TIMELINE_REBUILD_CHUNK)
+            ))
+            if not user_ids:
+                return written
+            written += rebuild_timeline_of(session, user_ids)
+            session.commit()
+
+        if len(user_ids) < TIMELINE_REBUILD_CHUNK:
+            return written
+        last_id = user_ids[-1]
+        time.sleep(CHUNK_PAUSE)
+
+def insert_post(session: Session, author_id: int, content: str, wall: WallView) -> PostView:
+    '''Adds a post to session, returning it with its new id (see post_to_wall)'''
+    content = storable_content(content)
+    post = Post(
         content = content,
         author_id = author_id,
-        wall_id = wall_id,
+        wall_id = wall.id,
         publish_datetime = time.time_ns()
     )
-    with Session(engine) as session:
-        try:
-            session.add(post)
-            session.commit()
-        except sql_error:
-            log.error("Failed to add post to wall")
-            log.debug("Post with {author_id=} {wall_id=} {len(content)=} failed to be added to {wall_id}")
-            return None 
-        
-        log.info(f"User with id {author_id} added a post with content length {len(content)} to the wall with id {wall_id}")
-        return {
-            "content": content,
-            "author_id": author_id,
-            "wall_id": wall_id,
-            "publish_datetime": post.publish_datetime,
-            "type": "wall"
-        }
-
-def post_to_group(author_id: int, content: str, group_id: int) -> bool:
-    '''
-    Publish a post to a group. Assumes the person creating the post is authorised to post on behalf
-    of the account referenced by author_id, and that account can post to the group referenced by group_id
-    Returns true if the post was successfully made
-    '''
-    post = GroupPost(
-            content = content,
-            author_id = author_id,
-            group_id = group_id,
-            publish_datetime = time.time_ns()
-    )
-    
-    with Session(engine) as session:
-        try:
-            session.add(post)
-            session.commit()
-        except sql_error:
-            log.error("Failed to add post to group")
-            log.debug("Post with {author_id=} {wall_id=} {len(content)=} failed to be added to group {group_id}")
-            return None 
-        
-        log.info(f"User with id {author_id} added a post with content length {len(content)} to the group with id {group_id}")
-        return {
-            "content": content,
-            "author_id": author_id,
-            "group_id": group_id,
-            "publish_datetime": post.publish_datetime,
-            "type": "group"
-        }
-
-def comment_to_group(author_id: int, content: str, parent_id: int) -> bool:
-    '''
-    Publish a post to a group. Assumes the person creating the post is authorised to post on behalf
-    of the account referenced by author_id, and that account can post to the group referenced by group_id
-    Returns true if the post was successfully made
-    '''
-    post = GroupPostComment(
-            content = content,
-            author_id = author_id,
-            post_id = parent_id,
-            publish_datetime = time.time_ns()
-    )
-    
-    with Session(engine) as session:
-        try:
-            session.add(post)
-            session.commit()
-        except sql_error:
-            log.error("Failed to add comment to group")
-            log.debug("Comment with {author_id=} {wall_id=} {len(content)=} failed to be added to group post {parent_id}")
-            return None
-        
-        return {
-            "content": content,
-            "author_id": author_id,
-            "publish_datetime": post.publish_datetime,
-        }
-
-def comment_to_wall(author_id: int, content: str, parent_id: int) -> bool:
+    session.add(post)
+    session.flush()
+    if TIMELINE_ENABLED:
+        fan_out_post(session, post, wall)
+    view = PostView(post.id, content, author_id, wall.id, wall.user_id, wall.group_id, post.publish_datetime, 0, wall.type)
+    publish_after_commit(session, events.wall_topic(wall.id), "post", view)
+    return view
+
+def post_to_wall(author_id: int, content: str, wall: WallView) -> PostView | None:
     '''
-    Publish a post to a group. Assumes the person creating the post is authorised to post on behalf
-    of the account referenced by author_id, and that account can post to the group referenced by group_id
-    Returns true if the post was successfully made
+    Publish a post to a wall (see get_wall). Assumes the person creating the post is authorised to post on behalf
+    of the account referenced by author_id, and that account can post to the wall
+    Returns the new post, or None if it couldn't be made
     '''
-    post = WallPostComment(
+    try:
+        view = write(lambda session: insert_post(session, author_id, content, wall))
+    except sql_error:
+        log.error("Failed to add post to wall")
+        log.debug(f"Post with {author_id=} {len(content)=} failed to be added to wall {wall.id}")
+        return None
+
+    log.info(f"User with id {author_id} added a post with content length {len(content)} to the wall with id {wall.id}")
+    return view
+
+def insert_comment(session: Session, author_id: int, content: str, post_id: int) -> CommentView:
+    '''Adds a comment to session, returning it with its new id (see comment_on_post)'''
+    content = storable_content(content)
+    comment = Comment(
             content = content,
             author_id = author_id,
-            post_id = parent_id,
+            post_id = post_id,
             publish_datetime = time.time_ns()
     )
-    
-    with Session(engine) as session:
-        try:
-            session.add(post)
-            session.commit()
-        except sql_error:
-            log.error("Failed to add comment to wall")
-            log.debug("Comment with {author_id=} {wall_id=} {len(content)=} failed to be added to wall post {parent_id}")
-            return None
-        
-        return {
-            "content": content,
-            "author_id": author_id,
-            "publish_datetime": post.publish_datetime,
-        }
+    session.add(comment)
+    session.execute(update(Post).where(Post.id == post_id).values(comment_count = Post.comment_count + 1))
+    session.flush()
+    view = CommentView(comment.id, post_id, content, author_id, comment.publish_datetime)
+    publish_after_commit(session, events.post_topic(post_id), "comment", view)
+    return view
+
+def comment_on_post(author_id: int, content: str, post_id: int) -> CommentView | None:
+    '''
+    Publish a comment on a post. Assumes the person creating the comment is authorised to post on behalf
+    of the account referenced by author_id, and that account can see the post
+    Returns the new comment, or None if it couldn't be made
+    '''
+    try:
+        return write(lambda session: insert_comment(session, author_id, content, post_id))
+    except sql_error:
+        log.error("Failed to add comment to post")
+        log.debug(f"Comment with {author_id=} {len(content)=} failed to be added to post {post_id}")
+        return None
 
 def user_exists(id: int) -> bool:
     '''Checks if a user exists'''
-    with Session(engine) as session:
+    with session_scope() as session:
         stmt = select(text("null")).where(User.id == id)
         return session.execute(stmt).one_or_none() is not None
 
 def grab_info_for(id: int) -> Tuple[str, bool] | None:
     '''Kind of stupid name. Grabs the name and whether the user is a teacher'''
     stmt = select(User.name, User.is_teacher).where(User.id == id)
-    with Session(engine) as session:
+    with session_scope() as session:
         result = session.execute(stmt).one_or_none()
         if result is None:
             return None
@@ -322,100 +734,170 @@ class AuthenticationError(enum.Enum):
                 return "Unexpected"
 
 def authenticate(username: str, password: str) -> int | AuthenticationError :
-    '''Given a username and password, returns the user's id if the password is correct, else an error pinpointing the mistake'''
-    with Session(engine) as session:
+    '''
+    Given a username and password, returns the user's id if the password is correct, else an error pinpointing the mistake.
+    Hashes made with outdated parameters are replaced on a successful login.
+    Raises passwords.HashingOverloaded if the hashing pool is saturated
+    '''
+    with session_scope() as session:
         stmt = select(User.password, User.id).where(User.name == username).limit(1)
         user = session.execute(stmt).one_or_none()
-        if user.password is None:
-            return AuthenticationError.UserDoesNotExist
-        try:
-            ph.verify(user.password, password)
-        except exceptions.VerifyMismatchError:
-            return AuthenticationError.IncorrectPassword
 
-        return user.id
+    if user is None:
+        return AuthenticationError.UserDoesNotExist
+
+    if not passwords.verify(user.password, password):
+        return AuthenticationError.IncorrectPassword
+
+    if passwords.needs_rehash(user.password):
+        new_hash = passwords.hash(password)
+        with session_scope() as session:
+            # Only replace the hash we verified against, in case the password changed in the meantime
+            session.execute(update(User).where(and_(User.id == user.id, User.password == user.password)).values(password = new_hash))
+            try:
+                commit(session)
+                log.info(f"Rehashed the password of user {user.id} with the current argon2 parameters")
+            except sql_error:
+                log.error(f"Failed to store the rehashed password of user {user.id}")
+
+    return user.id
 
 def register(name: str, password: str):
-    '''Attempts to register a user. Returns a bool representing success'''
-    if user_exists(name):
-        return False
-    with Session(engine) as session:
+    '''
+    Attempts to register a user. Returns a bool representing success.
+    Raises passwords.HashingOverloaded if the hashing pool is saturated
+    '''
+    password_hash = passwords.hash(password)
+    with session_scope() as session:
         user = User(
             name = name,
-            password = ph.hash(password),
+            password = password_hash,
             password_reset_on_next_login = False,
             student_requests_password_change = False,
-            is_teacher = False
+            is_teacher = False,
+            wall = Wall(type = "user")
         )
 
         try:
             session.add(user)
-            session.commit()
+            commit(session)
         except Exception as e:
             log.debug(e)
             return False
 
     return True
 
+def existing_user_names(names: Iterable[str]) -> set:
+    '''Returns which of names are already taken'''
+    names = set(names)
+    if not names:
+        return set()
+
+    with session_scope() as session:
+        return set(session.scalars(select(User.name).where(User.name.in_(names))))
+
+def insert_users(users: List[dict]) -> bool:
+    '''
+    Inserts many users (dicts of User columns, password already hashed) and their walls in one transaction.
+    Returns whether it succeeded; on failure none of them are inserted
+    '''
+    with session_scope() as session:
+        try:
+            session.execute(insert(User), users)
+            session.execute(insert(Wall).from_select(
+                ["type", "user_id"],
+                select(literal("user"), User.id).where(User.name.in_([user["name"] for user in users]))
+            ))
+            commit(session)
+        except sql_error as e:
+            log.debug(e)
+            session.rollback()
+            return False
+
+        return True
+
 def are_friends(a_id: int, b_id: int) -> bool:
     '''Checks if two users are friends'''
-    stmt = select(Friendship.is_request).where(
-        or_(
-            and_(
-                Friendship.first == a_id, Friendship.second == b_id
-            ),
-            and_(
-                Friendship.first == b_id, Friendship.second == a_id
-            )
-        )
-    )
+    first, second = friendship_key(a_id, b_id)
+    stmt = select(Friendship.is_request).where(and_(Friendship.first == first, Friendship.second == second))
 
-    with Session(engine) as session:
+    with session_scope() as session:
         res = session.execute(stmt).one_or_none()
         if res is None:
             return False
         else:
             return not res[0]
 
-def posts_to_wall(wall_id: int):
-    '''Returns a list of all posts to a walll'''
-    stmt = select(WallPost).where(WallPost.wall_id == wall_id).order_by(text('publish_datetime DESC'))
-    with Session(engine) as session:
-        return list(tag(obj, {"type": "wall"}) for obj in session.scalars(stmt))
+def visible_wall_ids(user_id: int) -> List[int]:
+    '''The ids of every wall a user's feed shows (see visible_walls)'''
+    with session_scope() as session:
+        return list(session.scalars(visible_walls(user_id)))
 
-def posts_to_group(group_id: int):
-    '''Returns a list of all posts to a group'''
-    stmt = select(GroupPost).where(GroupPost.group_id == group_id).order_by(text('publish_datetime DESC'))
-    with Session(engine) as session:
-        return list(tag(post, {"type": "group"}) for post in session.scalars(stmt))
+def wall_query(wall_id: int, position: Tuple[int, int] | None, limit: int):
+    '''The statement behind posts_to_wall. Fetches limit + 1 rows for make_page'''
+    return select(*post_columns()).join(Wall, Wall.id == Post.wall_id).where(and_(
+        Post.wall_id == wall_id,
+        older_than(Post.publish_datetime, Post.id, position)
+    )).order_by(Post.publish_datetime.desc(), Post.id.desc()).limit(limit + 1)
+
+def posts_to_wall(wall_id: int, cursor: str | None = None, limit: int = FEED_PAGE_SIZE) -> Page:
+    '''Returns a page of the posts to a wall, newest first'''
+    with session_scope() as session:
+        return post_page(session.execute(wall_query(wall_id, decode_cursor(cursor), limit)).all(), limit)
+
+def one_view(row, view):
+    '''Builds a view from a row fetched with one_or_none'''
+    return None if row is None else view(*row)
+
+def find_wall(condition) -> WallView | None:
+    '''Gets the wall matching a condition on the walls table, if there is one'''
+    with session_scope() as session:
+        return one_view(session.execute(select(*wall_columns()).where(condition)).one_or_none(), WallView)
+
+def get_wall(wall_id: int) -> WallView | None:
+    '''Gets a wall by id'''
+    return find_wall(Wall.id == wall_id)
+
+def get_user_wall(user_id: int) -> WallView | None:
+    '''Gets a user's wall'''
+    return find_wall(Wall.user_id == user_id)
+
+def get_group_wall(group_id: int) -> WallView | None:
+    '''Gets a group's wall'''
+    return find_wall(Wall.group_id == group_id)
 
 def get_user_by_id(user_id: int):
     '''Get a user object by id'''
     stmt = select(User).where(User.id == user_id)
-    with Session(engine) as session:
+    with session_scope() as session:
         return session.execute(stmt).scalar_one_or_none()
 
+def get_user_id_by_name(name: str) -> int | None:
+    '''Gets the id of the user called name, if there is one'''
+    with session_scope() as session:
+        return session.scalar(select(User.id).where(User.name == name))
+
 def is_group_member(user: int, group_id: int):
     '''Returns a bool representing if a user is a member of a particular group'''
     stmt = select(GroupMembership).where(
         and_(GroupMembership.member_id == user, GroupMembership.group_id == group_id)
     )
-    with Session(engine) as session:
+    with session_scope() as session:
         return session.execute(stmt).one_or_none() is not None
 
-def get_friends_of(user: int) -> List[int]:
-    '''Return a list of user ids of the user's friends'''
+def get_friends_of(user: int) -> List[Tuple[int, bool]]:
+    '''Return a list of (user id, is_request) for the user's friends and pending friend requests'''
     stmt = select(Friendship.second, Friendship.is_request).where(Friendship.first == user) \
-    .union(select(Friendship.first, Friendship.is_request).where(Friendship.second == user))
+    .union_all(select(Friendship.first, Friendship.is_request).where(Friendship.second == user))
 
-    with Session(engine) as session:
+    with session_scope() as session:
         return list(session.execute(stmt))
 
 def get_groups_of(user: int) -> List[int]:
     '''Return a list of group ids of the user's groups'''
     stmt = select(GroupMembership.group_id).where(GroupMembership.member_id == user)
     
-    with Session(engine) as session:
+    with session_scope() as session:
         return [_[0] for _ in session.execute(stmt)]
 
 class UserSidebarInfo:
@@ -428,7 +910,7 @@ def get_sidebar_user_info(user: int) -> UserSidebarInfo | None:
     '''Gets the information for a sidebar entry for a particular user'''
     stmt = select(User.name).where(User.id == user)
 
-    with Session(engine) as session:
+    with session_scope() as session:
         result = session.execute(stmt).one_or_none()
         if result is None:
             return None
@@ -445,83 +927,292 @@ def get_sidebar_group_info(group: int) -> GroupSidebarInfo | None:
     '''Gets the information for a sidebar entry for a particular group'''
     stmt = select(Group.name).where(Group.id == group)
 
-    with Session(engine) as session:
+    with session_scope() as session:
         result = session.execute(stmt).one_or_none()
         if result is None:
             return None
 
         return GroupSidebarInfo(group_id = group, name = result[0])
 
-def get_wall_post(id: int):
-    '''Gets a wall post by id'''
-    stmt = select(WallPost).where(WallPost.id == id)
+def get_sidebar_user_infos(users: Iterable[int]) -> Dict[int, UserSidebarInfo]:
+    '''Batched get_sidebar_user_info: resolves many users with a single query. Unknown ids are left out'''
+    users = set(users)
+    if not users:
+        return {}
+
+    stmt = select(User.id, User.name).where(User.id.in_(users))
+    with session_scope() as session:
+        return {row.id: UserSidebarInfo(name = row.name) for row in session.execute(stmt)}
+
+def get_sidebar_group_infos(groups: Iterable[int]) -> Dict[int, GroupSidebarInfo]:
+    '''Batched get_sidebar_group_info: resolves many groups with a single query. Unknown ids are left out'''
+    groups = set(groups)
+    if not groups:
+        return {}
+
+    stmt = select(Group.id, Group.name).where(Group.id.in_(groups))
+    with session_scope() as session:
+        return {row.id: GroupSidebarInfo(group_id = row.id, name = row.name) for row in session.execute(stmt)}
+
+def some_user_ids(limit: int) -> List[int]:
+    '''Up to limit user ids, most recently created first. Used to warm caches'''
+    with session_scope() as session:
+        return list(session.scalars(select(User.id).order_by(User.id.desc()).limit(limit)))
+
+def some_group_ids(limit: int) -> List[int]:
+    '''Up to limit group ids, most recently created first. Used to warm caches'''
+    with session_scope() as session:
+        return list(session.scalars(select(Group.id).order_by(Group.id.desc()).limit(limit)))
+
+def record_name_change(session: Session, kind: str, entity_id: int):
+    '''Bumps the name version of a user or group, as part of the session's transaction'''
+    change = NameChange(kind = kind, entity_id = entity_id)
+    session.add(change)
+    session.flush()
+    if change.seq % 1000 == 0:
+        session.execute(delete(NameChange).where(NameChange.seq <= change.seq - NAME_CHANGE_HISTORY))
+
+def latest_name_change() -> int:
+    '''The seq of the newest name change, or 0 if there have been none'''
+    with session_scope() as session:
+        return session.scalar(select(func.coalesce(func.max(NameChange.seq), 0)))
+
+def name_changes_since(seq: int) -> list:
+    '''Every name change after seq, oldest first'''
+    stmt = select(NameChange.seq, NameChange.kind, NameChange.entity_id).where(NameChange.seq > seq).order_by(NameChange.seq)
+    with session_scope() as session:
+        return session.execute(stmt).all()
+
+def post_query(id: int):
+    return select(*post_columns()).join(Wall, Wall.id == Post.wall_id).where(and_(Post.id == id, Wall.type != DELETED_WALL))
+
+def get_post(id: int) -> PostView | None:
+    '''Gets a post by id. Posts on a detached wall (see remove_wall) are already gone'''
+    with session_scope() as session:
+        return one_view(session.execute(post_query(id)).one_or_none(), PostView)
+
+COMMENT_PAGE_SIZE = 20
+
+def comments_query(post_id: int, position: Tuple[int, int] | None, limit: int):
+    '''The statement behind get_post_comments. Fetches limit + 1 rows for make_page'''
+    return select(*comment_columns()).where(and_(
+        Comment.post_id == post_id,
+        older_than(Comment.publish_datetime, Comment.id, position)
+    )).order_by(Comment.publish_datetime.desc(), Comment.id.desc()).limit(limit + 1)
+
+def comment_page(rows: list, limit: int) -> Page:
+    return make_page(rows, limit, lambda row: CommentView(*row))
+
+def get_post_comments(post_id: int, cursor: str | None = None, limit: int = COMMENT_PAGE_SIZE) -> Page:
+    '''Get a page of the comments on a post, newest first'''
+    with session_scope() as session:
+        return comment_page(session.execute(comments_query(post_id, decode_cursor(cursor), limit)).all(), limit)
+
+def get_comment(comment_id: int) -> CommentView | None:
+    '''Gets a comment by id'''
+    with session_scope() as session:
+        return one_view(session.execute(select(*comment_columns()).where(Comment.id == comment_id)).one_or_none(), CommentView)
+
+def post_wall(post_id: int):
+    '''Gets the (type, user_id, group_id) of the wall a post was posted to'''
+    stmt = select(Wall.type, Wall.user_id, Wall.group_id).join(Post, Post.wall_id == Wall.id).where(Post.id == post_id)
+
+    with session_scope() as session:
+        return session.execute(stmt).one_or_none()
 
-    with Session(engine) as session:
-        return session.scalars(stmt).one_or_none()
+def can_see_detail_on_post(current_user_id: int, post_id: int) -> bool:
+    '''Checks if a user can see a detailed view of a post (equiv. they can see the post at all, and comment on it)'''
+    wall = post_wall(post_id)
+    if wall is None:
+        return False
 
-def tag(obj, tag: dict):
-    '''Helper function to add values to a object functionally. Returns obj but with attrs set'''
-    for key,value in tag.items():
-        setattr(obj, key, value)
+    if wall.type == "group":
+        return is_group_member(current_user_id, wall.group_id)
+    if wall.type != "user":
+        return False
 
-    return obj
+    return current_user_id == wall.user_id or are_friends(current_user_id, wall.user_id)
 
-def get_group_post(id: int):
-    '''Get's a group post by id'''
-    stmt = select(GroupPost).where(GroupPost.id == id)
+class ViewerContext:
+    '''
+    Everything permission checks need to know about the logged in user: their friends, pending friend requests,
+    group memberships, whether they are a teacher and their own wall. Loaded once per request by load_viewer_context
+    '''
+    def __init__(self, user_id: int, is_teacher: bool, wall_id: int | None, friendships: List[Tuple[int, int, bool]], groups: Dict[int, bool]):
+        self.user_id = user_id
+        self.is_teacher = is_teacher
+        self.wall_id = wall_id
+        # Sidebar order and shape of get_friends_of: (user id, is_request)
+        self.friend_list = [(other, is_request) for other, _, is_request in friendships]
+        self.friends = {other for other, _, is_request in friendships if not is_request}
+        self.requesters = {other: requester_id for other, requester_id, is_request in friendships if is_request}
+        # group id -> is_admin, in get_groups_of order
+        self.groups = groups
+
+    def are_friends(self, other: int) -> bool:
+        return other in self.friends
+
+    def requester(self, other: int) -> int | None:
+        '''Id of whoever made the pending friend request between the viewer and other, if there is one'''
+        return self.requesters.get(other)
+
+    def can_see_wall(self, owner_id: int) -> bool:
+        return owner_id == self.user_id or owner_id in self.friends
+
+    def is_wall_admin(self, owner_id: int) -> bool:
+        return owner_id == self.user_id or self.is_teacher
+
+    def is_group_member(self, group_id: int) -> bool:
+        return group_id in self.groups
+
+    def is_group_admin(self, group_id: int) -> bool:
+        return self.is_teacher or self.groups.get(group_id, False)
+
+    def can_see(self, wall_type: str, wall_owner_id: int | None, group_id: int | None) -> bool:
+        '''Checks if the viewer can read, post to and comment on a wall, given who it belongs to'''
+        if wall_type == "group":
+            return self.is_group_member(group_id)
+        return wall_type == "user" and self.can_see_wall(wall_owner_id)
+
+    def can_admin(self, wall_type: str, wall_owner_id: int | None, group_id: int | None) -> bool:
+        '''Checks if the viewer can delete posts and comments on a wall, given who it belongs to'''
+        if wall_type == "group":
+            return self.is_group_admin(group_id)
+        return wall_type == "user" and self.is_wall_admin(wall_owner_id)
+
+def viewer_context_queries(user_id: int):
+    '''The (memberships, friendships) statements load_viewer_context runs, for build_viewer_context'''
+    friendship_stmt = select(Friendship.second, Friendship.requester_id, Friendship.is_request).where(Friendship.first == user_id) \
+        .union_all(select(Friendship.first, Friendship.requester_id, Friendship.is_request).where(Friendship.second == user_id))
+
+    membership_stmt = select(User.is_teacher, Wall.id.label("wall_id"), GroupMembership.group_id, GroupMembership.is_admin) \
+        .outerjoin(Wall, Wall.user_id == User.id) \
+        .outerjoin(GroupMembership, GroupMembership.member_id == User.id) \
+        .where(User.id == user_id).order_by(GroupMembership.group_id)
+
+    return membership_stmt, friendship_stmt
+
+def build_viewer_context(user_id: int, memberships: list, friendships: list) -> ViewerContext | None:
+    if not memberships:
+        return None
+
+    return ViewerContext(
+        user_id = user_id,
+        is_teacher = memberships[0].is_teacher,
+        wall_id = memberships[0].wall_id,
+        friendships = [tuple(row) for row in friendships],
+        groups = {row.group_id: row.is_admin for row in memberships if row.group_id is not None}
+    )
 
-    with Session(engine) as session:
-        return tag(session.scalars(stmt).one_or_none(), {"type": "group"})
+def load_viewer_context(user_id: int) -> ViewerContext | None:
+    '''Loads a ViewerContext in two queries. Returns None if the user doesn't exist'''
+    membership_stmt, friendship_stmt = viewer_context_queries(user_id)
+    with session_scope() as session:
+        memberships = session.execute(membership_stmt).all()
+        if not memberships:
+            return None
 
-def get_wall_post_comments(parent_id: int):
-    '''Get a list of comments on a wall post'''
-    stmt = select(WallPostComment).where(WallPostComment.post_id == parent_id).order_by(text('publish_datetime DESC'))
+        return build_viewer_context(user_id, memberships, session.execute(friendship_stmt).all())
 
-    with Session(engine) as session:
-        return list(session.scalars(stmt))
+# The FTS5 indexes over posts.content and comments.content (see migrations.add_search). Triggers keep them in sync
+# with every write, so they are only ever read, and aren't ORM mapped
+posts_search = table("posts_search", column("rowid"), column("content"))
+comments_search = table("comments_search", column("rowid"), column("content"))
 
-def get_group_post_comments(parent_id: int):
-    '''Gets a list of comments on a group post'''
-    stmt = select(GroupPostComment).where(GroupPostComment.post_id == parent_id).order_by(text('publish_datetime DESC'))
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_TERMS = 16
 
-    with Session(engine) as session:
-        return list(session.scalars(stmt))
+# Matched terms in SearchHit.snippet are wrapped in these. They can't be typed into a form, so templates can
+# escape the snippet and then turn them into tags (see the highlight filter)
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
 
-def wall_post_owner(post_id: int):
-    '''Gets the id of a wall post's wall owneer'''
-    stmt = select(WallPost.author_id).where(WallPost.id == post_id)
+def storable_content(content: str) -> str:
+    '''Post or comment content without SNIPPET_START / SNIPPET_END, so it can't fake or unbalance a snippet's marks'''
+    return content.replace(SNIPPET_START, "").replace(SNIPPET_END, "")
+SNIPPET_TOKENS = 16
 
-    with Session(engine) as session:
-        return session.execute(stmt).one_or_none()
+class SearchHit:
+    '''
+    Read model of a search result: a post, or a comment on post_id, with a snippet of its content around the
+    matched terms. kind is "post" or "comment"
+    '''
+    __slots__ = ("kind", "id", "post_id", "author_id", "publish_datetime", "snippet")
 
-def group_post_group(post_id: int):
-    '''Get's the id of a group post's group'''
-    stmt = select(GroupPost.group_id).where(GroupPost.id == post_id)
+    def __init__(self, kind: str, id: int, post_id: int, author_id: int, publish_datetime: int, snippet: str):
+        self.kind = kind
+        self.id = id
+        self.post_id = post_id
+        self.author_id = author_id
+        self.publish_datetime = publish_datetime
+        self.snippet = snippet
 
-    with Session(engine) as session:
-        return session.execute(stmt).one_or_none()
+def search_match(terms: str) -> str | None:
+    '''
+    Turns what someone typed into an FTS5 query for content containing every word, the last one as a prefix
+    so results show up while a word is unfinished. Returns None if there are no words to search for
+    '''
+    words = re.findall(r"\w+", terms)[:SEARCH_MAX_TERMS]
+    if not words:
+        return None
+    # Quoted, each word is a plain string to FTS5 rather than query syntax
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+def search_hits(kind: str, model, index, post_id, match: str, walls):
+    '''The SearchHit columns (plus rank) of the rows of model matching in index, on the given walls'''
+    index_column = literal_column(index.name)
+    return select(
+        literal(kind).label("kind"),
+        model.id,
+        post_id.label("post_id"),
+        model.author_id,
+        model.publish_datetime,
+        func.snippet(index_column, 0, SNIPPET_START, SNIPPET_END, "…", SNIPPET_TOKENS).label("snippet"),
+        func.bm25(index_column).label("rank")
+    ).select_from(index).where(and_(index_column.op("MATCH")(match), Post.wall_id.in_(walls)))
+
+def search_query(user_id: int, match: str, offset: int, limit: int):
+    '''
+    The statement behind search: posts and comments matching an FTS5 query on the walls the user can see, best
+    match first. Fetches limit + 1 rows to detect a next page
+    '''
+    walls = visible_walls(user_id)
+    posts = search_hits("post", Post, posts_search, Post.id, match, walls) \
+        .join(Post, Post.id == posts_search.c.rowid)
+    comments = search_hits("comment", Comment, comments_search, Comment.post_id, match, walls) \
+        .join(Comment, Comment.id == comments_search.c.rowid).join(Post, Post.id == Comment.post_id)
 
-def can_see_detail_on_post(target_t: str, current_user_id: int, post_id: int) -> bool:
-    '''Checks if a user can see a detailed view of a post (equiv. they can see the post at all)'''
-    if target_t == "wall":
-        post_owner = wall_post_owner(post_id)
-        if post_owner is None:
-            return False
+    hits = union_all(posts, comments).subquery()
+    return select(hits.c.kind, hits.c.id, hits.c.post_id, hits.c.author_id, hits.c.publish_datetime, hits.c.snippet) \
+        .order_by(hits.c.rank, hits.c.publish_datetime.desc(), hits.c.kind, hits.c.id.desc()).limit(limit + 1).offset(offset)
 
-        return current_user_id == post_owner[0] or are_friends(current_user_id, post_owner[0])
+def search(user_id: int, terms: str, cursor: str | None = None, limit: int = SEARCH_PAGE_SIZE) -> Page:
+    '''
+    Returns a page of the posts and comments containing every word of terms that the user can see (by the
+    rules of can_see_detail_on_post), ranked by bm25. Results are ordered by relevance rather than time, so the
+    cursor is an offset into them
+    '''
+    match = search_match(terms)
+    if match is None:
+        return Page([], None)
 
-    elif target_t == "group":
-        group_id = group_post_group(post_id)
-        if group_id is None:
-            return False
+    offset = int(cursor) if cursor and cursor.isdigit() else 0
+    with session_scope() as session:
+        rows = session.execute(search_query(user_id, match, offset, limit)).all()
 
-        return is_group_member(current_user_id, group_id[0])
+    items = [SearchHit(*row) for row in rows[:limit]]
+    return Page(items, str(offset + limit) if len(rows) > limit else None)
 
-    return False
+def rebuild_search_index():
+    '''Rebuilds the search indexes from the posts and comments tables, e.g. after editing the database by hand'''
+    with session_scope() as session:
+        for index in (posts_search, comments_search):
+            session.execute(text(f"INSERT INTO {index.name} ({index.name}) VALUES ('rebuild')"))
+        commit(session)
 
 def friend_request(requester_id: int, requestee_name: str) -> bool:
     '''Creates a friend request from the requester to a user with name == requestee_name'''
-    with Session(engine) as session:
+    with session_scope() as session:
         requestee_id = session.execute(
                 select(User.id).where(User.name == requestee_name)
             ).one_or_none()
@@ -529,13 +1220,15 @@ def friend_request(requester_id: int, requestee_name: str) -> bool:
         if requestee_id is None or requestee_id[0] == requester_id:
             return False
 
+        first, second = friendship_key(requester_id, requestee_id[0])
         try:
             session.add(Friendship(
-            first = requester_id,
-            second = requestee_id[0],
+            first = first,
+            second = second,
+            requester_id = requester_id,
             is_request = True
             ))
-            session.commit()
+            commit(session)
         except sql_error:
             return False
         except Exception as err:
@@ -544,26 +1237,30 @@ def friend_request(requester_id: int, requestee_name: str) -> bool:
 
         return True
 
-def requester(first: id, second: id):
-    '''Returns the id of the user who requested a friendship'''
-    stmt = select(Friendship.first).where(and_(Friendship.first == first, Friendship.second == second)).union(
-            select(Friendship.first).where(and_(Friendship.first == second, Friendship.second == first)))
-    with Session(engine) as session:
-        return session.execute(stmt).one_or_none()
+def requester(a_id: int, b_id: int) -> int | None:
+    '''Returns the id of the user who requested a friendship, or None if the users have no friendship'''
+    first, second = friendship_key(a_id, b_id)
+    stmt = select(Friendship.requester_id).where(and_(Friendship.first == first, Friendship.second == second))
+    with session_scope() as session:
+        return session.scalar(stmt)
 
 def accept_friend_request(self: id, other: id):
     '''Changes a friend request into a friendship'''
-    with Session(engine) as session:
-        # Leverages the fact that acceptance has to come from second
-        res = session.scalar(select(Friendship).where(and_(Friendship.first == other, Friendship.second == self)))
+    with session_scope() as session:
+        # Acceptance has to come from the user who didn't make the request
+        first, second = friendship_key(self, other)
+        res = session.get(Friendship, (first, second))
 
-        if res is None:
+        if res is None or not res.is_request or res.requester_id != other:
             return False
 
         res.is_request = False 
 
         try:
-            session.commit()
+            if TIMELINE_ENABLED:
+                backfill_wall(session, self, user_wall(other))
+                backfill_wall(session, other, user_wall(self))
+            commit(session)
         except sql_error:
             return False
 
@@ -571,18 +1268,18 @@ def accept_friend_request(self: id, other: id):
 
 def end_friendship(self: id, other: id):
     '''Deletes a friendship between self and other. Returns whether it succeeds'''
-    with Session(engine) as session:
-        res = session.scalar(
-                select(Friendship).from_statement(select(Friendship).where(and_(Friendship.first == other, Friendship.second == self)).union(
-            select(Friendship).where(and_(Friendship.first == self, Friendship.second == other))
-        )))
+    with session_scope() as session:
+        res = session.get(Friendship, friendship_key(self, other))
 
         if res is None:
             return False
 
         try:
+            if TIMELINE_ENABLED:
+                prune_wall(session, self, user_wall(other))
+                prune_wall(session, other, user_wall(self))
             session.delete(res)
-            session.commit()
+            commit(session)
         except sql_error:
             return False
 
@@ -590,9 +1287,10 @@ def end_friendship(self: id, other: id):
 
 def create_group(user_id: int, group_name: str):
     '''Creates a group, owned by the user with id user_id'''
-    with Session(engine) as session:
+    with session_scope() as session:
         group = Group(
-            name = group_name
+            name = group_name,
+            wall = Wall(type = "group")
         )
  
         session.add(group)
@@ -606,7 +1304,9 @@ def create_group(user_id: int, group_name: str):
         session.add(membership)
 
         try:
-            session.commit()
+            session.flush()
+            record_name_change(session, "group", group.id)
+            commit(session)
         except sql_error:
             return False
 
@@ -614,7 +1314,7 @@ def create_group(user_id: int, group_name: str):
 
 def join_group(user_id: int, group_id: int):
     '''Adds a user as a member of a group'''
-    with Session(engine) as session:
+    with session_scope() as session:
         membership = GroupMembership(
                 group_id = group_id,
                 member_id = user_id,
@@ -624,149 +1324,215 @@ def join_group(user_id: int, group_id: int):
         session.add(membership)
 
         try:
-            session.commit()
+            if TIMELINE_ENABLED:
+                backfill_wall(session, user_id, group_wall(group_id))
+            commit(session)
         except sql_error:
             return False
 
         return True
 
+def remove_wall(session: Session, wall_id: int):
+    '''
+    Deletes a wall and everything posted to it, as part of the session's transaction. A wall with more than
+    RECLAIM_CHUNK posts is detached instead (it becomes a DELETED_WALL that nobody can see), and once the
+    transaction commits its posts are reclaimed in the background without holding up other writers
+    '''
+    posts = select(Post.id).where(Post.wall_id == wall_id).limit(RECLAIM_CHUNK + 1).subquery()
+    if session.scalar(select(func.count()).select_from(posts)) <= RECLAIM_CHUNK:
+        session.execute(delete(Wall).where(Wall.id == wall_id))
+        return
+
+    session.execute(update(Wall).where(Wall.id == wall_id).values(type = DELETED_WALL, user_id = None, group_id = None))
+    call_after_commit(session, reclaim_in_background)
+
 def delete_group(group_id: int):
-    '''Deletes a group with id == group_id. Returns bool regarding whether it succeeded'''
-    with Session(engine) as session:
-        group = session.scalar(select(Group).where(Group.id == group_id))
-        if group is None:
+    '''
+    Deletes a group with id == group_id, along with its memberships and its wall (see remove_wall).
+    Returns bool regarding whether it succeeded
+    '''
+    with session_scope() as session:
+        wall_id = session.scalar(select(Wall.id).where(Wall.group_id == group_id))
+        if wall_id is None:
             return False
 
         try:
-            session.delete(group)
-            session.commit()
+            remove_wall(session, wall_id)
+            session.execute(delete(Group).where(Group.id == group_id))
+            record_name_change(session, "group", group_id)
+            commit(session)
         except sql_error:
             return False
 
         return True
 
+def delete_user(user_id: int) -> bool:
+    '''
+    Deletes a user's account, along with their wall (see remove_wall) and everything else of theirs: posts,
+    comments, friendships, memberships, messages and timeline. Returns whether it succeeded
+    '''
+    with session_scope() as session:
+        wall_id = session.scalar(select(Wall.id).where(Wall.user_id == user_id))
+        if wall_id is None:
+            return False
+
+        their_comments = select(func.count()).where(and_(Comment.post_id == Post.id, Comment.author_id == user_id)).scalar_subquery()
+        try:
+            remove_wall(session, wall_id)
+            session.execute(update(Post).where(Post.id.in_(select(Comment.post_id).where(Comment.author_id == user_id)))
+                            .values(comment_count = Post.comment_count - their_comments))
+            session.execute(delete(User).where(User.id == user_id))
+            record_name_change(session, "user", user_id)
+            commit(session)
+        except sql_error:
+            return False
+
+        return True
+
+def reclaim_wall(wall_id: int) -> int:
+    '''
+    Deletes a detached wall's posts RECLAIM_CHUNK at a time, each chunk in a transaction of its own, and then
+    the wall. Returns how many posts it deleted
+    '''
+    chunk = select(Post.id).where(Post.wall_id == wall_id).limit(RECLAIM_CHUNK)
+    deleted = 0
+    while True:
+        with write_session() as session:
+            count = session.execute(delete(Post).where(Post.id.in_(chunk)), execution_options = {"synchronize_session": False}).rowcount
+            if count < RECLAIM_CHUNK:
+                session.execute(delete(Wall).where(and_(Wall.id == wall_id, Wall.type == DELETED_WALL)))
+            session.commit()
+
+        deleted += count
+        if count < RECLAIM_CHUNK:
+            return deleted
+        time.sleep(CHUNK_PAUSE)
+
+def reclaim_deleted_walls() -> int:
+    '''Reclaims every detached wall (see reclaim_wall). Returns how many posts it deleted'''
+    with session_scope() as session:
+        wall_ids = list(session.scalars(select(Wall.id).where(Wall.type == DELETED_WALL)))
+
+    return sum(reclaim_wall(wall_id) for wall_id in wall_ids)
+
+# The thread reclaiming detached walls in this process, if there is one, and whether it should look for more
+# once it's done. Both are only changed under reclaim_lock
+reclaim_lock = threading.Lock()
+reclaimer: threading.Thread | None = None
+reclaim_pending = False
+
+def reclaim_in_background():
+    '''Reclaims every detached wall on a background thread, e.g. after remove_wall detaches one, or at startup'''
+    global reclaimer, reclaim_pending
+    with reclaim_lock:
+        reclaim_pending = True
+        # A worker forked from a process that was reclaiming has its reclaimer, but not the thread
+        if reclaimer is None or not reclaimer.is_alive():
+            reclaimer = threading.Thread(target = reclaim_until_done, name = "reclaimer", daemon = True)
+            reclaimer.start()
+
+def reclaim_until_done():
+    global reclaimer, reclaim_pending
+    while True:
+        with reclaim_lock:
+            if not reclaim_pending:
+                reclaimer = None
+                return
+            reclaim_pending = False
+
+        try:
+            deleted = reclaim_deleted_walls()
+            if deleted:
+                log.info(f"Reclaimed {deleted} posts from deleted walls")
+        except Exception:
+            log.exception("Failed to reclaim deleted walls")
+
+def wait_for_reclaim():
+    '''Waits until the background reclaimer, if one is running, has finished'''
+    with reclaim_lock:
+        thread = reclaimer
+    if thread is not None:
+        thread.join()
+
 def rename(user_id: int, name: str):
     '''Renames a user with id == user_id to have name = name. Returns whether it was successful'''
-    with Session(engine) as session:
+    with session_scope() as session:
         user = session.scalar(select(User).where(User.id == user_id))
         if user is None:
             return False
         user.name = name
 
         try:
-            session.commit()
+            record_name_change(session, "user", user_id)
+            commit(session)
         except sql_error:
             return False
 
         return True
 
-def is_wall_admin(user_id: int, wall_id: int):
-    '''Returns a bool representing if user is admin of wall. i.e it's theirs or they are site admin'''
-    if wall_id == user_id:
+def is_wall_admin(user_id: int, owner_id: int):
+    '''Returns a bool representing if user is admin of owner_id's wall. i.e it's theirs or they are site admin'''
+    if owner_id == user_id:
         return True
 
-    with Session(engine) as session:
+    with session_scope() as session:
         res = session.scalar(select(User.is_teacher).where(User.id == user_id))
         return res is not None and res
 
-def is_wall_post_admin(user_id: int, post_id: int):
-    '''Returns a bool representing whether the user is an admin of the wall where the wall post was posted'''
-    with Session(engine) as session:
-        wall_id = session.scalar(select(WallPost.wall_id).where(WallPost.id == post_id))
-        if wall_id is None:
-            return False
+def is_post_admin(user_id: int, post_id: int):
+    '''Returns a bool representing whether the user is an admin of the wall or group where the post was posted'''
+    wall = post_wall(post_id)
+    if wall is None:
+        return False
 
-        if wall_id == user_id:
-            return True
+    if wall.type == "group":
+        return is_group_admin(user_id, wall.group_id)
+    if wall.type != "user":
+        return False
 
-        res = session.scalar(select(User.is_teacher).where(User.id == user_id))
-        return res is not None and res
+    return is_wall_admin(user_id, wall.user_id)
 
 def is_group_admin(user_id: int, group_id: int):
     '''Returns a bool representing if user is admin of wall. i.e explicit admin or they are site admin'''
-    with Session(engine) as session:
-        user = session.scalar(select(User.is_teacher).where(User.id == user_id))
-        group_admin = session.scalar(select(GroupMembership.is_admin).where(and_(
-            GroupMembership.member_id == user_id,
-            GroupMembership.group_id == group_id
-        )))
-
-        return user or group_admin
-
-def is_group_post_admin(user_id: int, post_id: int):
-    '''Returns a bool representing whether the user is an admin of the grou where the group post was posted'''
-    with Session(engine) as session:
-        group_id = session.scalar(select(GroupPost.group_id).where(GroupPost.id == post_id))
-        print(f"{group_id=}")
-        if group_id is None:
-            return False
-
-        user = session.scalar(select(User.is_teacher).where(User.id == user_id))
-        print(f"{user=}")
-        group_admin = session.scalar(select(GroupMembership.is_admin).where(and_(
-            GroupMembership.member_id == user_id,
-            GroupMembership.group_id == group_id
-        )))
-        print(f"{group_admin=}")
-
-        return user or group_admin
-
-def delete_post(target_t: str, post_id: str):
-    '''Thin wrapper around deleting wall or group post'''
-    if target_t == "wall":
-        return delete_wall_post(post_id)
-    elif target_t == "group":
-        return delete_group_post(post_id)
-    else:
-        return False
-
-def delete_wall_post(post_id):
-    '''Deletes wall post with id == post_id'''
-    with Session(engine) as session:
-        post = session.scalar(select(WallPost).where(WallPost.id == post_id))
-        if post is None:
+    stmt = select(User.is_teacher, GroupMembership.is_admin).outerjoin(GroupMembership, and_(
+        GroupMembership.member_id == User.id,
+        GroupMembership.group_id == group_id
+    )).where(User.id == user_id)
+
+    with session_scope() as session:
+        row = session.execute(stmt).one_or_none()
+        return row is not None and bool(row.is_teacher or row.is_admin)
+
+def delete_comment(comment_id: int) -> bool:
+    '''Deletes a comment, keeping its post's comment_count in step'''
+    with session_scope() as session:
+        comment = session.get(Comment, comment_id)
+        if comment is None:
             return False
 
         try:
-            session.delete(post)
-            session.commit()
+            session.execute(update(Post).where(Post.id == comment.post_id).values(comment_count = Post.comment_count - 1))
+            session.delete(comment)
+            commit(session)
         except sql_error:
             return False
 
         return True
 
-def delete_group_post(post_id):
-    '''Deletes group post with id == post_id'''
-    with Session(engine) as session:
-        post = session.scalar(select(GroupPost).where(GroupPost.id == post_id))
-        if post is None:
-            return False
-
+def delete_post(post_id: int):
+    '''Deletes post with id == post_id, along with its comments and timeline entries'''
+    with session_scope() as session:
         try:
-            session.delete(post)
-            session.commit()
+            deleted = session.execute(delete(Post).where(Post.id == post_id)).rowcount
+            commit(session)
         except sql_error:
             return False
 
-        return True
+        return deleted > 0
 
-def can_comment_on_wall_post(user_id: int, post_id: int):
-    '''Checks if a user can comment on a wall post (i.e. they are allowed to see it)'''
-    with Session(engine) as session:
-        resp = session.scalar(select(WallPost.wall_id).where(WallPost.id == post_id))
-        if resp is None:
-            return False
+# Time every function here that talks to the database, per request (see metrics.py). Writes get their session
+# from write or write_session rather than session_scope
+metrics.instrument(globals(), __name__, ("session_scope", "write", "write_session"))
 
-        return user_id == resp or are_friends(user_id, resp)
-
-def can_comment_on_group_post(user_id: int, post_id: int):
-    '''Checks if a user can comment on a group post (i.e. they are allowed to see it)'''
-    with Session(engine) as session:
-        resp = session.scalar(select(GroupPost.group_id).where(GroupPost.id == post_id))
-        if resp is None:
-            return False
-
-        return is_group_member(user_id, resp) 
-    
 if __name__ == "__main__":
     print(f"{are_friends(5,6)=}")
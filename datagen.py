@@ -0,0 +1,214 @@
+'''
+Seeded synthetic databases for benchmarking (see bench.py and `flask generate-dataset`).
+
+generate() builds a database at one of the SCALES with the same schema a fully migrated main.db has, the way
+migrations.create does, but inserting the rows before the search indexes are built. Its timeline is filled in
+too, so it can be served with or without SOCIALITE_TIMELINE. The same seed and scale
+always give the same database.
+
+The data is shaped like a school's: friendships are grown by preferential attachment, so a few people have
+hundreds of friends and most have a handful; groups have 30 to 300 members; how much people post and how much
+a post is commented on both follow power laws; and posts and comments are spread over the scale's days.
+Every account's password is PASSWORD
+'''
+from typing import Dict, List
+import os
+import random
+import sqlite3
+
+import database
+import migrations
+import passwords
+
+import logging
+log = logging.getLogger("datagen")
+
+SCALES = {
+    "small": {"users": 1000, "groups": 20, "friends": 8, "posts_per_user": 8, "comments_per_post": 2, "days": 60},
+    "medium": {"users": 5000, "groups": 60, "friends": 12, "posts_per_user": 12, "comments_per_post": 3, "days": 180},
+    "large": {"users": 20000, "groups": 200, "friends": 16, "posts_per_user": 15, "comments_per_post": 3, "days": 365},
+}
+
+PASSWORD = "password"
+
+# Fraction of friendships that are still pending requests, and of accounts that are teachers
+PENDING_FRIENDSHIPS = 0.1
+TEACHERS = 0.02
+
+# The newest timestamp in a generated database. Fixed so that the same seed gives the same database
+END_DATETIME = 1_700_000_000 * 1_000_000_000
+DAY = 86_400 * 1_000_000_000
+
+FIRST_NAMES = '''Alex Amelia Ava Ben Charlie Chloe Daniel Ella Emily Ethan Finn Freya Grace Harry Isla Jack Jacob
+    James Leo Lily Lucas Mia Noah Oliver Olivia Oscar Ruby Sam Sophie Thomas Zara'''.split()
+LAST_NAMES = '''Ahmed Brown Clarke Davies Evans Green Hall Hughes Jackson Jones Khan King Lee Lewis Martin Patel
+    Roberts Robinson Smith Taylor Thomas Thompson Walker White Williams Wilson Wood Wright Young'''.split()
+WORDS = '''the a to and of in is it you that was for on are with as I his they be at one have this from or had by
+    not word but what some we can out other were all there when up use your how said an each she which do their
+    time if will way about many then them write would like so these her long make thing see him two has look more
+    day could go come did number sound no most people my over know water than call first who may down side been
+    now find any new work part take get place made live where after back little only round man year came show
+    every good me give our under name very through just form sentence great think say help low line differ turn
+    cause much mean before move right boy old too same tell does set three want air well also play small end put
+    home read hand port large spell add even land here must big high such follow act why ask men change went
+    light kind off need house picture try us again animal point mother world near build self earth father head
+    stand own page should country found answer school grow study still learn plant cover food sun four between
+    state keep eye never last let thought city tree cross farm hard start might story saw far sea draw left late
+    run while press close night real life few north open seem together next white children begin got walk example
+    ease paper group always music those both mark often letter until mile river car feet care second book carry
+    took science eat room friend began idea fish mountain stop once base hear horse cut sure watch color face wood
+    main enough plain girl usual young ready above ever red list though feel talk bird soon body dog family direct
+    pose leave song measure door product black short numeral class wind question happen complete ship area half
+    rock order fire south problem piece told knew pass since top whole king space heard best hour better true
+    during hundred five remember step early hold west ground interest reach fast verb sing listen six table travel
+    less morning ten simple several vowel toward war lay against pattern slow center love person money serve
+    appear road map rain rule govern pull cold notice voice unit power town fine certain fly fall lead cry dark
+    machine note wait plan figure star box noun field rest correct able pound done beauty drive stood contain
+    front teach week final gave green oh quick develop ocean warm free minute strong special mind behind clear
+    tail produce fact street inch multiply nothing course stay wheel full force blue object decide surface deep
+    moon island foot system busy test record boat common gold possible plane stead dry wonder laugh thousand ago
+    ran check game shape equate hot miss brought heat snow tire bring yes distant fill east paint language among
+    homework exam lunch maths history geography chemistry physics biology trip teacher lesson holiday football'''.split()
+
+# Zipf weights, so a few words are everywhere and most are rare, like in real text
+WORD_WEIGHTS = [1 / rank for rank in range(1, len(WORDS) + 1)]
+
+def power_law_weights(rng: random.Random, count: int, alpha: float = 1.5) -> List[float]:
+    return [rng.paretovariate(alpha) for _ in range(count)]
+
+def sentence(rng: random.Random, low: int, high: int) -> str:
+    words = rng.choices(WORDS, WORD_WEIGHTS, k = rng.randint(low, high))
+    return " ".join(words).capitalize()
+
+def generate_friendships(rng: random.Random, users: int, friends: int) -> Dict[tuple, tuple]:
+    '''
+    (first, second) -> (requester_id, is_request) for a preferential attachment graph averaging friends
+    friendships per user
+    '''
+    friendships = {}
+    # Every user appears once per friendship they are in, so choosing from it favours well connected users
+    endpoints = []
+    for user in range(1, users + 1):
+        wanted = min(user - 1, max(1, round(rng.expovariate(2 / friends))))
+        for _ in range(wanted):
+            other = rng.choice(endpoints) if endpoints and rng.random() < 0.8 else rng.randint(1, user - 1)
+            key = database.friendship_key(user, other)
+            if other == user or key in friendships:
+                continue
+            friendships[key] = (rng.choice(key), rng.random() < PENDING_FRIENDSHIPS)
+            endpoints.extend(key)
+    return friendships
+
+def fill_timeline(db: sqlite3.Connection) -> int:
+    '''
+    Writes everyone's materialized timeline from the posts, friendships and memberships: the entries
+    database.rebuild_timeline would, in one statement per kind of wall. Returns how many it wrote
+    '''
+    written = db.execute('''INSERT INTO timeline_entries (user_id, publish_datetime, post_id)
+        SELECT readers.user_id, posts.publish_datetime, posts.id FROM (
+            SELECT first AS user_id, second AS friend_id FROM friendships WHERE NOT is_request
+            UNION ALL SELECT second, first FROM friendships WHERE NOT is_request
+            UNION ALL SELECT id, id FROM users
+        ) AS readers
+        JOIN walls ON walls.user_id = readers.friend_id
+        JOIN posts ON posts.wall_id = walls.id''').rowcount
+    written += db.execute('''INSERT INTO timeline_entries (user_id, publish_datetime, post_id)
+        SELECT group_memberships.member_id, posts.publish_datetime, posts.id FROM group_memberships
+        JOIN walls ON walls.group_id = group_memberships.group_id
+        JOIN posts ON posts.wall_id = walls.id''').rowcount
+    return written
+
+def generate(path: str, scale: str = "small", seed: int = 0):
+    '''Writes a new database of the given scale to path, replacing anything there'''
+    if scale not in SCALES:
+        raise ValueError(f"Unknown scale {scale!r}, expected one of {list(SCALES)}")
+    settings = SCALES[scale]
+    rng = random.Random(seed)
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    migrations.create_tables(path)
+
+    db = migrations.connect(path)
+    try:
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        db.execute("BEGIN")
+
+        users = settings["users"]
+        password_hash = passwords.hash(PASSWORD)
+        db.executemany('''INSERT INTO users (id, name, password, password_reset_on_next_login,
+            student_requests_password_change, is_teacher) VALUES (?, ?, ?, 0, 0, ?)''',
+            ((id, f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {id}", password_hash, rng.random() < TEACHERS)
+             for id in range(1, users + 1)))
+        db.executemany("INSERT INTO walls (id, type, user_id) VALUES (?, 'user', ?)", ((id, id) for id in range(1, users + 1)))
+
+        friendships = generate_friendships(rng, users, settings["friends"])
+        db.executemany("INSERT INTO friendships (first, second, requester_id, is_request) VALUES (?, ?, ?, ?)",
+            (key + value for key, value in friendships.items()))
+
+        friends_of = {id: [] for id in range(1, users + 1)}
+        for (first, second), (_, is_request) in friendships.items():
+            if not is_request:
+                friends_of[first].append(second)
+                friends_of[second].append(first)
+
+        groups_of = {id: [] for id in range(1, users + 1)}
+        members_of = {}
+        for group in range(1, settings["groups"] + 1):
+            members = rng.sample(range(1, users + 1), min(users, rng.randint(30, 300)))
+            members_of[group] = members
+            for member in members:
+                groups_of[member].append(group)
+            db.execute("INSERT INTO groups (id, name) VALUES (?, ?)", (group, f"{sentence(rng, 1, 3)} club"))
+            db.execute("INSERT INTO walls (id, type, group_id) VALUES (?, 'group', ?)", (users + group, group))
+            db.executemany("INSERT INTO group_memberships (member_id, group_id, is_admin) VALUES (?, ?, ?)",
+                ((member, group, index == 0) for index, member in enumerate(members)))
+
+        span = settings["days"] * DAY
+        start = END_DATETIME - span
+        authors = rng.choices(range(1, users + 1), power_law_weights(rng, users), k = users * settings["posts_per_user"])
+        posts = []
+        for author in authors:
+            where = rng.random()
+            if where < 0.3 and friends_of[author]:
+                wall = rng.choice(friends_of[author])
+                readers = [wall, author]
+            elif where < 0.5 and groups_of[author]:
+                group = rng.choice(groups_of[author])
+                wall = users + group
+                readers = members_of[group]
+            else:
+                wall = author
+                readers = friends_of[author] + [author]
+            posts.append((start + rng.randrange(span), author, wall, readers))
+        posts.sort(key = lambda post: post[0])
+
+        comments = []
+        for index in rng.choices(range(len(posts)), power_law_weights(rng, len(posts)), k = len(posts) * settings["comments_per_post"]):
+            publish_datetime, _, _, readers = posts[index]
+            delay = min(int(rng.expovariate(1 / 3600) * 1_000_000_000), END_DATETIME - publish_datetime)
+            comments.append((publish_datetime + delay, rng.choice(readers), index + 1))
+        comments.sort(key = lambda comment: comment[0])
+
+        comment_counts = [0] * len(posts)
+        for _, _, post_id in comments:
+            comment_counts[post_id - 1] += 1
+
+        db.executemany('''INSERT INTO posts (id, content, author_id, wall_id, publish_datetime, comment_count)
+            VALUES (?, ?, ?, ?, ?, ?)''',
+            ((id, sentence(rng, 5, 40), author, wall, publish_datetime, comment_counts[id - 1])
+             for id, (publish_datetime, author, wall, _) in enumerate(posts, start = 1)))
+        db.executemany("INSERT INTO comments (id, content, author_id, post_id, publish_datetime) VALUES (?, ?, ?, ?, ?)",
+            ((id, sentence(rng, 2, 20), author, post_id, publish_datetime)
+             for id, (publish_datetime, author, post_id) in enumerate(comments, start = 1)))
+        timeline = fill_timeline(db)
+
+        db.execute("COMMIT")
+        migrations.finish_schema(db)
+    finally:
+        db.close()
+
+    log.info(f"Generated a {scale} database at {path}: {users} users, {len(friendships)} friendships, "
+             f"{settings['groups']} groups, {len(posts)} posts, {len(comments)} comments, {timeline} timeline entries")
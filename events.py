@@ -0,0 +1,151 @@
+'''
+Publish / subscribe of new posts and comments, for the /events live update stream.
+
+Topics are "wall:<wall id>" (new posts to a user's wall or a group) and "post:<post id>" (new comments on a post).
+database.py publishes to them once the transaction that wrote the post or comment has committed, and each
+/events stream subscribes to the topics its viewer is allowed to see.
+
+LocalBroker only reaches subscribers in the same process, which is all a single worker deployment needs.
+With several workers, swap in a Broker whose publish fans out through something every worker can see
+(e.g. Redis pub/sub) with use_broker() at startup: events are plain picklable values so they can cross processes.
+
+Subscription blocks a thread while it waits. The async serving mode (asgi.py) uses AsyncSubscription instead,
+which hands events over to its event loop, whatever thread they were published from
+'''
+from collections import defaultdict
+from typing import Iterable, Set
+import asyncio
+import queue
+import threading
+
+import logging
+log = logging.getLogger("events")
+
+# How many undelivered events a subscriber may fall behind by before it is dropped (and has to reconnect)
+MAX_BACKLOG = 256
+
+def wall_topic(wall_id: int) -> str:
+    return f"wall:{wall_id}"
+
+def post_topic(post_id: int) -> str:
+    return f"post:{post_id}"
+
+class Event:
+    '''Something that happened on a topic: kind is "post" or "comment", and item its PostView / CommentView'''
+    __slots__ = ("topic", "kind", "item")
+
+    def __init__(self, topic: str, kind: str, item):
+        self.topic = topic
+        self.kind = kind
+        self.item = item
+
+class Subscription:
+    '''A subscriber's queue of events on its topics. closed is set once the broker stops delivering to it'''
+    def __init__(self, broker: "Broker", topics: Set[str]):
+        self.broker = broker
+        self.topics = topics
+        self.events = queue.Queue(maxsize = MAX_BACKLOG)
+        self.closed = False
+
+    def deliver(self, event: Event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            log.info(f"Dropping a subscriber that fell {MAX_BACKLOG} events behind")
+            self.close()
+
+    def get(self, timeout: float) -> Event | None:
+        '''Waits up to timeout seconds for the next event. Returns None if there wasn't one'''
+        try:
+            return self.events.get(timeout = timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.broker.unsubscribe(self)
+
+class AsyncSubscription(Subscription):
+    '''A Subscription to await from the event loop it was created on'''
+    def __init__(self, broker: "Broker", topics: Set[str]):
+        super().__init__(broker, topics)
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue(maxsize = MAX_BACKLOG)
+
+    def deliver(self, event: Event):
+        try:
+            self.loop.call_soon_threadsafe(self.put, event)
+        except RuntimeError:
+            # The loop has shut down, so nobody is listening any more
+            self.close()
+
+    def put(self, event: Event):
+        try:
+            self.events.put_nowait(event)
+        except asyncio.QueueFull:
+            log.info(f"Dropping a subscriber that fell {MAX_BACKLOG} events behind")
+            self.close()
+
+    async def get(self, timeout: float) -> Event | None:
+        '''Waits up to timeout seconds for the next event. Returns None if there wasn't one'''
+        try:
+            return await asyncio.wait_for(self.events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+class Broker:
+    '''Interface of a pub/sub broker'''
+    def publish(self, event: Event):
+        raise NotImplementedError
+
+    def subscribe(self, subscription: Subscription) -> Subscription:
+        '''Starts delivering events on subscription.topics to subscription'''
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription: Subscription):
+        raise NotImplementedError
+
+class LocalBroker(Broker):
+    '''Broker delivering events to subscribers in this process'''
+    def __init__(self):
+        self.subscribers = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def publish(self, event: Event):
+        with self.lock:
+            subscribers = list(self.subscribers.get(event.topic, ()))
+        for subscription in subscribers:
+            subscription.deliver(event)
+
+    def subscribe(self, subscription: Subscription) -> Subscription:
+        with self.lock:
+            for topic in subscription.topics:
+                self.subscribers[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            for topic in subscription.topics:
+                subscribers = self.subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscribers[topic]
+
+broker: Broker = LocalBroker()
+
+def use_broker(new_broker: Broker):
+    '''Replaces the broker every publish and subscribe goes through, e.g. with a cross-worker one'''
+    global broker
+    broker = new_broker
+
+def publish(topic: str, kind: str, item):
+    broker.publish(Event(topic, kind, item))
+
+def subscribe(topics: Iterable[str]) -> Subscription:
+    return broker.subscribe(Subscription(broker, set(topics)))
+
+def subscribe_async(topics: Iterable[str]) -> AsyncSubscription:
+    '''subscribe for coroutines: must be called on the event loop that will await the subscription'''
+    return broker.subscribe(AsyncSubscription(broker, set(topics)))
@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 from wtforms import StringField, PasswordField, IntegerField, validators
 
 class LoginForm(FlaskForm):
@@ -12,6 +13,13 @@ class RegistrationForm(FlaskForm):
     # email = StringField("Email", [validators.Email()])
     # confirmed_email = StringField("Email", [validators.Email(), validators.EqualTo("email")])
 
+class SearchForm(FlaskForm):
+    class Meta:
+        # Submitted with GET, and only ever reads
+        csrf = False
+
+    q = StringField("Search", [validators.InputRequired()])
+
 class PostForm(FlaskForm):
     content = StringField("Content", [validators.InputRequired()])
 
@@ -26,3 +34,6 @@ class JoinGroup(FlaskForm):
 
 class RenameForm(FlaskForm):
     name = StringField("Name", [validators.InputRequired()])
+
+class ImportUsersForm(FlaskForm):
+    file = FileField("CSV of names", [FileRequired()])
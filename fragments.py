@@ -0,0 +1,101 @@
+'''
+Cache of rendered post HTML.
+
+Posts never change once written, apart from their comment count and the names of their author, wall owner and
+group. Each post's fragment is stored with the comment count and name versions (see namecache.name_version) it
+was rendered with, and is only reused while they all still match, so a rename or a new comment makes the old
+fragment unreachable without having to find it. Entries are evicted least recently used first once the cached
+HTML goes over MAX_BYTES.
+
+Deleted posts don't appear in any listing, so their fragments can't be served even by workers that didn't
+delete them. delete_post still drops the entry in its own worker to free the memory straight away
+'''
+from collections import OrderedDict
+from typing import Callable, Dict
+import os
+import threading
+
+from markupsafe import Markup
+
+import namecache
+
+MAX_BYTES = int(os.environ.get("SOCIALITE_FRAGMENT_CACHE_BYTES", 8 * 1024 * 1024))
+
+class FragmentCache:
+    '''Thread safe LRU of rendered post HTML keyed by post id, bounded by the total size of the HTML'''
+    def __init__(self, max_bytes: int = MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # post id -> (version, html)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, post_id: int, version: tuple) -> Markup | None:
+        '''Returns the HTML cached for post_id if it was rendered at version'''
+        with self.lock:
+            entry = self.entries.get(post_id)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(post_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, post_id: int, version: tuple, html: Markup):
+        '''Stores html for post_id, replacing any older version and evicting the least recently used entries beyond max_bytes'''
+        if len(html) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(post_id, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.entries[post_id] = (version, html)
+            self.size += len(html)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last = False)
+                self.size -= len(evicted)
+
+    def invalidate(self, post_id: int):
+        with self.lock:
+            old = self.entries.pop(post_id, None)
+            if old is not None:
+                self.size -= len(old[1])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+def post_version(post) -> tuple:
+    '''Everything a post's rendered HTML depends on that can change after it was written'''
+    return (
+        post.type,
+        post.comment_count,
+        namecache.name_version("user", post.author_id),
+        namecache.name_version("user", post.wall_owner_id),
+        namecache.name_version("group", post.group_id)
+    )
+
+def render(post, render_post: Callable[[object], str]) -> Markup:
+    '''A post's HTML from the cache, rendering it with render_post (and caching the result) on a miss'''
+    version = post_version(post)
+    html = posts.get(post.id, version)
+    if html is None:
+        html = Markup(render_post(post))
+        posts.put(post.id, version, html)
+    return html
+
+def stats() -> Dict[str, float]:
+    '''Hit / miss counts, hit rate and size of this worker's fragment cache'''
+    lookups = posts.hits + posts.misses
+    return {
+        "hits": posts.hits,
+        "misses": posts.misses,
+        "hit_rate": posts.hits / lookups if lookups else 0.0,
+        "size": len(posts.entries),
+        "bytes": posts.size
+    }
+
+posts = FragmentCache()
@@ -0,0 +1,277 @@
+'''
+Per-request instrumentation, exposed in Prometheus text format at /metrics.
+
+Each request gets a RequestTimings (begin_request / finish_request) recording how long it spent in:
+- SQL, timed by engine event hooks on every Engine
+- the database.py / aiodatabase.py functions it called (see instrument)
+- template rendering
+- password hashing (see passwords.run)
+
+finish_request adds them to per-endpoint histograms, and with SERVER_TIMING on they are sent back in a
+Server-Timing header, so a browser's dev tools show where a slow page spent its time. The times overlap:
+SQL is also part of the database function that ran it, and of the render if a template looked a name up.
+
+Everything is kept per worker process, like the caches whose hit / miss counts /metrics also reports, so a
+multi-worker deployment shows up as one scrape target per worker
+'''
+from sqlalchemy import event, Engine
+from bisect import bisect_left
+from contextvars import ContextVar, Token
+from typing import Callable, Dict, Iterable, List, Tuple
+import functools
+import inspect
+import os
+import threading
+import time
+
+import logging
+log = logging.getLogger("metrics")
+
+# Whether responses carry a Server-Timing header. Off by default, since it tells anyone how long our queries take
+SERVER_TIMING = os.environ.get("SOCIALITE_SERVER_TIMING", "0") == "1"
+
+# What a request's time is broken down into, in Server-Timing order
+KINDS = ("sql", "database", "render", "hashing")
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names: Iterable[str], values: Iterable) -> str:
+    labels = ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+    return "{" + labels + "}" if labels else ""
+
+class Histogram:
+    '''Thread safe Prometheus histogram, with a series of bucket counts, sum and count per combination of labels'''
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...], buckets: Tuple[float, ...] = SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket (not cumulative), sum, count]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def exposition(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(values, list(counts), total, count) for values, (counts, total, count) in sorted(self.series.items())]
+        for values, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), values + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), values + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, values)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, values)} {count}")
+        return lines
+
+class Counter:
+    '''Thread safe Prometheus counter, with a value per combination of labels'''
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def exposition(self) -> List[str]:
+        with self.lock:
+            values = sorted(self.values.items())
+        return sample_lines(self.name, self.help, "counter", ((self.labels, labels, value) for labels, value in values))
+
+def sample_lines(name: str, help: str, type: str, samples: Iterable[Tuple[Tuple[str, ...], tuple, float]]) -> List[str]:
+    '''The exposition of a metric from (label names, label values, value) samples'''
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+    lines.extend(f"{name}{format_labels(names, values)} {value}" for names, values, value in samples)
+    return lines
+
+request_seconds = Histogram("socialite_request_duration_seconds",
+    "Time from the start of a request until its response was ready", ("endpoint", "method"))
+request_kind_seconds = Histogram("socialite_request_time_seconds",
+    "Time a request spent in SQL, database.py functions, template rendering and password hashing", ("endpoint", "kind"))
+request_statements = Histogram("socialite_request_sql_statements",
+    "SQL statements executed per request", ("endpoint",), STATEMENT_BUCKETS)
+database_seconds = Histogram("socialite_database_call_duration_seconds",
+    "Time taken by the database.py functions requests called directly", ("function",))
+name_lookups = Counter("socialite_name_filter_lookups_total",
+    "Names rendered by the sidebar info filters, by whether they had been prefetched for the request", ("kind", "source"))
+
+class RequestTimings:
+    '''What a request has spent its time on so far'''
+    __slots__ = ("started", "spent", "statements", "function", "statement_started", "render_started")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spent = dict.fromkeys(KINDS, 0.0)
+        self.statements = 0
+        # The instrumented function currently running, if any. Calls it makes to other ones are part of it
+        self.function = None
+        self.statement_started = None
+        self.render_started = None
+
+    def server_timing(self) -> str:
+        '''The Server-Timing header for these timings'''
+        total = (time.perf_counter() - self.started) * 1000
+        parts = [f'sql;dur={self.spent["sql"] * 1000:.2f};desc="{self.statements} statements"']
+        parts.extend(f"{kind};dur={self.spent[kind] * 1000:.2f}" for kind in KINDS[1:] if self.spent[kind])
+        parts.append(f"total;dur={total:.2f}")
+        return ", ".join(parts)
+
+# The timings of the request being handled, if there is one
+current: ContextVar[RequestTimings | None] = ContextVar("request_timings", default = None)
+
+def begin_request() -> Token:
+    return current.set(RequestTimings())
+
+def finish_request(endpoint: str | None, method: str) -> RequestTimings | None:
+    '''Adds the current request's timings to the histograms, and returns them'''
+    timings = current.get()
+    if timings is None:
+        return None
+
+    endpoint = endpoint or "unmatched"
+    request_seconds.observe(time.perf_counter() - timings.started, endpoint, method)
+    request_statements.observe(timings.statements, endpoint)
+    for kind, seconds in timings.spent.items():
+        request_kind_seconds.observe(seconds, endpoint, kind)
+    return timings
+
+def end_request(token: Token):
+    current.reset(token)
+
+class timer:
+    '''Context manager adding the time spent in its block to the current request's time in kind'''
+    __slots__ = ("kind", "started")
+
+    def __init__(self, kind: str):
+        self.kind = kind
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        timings = current.get()
+        if timings is not None:
+            timings.spent[self.kind] += time.perf_counter() - self.started
+
+def timed(function: Callable) -> Callable:
+    '''
+    Wraps a function (or coroutine function) so that, during a request, its time goes into the request's
+    database time and into its own histogram. Only the outermost instrumented call is counted
+    '''
+    name = function.__name__
+
+    def enter():
+        timings = current.get()
+        if timings is None or timings.function is not None:
+            return None
+        timings.function = name
+        return timings
+
+    def leave(timings: RequestTimings, started: float):
+        elapsed = time.perf_counter() - started
+        timings.function = None
+        timings.spent["database"] += elapsed
+        database_seconds.observe(elapsed, name)
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            timings = enter()
+            if timings is None:
+                return await function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                leave(timings, started)
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        timings = enter()
+        if timings is None:
+            return function(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            leave(timings, started)
+    return wrapper
+
+def instrument(namespace: dict, module: str, entry_points: Iterable[str] = ("session_scope",)):
+    '''
+    Wraps every function defined in module (whose globals are namespace) that calls one of entry_points (the ways
+    it has of getting a session), or calls a function that does, with timed. Call it at the bottom of the module,
+    before anything imports its functions
+    '''
+    functions = {name: value for name, value in namespace.items()
+                 if inspect.isfunction(value) and value.__module__ == module and not name.startswith("_")}
+    instrumented = set()
+    changed = True
+    while changed:
+        changed = False
+        for name, function in functions.items():
+            names = function.__code__.co_names
+            if name not in instrumented and (set(entry_points).intersection(names) or instrumented.intersection(names)):
+                instrumented.add(name)
+                changed = True
+
+    for name in instrumented:
+        namespace[name] = timed(functions[name])
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_statement(conn, cursor, statement, parameters, context, executemany):
+    timings = current.get()
+    if timings is not None:
+        timings.statement_started = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_statement(conn, cursor, statement, parameters, context, executemany):
+    timings = current.get()
+    if timings is not None and timings.statement_started is not None:
+        timings.spent["sql"] += time.perf_counter() - timings.statement_started
+        timings.statements += 1
+        timings.statement_started = None
+
+def template_started(sender, template, context, **extra):
+    timings = current.get()
+    if timings is not None:
+        timings.render_started = time.perf_counter()
+
+def template_finished(sender, template, context, **extra):
+    timings = current.get()
+    if timings is not None and timings.render_started is not None:
+        timings.spent["render"] += time.perf_counter() - timings.render_started
+        timings.render_started = None
+
+def exposition(caches: Dict[str, Dict[str, float]]) -> str:
+    '''Every metric in Prometheus text format, including the hit / miss counts of caches (name -> stats)'''
+    lines = []
+    for metric in (request_seconds, request_kind_seconds, request_statements, database_seconds, name_lookups):
+        lines.extend(metric.exposition())
+    for name, help, type, stat in (
+        ("socialite_cache_hits_total", "Lookups answered by a cache", "counter", "hits"),
+        ("socialite_cache_misses_total", "Lookups a cache had to load or render", "counter", "misses"),
+        ("socialite_cache_entries", "Entries currently in a cache", "gauge", "size"),
+    ):
+        lines.extend(sample_lines(name, help, type, ((("cache",), (cache,), stats[stat]) for cache, stats in caches.items())))
+    return "\n".join(lines) + "\n"
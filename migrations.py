@@ -0,0 +1,401 @@
+'''
+Versioned, in place upgrades of the sqlite database.
+
+The schema version is stored in the database header (PRAGMA user_version). MIGRATIONS[n] upgrades a
+database from version n to n + 1, and each one runs in its own transaction together with the version bump,
+so an interrupted upgrade leaves the file at the last version that completed.
+Migrations are plain SQL on purpose: they describe the schema as it was when they were written, not the
+current ORM models in database.py. A new database skips them: create() makes the ORM models' tables and adds
+what only migrations describe (see finish_schema)
+'''
+import os
+import sqlite3
+from typing import Tuple
+
+import logging
+log = logging.getLogger("migrations")
+
+def add_hot_path_indexes(db: sqlite3.Connection):
+    '''Secondary indexes for the columns every page filters and sorts on'''
+    db.execute("CREATE INDEX IF NOT EXISTS ix_wall_posts_wall ON wall_posts (wall_id, publish_datetime)")
+    db.execute("CREATE INDEX IF NOT EXISTS ix_group_posts_group ON group_posts (group_id, publish_datetime)")
+    db.execute("CREATE INDEX IF NOT EXISTS ix_wall_post_comments_post ON wall_post_comments (post_id, publish_datetime)")
+    db.execute("CREATE INDEX IF NOT EXISTS ix_group_post_comments_post ON group_post_comments (post_id, publish_datetime)")
+    db.execute("CREATE INDEX IF NOT EXISTS ix_group_memberships_group ON group_memberships (group_id, member_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS ix_friendships_second ON friendships (second, first)")
+
+def add_timeline(db: sqlite3.Connection):
+    '''The materialized home feed. Older databases may already have it from `flask rebuild-timeline`'''
+    db.execute('''CREATE TABLE IF NOT EXISTS timeline_entries (
+        user_id INTEGER NOT NULL,
+        publish_datetime INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        post_type VARCHAR NOT NULL,
+        PRIMARY KEY (user_id, publish_datetime, post_id, post_type),
+        FOREIGN KEY(user_id) REFERENCES users (id)
+    )''')
+    db.execute("CREATE INDEX IF NOT EXISTS ix_timeline_entries_post ON timeline_entries (post_type, post_id)")
+
+def canonical_friendships(db: sqlite3.Connection):
+    '''
+    Stores each friendship once as (low id, high id) with an explicit requester column.
+    Previously the requester was always first. If both users requested each other, an accepted row wins, and
+    otherwise the earlier request
+    '''
+    db.execute('''CREATE TABLE friendships_canonical (
+        first INTEGER NOT NULL,
+        second INTEGER NOT NULL,
+        requester_id INTEGER NOT NULL,
+        is_request BOOLEAN NOT NULL,
+        PRIMARY KEY (first, second),
+        CHECK (first < second),
+        FOREIGN KEY(first) REFERENCES users (id),
+        FOREIGN KEY(second) REFERENCES users (id),
+        FOREIGN KEY(requester_id) REFERENCES users (id)
+    )''')
+    db.execute('''INSERT OR IGNORE INTO friendships_canonical (first, second, requester_id, is_request)
+        SELECT min(first, second), max(first, second), first, is_request FROM friendships
+        WHERE first != second
+        ORDER BY is_request ASC, rowid ASC''')
+    db.execute("DROP TABLE friendships")
+    db.execute("ALTER TABLE friendships_canonical RENAME TO friendships")
+    db.execute("CREATE INDEX ix_friendships_second ON friendships (second, first)")
+
+def add_name_changes(db: sqlite3.Connection):
+    '''Log of user and group name changes that keeps every worker's name cache coherent'''
+    db.execute('''CREATE TABLE name_changes (
+        seq INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        kind VARCHAR NOT NULL,
+        entity_id INTEGER NOT NULL
+    )''')
+
+def add_comment_counts(db: sqlite3.Connection):
+    '''Denormalized comment counts on posts, backfilled from the comment tables'''
+    for posts, comments in (("wall_posts", "wall_post_comments"), ("group_posts", "group_post_comments")):
+        db.execute(f"ALTER TABLE {posts} ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0")
+        db.execute(f"UPDATE {posts} SET comment_count = (SELECT count(*) FROM {comments} WHERE {comments}.post_id = {posts}.id)")
+
+def unify_walls(db: sqlite3.Connection):
+    '''
+    Replaces the wall and group post / comment tables with one posts table keyed by a wall, where every user
+    and every group has a wall, and one comments table. Wall posts and comments keep their ids and group ones
+    are moved past them. The timeline is rewritten to match, since a post no longer needs a type to be found
+    '''
+    db.execute('''CREATE TABLE walls (
+        id INTEGER NOT NULL PRIMARY KEY,
+        type VARCHAR NOT NULL,
+        user_id INTEGER UNIQUE,
+        group_id INTEGER UNIQUE,
+        CONSTRAINT ck_walls_owner CHECK ((type = 'user' AND user_id IS NOT NULL AND group_id IS NULL) OR
+            (type = 'group' AND group_id IS NOT NULL AND user_id IS NULL)),
+        FOREIGN KEY(user_id) REFERENCES users (id),
+        FOREIGN KEY(group_id) REFERENCES groups (id)
+    )''')
+    db.execute("INSERT INTO walls (type, user_id) SELECT 'user', id FROM users ORDER BY id")
+    db.execute("INSERT INTO walls (type, group_id) SELECT 'group', id FROM groups ORDER BY id")
+
+    db.execute('''CREATE TABLE posts (
+        id INTEGER NOT NULL PRIMARY KEY,
+        content VARCHAR NOT NULL,
+        author_id INTEGER NOT NULL,
+        wall_id INTEGER NOT NULL,
+        publish_datetime INTEGER NOT NULL,
+        comment_count INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY(author_id) REFERENCES users (id),
+        FOREIGN KEY(wall_id) REFERENCES walls (id)
+    )''')
+    db.execute('''CREATE TABLE comments (
+        id INTEGER NOT NULL PRIMARY KEY,
+        content VARCHAR NOT NULL,
+        author_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        publish_datetime INTEGER NOT NULL,
+        FOREIGN KEY(author_id) REFERENCES users (id),
+        FOREIGN KEY(post_id) REFERENCES posts (id)
+    )''')
+
+    post_offset = db.execute("SELECT coalesce(max(id), 0) FROM wall_posts").fetchone()[0]
+    comment_offset = db.execute("SELECT coalesce(max(id), 0) FROM wall_post_comments").fetchone()[0]
+
+    db.execute('''INSERT INTO posts (id, content, author_id, wall_id, publish_datetime, comment_count)
+        SELECT wall_posts.id, content, author_id, walls.id, publish_datetime, comment_count
+        FROM wall_posts JOIN walls ON walls.user_id = wall_posts.wall_id''')
+    db.execute('''INSERT INTO posts (id, content, author_id, wall_id, publish_datetime, comment_count)
+        SELECT group_posts.id + ?, content, author_id, walls.id, publish_datetime, comment_count
+        FROM group_posts JOIN walls ON walls.group_id = group_posts.group_id''', (post_offset,))
+
+    db.execute('''INSERT INTO comments (id, content, author_id, post_id, publish_datetime)
+        SELECT id, content, author_id, post_id, publish_datetime FROM wall_post_comments
+        WHERE post_id IN (SELECT id FROM posts)''')
+    db.execute('''INSERT INTO comments (id, content, author_id, post_id, publish_datetime)
+        SELECT id + ?, content, author_id, post_id + ?, publish_datetime FROM group_post_comments
+        WHERE post_id + ? IN (SELECT id FROM posts)''', (comment_offset, post_offset, post_offset))
+
+    db.execute('''CREATE TABLE timeline_entries_unified (
+        user_id INTEGER NOT NULL,
+        publish_datetime INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        PRIMARY KEY (user_id, publish_datetime, post_id),
+        FOREIGN KEY(user_id) REFERENCES users (id),
+        FOREIGN KEY(post_id) REFERENCES posts (id)
+    )''')
+    db.execute('''INSERT OR IGNORE INTO timeline_entries_unified (user_id, publish_datetime, post_id)
+        SELECT user_id, publish_datetime, CASE post_type WHEN 'group' THEN post_id + ? ELSE post_id END
+        FROM timeline_entries''', (post_offset,))
+    db.execute("DROP TABLE timeline_entries")
+    db.execute("ALTER TABLE timeline_entries_unified RENAME TO timeline_entries")
+
+    for table in ("wall_post_comments", "group_post_comments", "wall_posts", "group_posts"):
+        db.execute(f"DROP TABLE {table}")
+
+    db.execute("CREATE INDEX ix_posts_wall ON posts (wall_id, publish_datetime)")
+    db.execute("CREATE INDEX ix_comments_post ON comments (post_id, publish_datetime)")
+    db.execute("CREATE INDEX ix_timeline_entries_post ON timeline_entries (post_id)")
+
+SEARCH_INDEXES = (("posts_search", "posts"), ("comments_search", "comments"))
+
+def add_search(db: sqlite3.Connection):
+    '''
+    FTS5 indexes over the content of posts and comments. They are external content tables (the text is only
+    stored once, in posts / comments), kept in sync by triggers so every way of writing or deleting a row is
+    covered, and built here from the existing rows
+    '''
+    for index, table in SEARCH_INDEXES:
+        db.execute(f'''CREATE VIRTUAL TABLE {index} USING fts5(
+            content, content = '{table}', content_rowid = 'id', tokenize = 'unicode61 remove_diacritics 2'
+        )''')
+        db.execute(f"INSERT INTO {index} ({index}) VALUES ('rebuild')")
+    add_search_triggers(db)
+
+def add_search_triggers(db: sqlite3.Connection):
+    '''The triggers that keep the search indexes in step with posts and comments'''
+    for index, table in SEARCH_INDEXES:
+        db.execute(f'''CREATE TRIGGER {index}_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {index} (rowid, content) VALUES (new.id, new.content);
+        END''')
+        db.execute(f'''CREATE TRIGGER {index}_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {index} ({index}, rowid, content) VALUES ('delete', old.id, old.content);
+        END''')
+        db.execute(f'''CREATE TRIGGER {index}_update AFTER UPDATE OF content ON {table} BEGIN
+            INSERT INTO {index} ({index}, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO {index} (rowid, content) VALUES (new.id, new.content);
+        END''')
+
+def rebuild_table(db: sqlite3.Connection, table: str, definition: str):
+    '''
+    Replaces a table with one of the same columns but a new definition, keeping its rows.
+    sqlite can't alter constraints in place. Dropping the old table drops its indexes and triggers too.
+    Rows are copied by column name, since hand edited databases don't all have their columns in the same order
+    '''
+    db.execute(f"CREATE TABLE {table}_rebuilt ({definition})")
+    columns = ", ".join(f'"{name}"' for _, name, *_ in db.execute(f"PRAGMA table_info({table}_rebuilt)"))
+    db.execute(f"INSERT INTO {table}_rebuilt ({columns}) SELECT {columns} FROM {table}")
+    db.execute(f"DROP TABLE {table}")
+    db.execute(f"ALTER TABLE {table}_rebuilt RENAME TO {table}")
+
+def cascade_deletes(db: sqlite3.Connection):
+    '''
+    Makes every foreign key ON DELETE CASCADE, so deleting a user, group, wall or post deletes everything that
+    belongs to it in the same statement, and indexes the child side of every foreign key so those deletes
+    don't scan. Walls may also be 'deleted': detached from their owner while their posts are reclaimed.
+    Rows that were already orphaned (foreign keys weren't enforced before) are deleted
+    '''
+    rebuild_table(db, "walls", '''
+        id INTEGER NOT NULL PRIMARY KEY,
+        type VARCHAR NOT NULL,
+        user_id INTEGER UNIQUE,
+        group_id INTEGER UNIQUE,
+        CONSTRAINT ck_walls_owner CHECK ((type = 'user' AND user_id IS NOT NULL AND group_id IS NULL) OR
+            (type = 'group' AND group_id IS NOT NULL AND user_id IS NULL) OR
+            (type = 'deleted' AND user_id IS NULL AND group_id IS NULL)),
+        FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE,
+        FOREIGN KEY(group_id) REFERENCES groups (id) ON DELETE CASCADE
+    ''')
+    rebuild_table(db, "posts", '''
+        id INTEGER NOT NULL PRIMARY KEY,
+        content VARCHAR NOT NULL,
+        author_id INTEGER NOT NULL,
+        wall_id INTEGER NOT NULL,
+        publish_datetime INTEGER NOT NULL,
+        comment_count INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY(author_id) REFERENCES users (id) ON DELETE CASCADE,
+        FOREIGN KEY(wall_id) REFERENCES walls (id) ON DELETE CASCADE
+    ''')
+    rebuild_table(db, "comments", '''
+        id INTEGER NOT NULL PRIMARY KEY,
+        content VARCHAR NOT NULL,
+        author_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        publish_datetime INTEGER NOT NULL,
+        FOREIGN KEY(author_id) REFERENCES users (id) ON DELETE CASCADE,
+        FOREIGN KEY(post_id) REFERENCES posts (id) ON DELETE CASCADE
+    ''')
+    rebuild_table(db, "friendships", '''
+        first INTEGER NOT NULL,
+        second INTEGER NOT NULL,
+        requester_id INTEGER NOT NULL,
+        is_request BOOLEAN NOT NULL,
+        PRIMARY KEY (first, second),
+        CHECK (first < second),
+        FOREIGN KEY(first) REFERENCES users (id) ON DELETE CASCADE,
+        FOREIGN KEY(second) REFERENCES users (id) ON DELETE CASCADE,
+        FOREIGN KEY(requester_id) REFERENCES users (id) ON DELETE CASCADE
+    ''')
+    rebuild_table(db, "group_memberships", '''
+        member_id INTEGER NOT NULL,
+        group_id INTEGER NOT NULL,
+        is_admin BOOLEAN NOT NULL,
+        PRIMARY KEY (member_id, group_id),
+        FOREIGN KEY(member_id) REFERENCES users (id) ON DELETE CASCADE,
+        FOREIGN KEY(group_id) REFERENCES groups (id) ON DELETE CASCADE
+    ''')
+    rebuild_table(db, "private_messages", '''
+        id INTEGER NOT NULL PRIMARY KEY,
+        author_id INTEGER NOT NULL,
+        recipient_id INTEGER NOT NULL,
+        content VARCHAR NOT NULL,
+        FOREIGN KEY(author_id) REFERENCES users (id) ON DELETE CASCADE,
+        FOREIGN KEY(recipient_id) REFERENCES users (id) ON DELETE CASCADE
+    ''')
+    rebuild_table(db, "timeline_entries", '''
+        user_id INTEGER NOT NULL,
+        publish_datetime INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        PRIMARY KEY (user_id, publish_datetime, post_id),
+        FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE,
+        FOREIGN KEY(post_id) REFERENCES posts (id) ON DELETE CASCADE
+    ''')
+
+    db.execute("CREATE INDEX ix_posts_wall ON posts (wall_id, publish_datetime)")
+    db.execute("CREATE INDEX ix_posts_author ON posts (author_id)")
+    db.execute("CREATE INDEX ix_comments_post ON comments (post_id, publish_datetime)")
+    db.execute("CREATE INDEX ix_comments_author ON comments (author_id)")
+    db.execute("CREATE INDEX ix_friendships_second ON friendships (second, first)")
+    db.execute("CREATE INDEX ix_friendships_requester ON friendships (requester_id)")
+    db.execute("CREATE INDEX ix_group_memberships_group ON group_memberships (group_id, member_id)")
+    db.execute("CREATE INDEX ix_private_messages_author ON private_messages (author_id)")
+    db.execute("CREATE INDEX ix_private_messages_recipient ON private_messages (recipient_id)")
+    db.execute("CREATE INDEX ix_timeline_entries_post ON timeline_entries (post_id)")
+    add_search_triggers(db)
+
+    # Deleting an orphan may orphan the rows below it, since foreign keys are off on this connection
+    orphans = 0
+    while True:
+        rows = db.execute("PRAGMA foreign_key_check").fetchall()
+        if not rows:
+            break
+        for table, rowid, _, _ in rows:
+            db.execute(f"DELETE FROM {table} WHERE rowid = ?", (rowid,))
+        orphans += len(rows)
+    if orphans:
+        log.warning(f"Deleted {orphans} rows that referenced users, groups, walls or posts that no longer exist")
+
+MIGRATIONS = [
+    add_hot_path_indexes,
+    add_timeline,
+    canonical_friendships,
+    add_name_changes,
+    add_comment_counts,
+    unify_walls,
+    add_search,
+    cascade_deletes,
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+def connect(path: str) -> sqlite3.Connection:
+    '''
+    Opens an existing database in autocommit mode so migrations control their own transactions (DDL included).
+    sqlite would create an empty file at a path with no database, so a missing one raises FileNotFoundError instead
+    '''
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"There is no database at {path}")
+    return sqlite3.connect(path, isolation_level = None)
+
+def is_empty(path: str) -> bool:
+    '''Checks that there is no database at path, or one without any schema (e.g. an empty file)'''
+    if not os.path.exists(path):
+        return True
+    db = connect(path)
+    try:
+        return db.execute("SELECT count(*) FROM sqlite_master").fetchone()[0] == 0
+    finally:
+        db.close()
+
+def create_tables(path: str):
+    '''Creates the ORM models' tables in a new database, which finish_schema then brings up to the latest version'''
+    # Only creating a database needs the models. Upgrades mustn't depend on them
+    import database
+    engine = database.make_engine(f"sqlite:///{path}")
+    try:
+        database.Base.metadata.create_all(engine)
+    finally:
+        engine.dispose()
+
+def finish_schema(db: sqlite3.Connection):
+    '''
+    Adds the schema only migrations describe to a database from create_tables, indexing any rows already
+    inserted, and marks it current
+    '''
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        add_search(db)
+        db.execute(f"PRAGMA user_version = {LATEST_VERSION}")
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+
+def create(path: str):
+    '''Creates an empty database at the latest schema version at path, which must not have any schema yet'''
+    create_tables(path)
+    db = connect(path)
+    try:
+        finish_schema(db)
+    finally:
+        db.close()
+
+def schema_version(db: sqlite3.Connection) -> int:
+    '''Returns the schema version recorded in the database'''
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+def is_current(path: str) -> bool:
+    '''Checks that a database has had every migration applied. Raises FileNotFoundError if there is no database'''
+    db = connect(path)
+    try:
+        return schema_version(db) == LATEST_VERSION
+    finally:
+        db.close()
+
+def migrate(path: str, target: int = LATEST_VERSION) -> Tuple[int, int]:
+    '''
+    Applies every pending migration up to target to the database at path, or creates it at the latest version
+    if there is no database there yet (or only an empty file). Returns the (old, new) schema versions
+    '''
+    if is_empty(path):
+        log.info(f"Creating {path} at schema version {LATEST_VERSION}")
+        create(path)
+        return 0, LATEST_VERSION
+
+    db = connect(path)
+    try:
+        start = schema_version(db)
+        if start > LATEST_VERSION:
+            raise RuntimeError(f"{path} is at schema version {start}, which is newer than this code ({LATEST_VERSION})")
+
+        for version in range(start, target):
+            migration = MIGRATIONS[version]
+            log.info(f"Migrating {path} from version {version} to {version + 1} ({migration.__name__})")
+
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                migration(db)
+                db.execute(f"PRAGMA user_version = {version + 1}")
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+        return start, max(start, target)
+    finally:
+        db.close()
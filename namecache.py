@@ -0,0 +1,211 @@
+'''
+Display name cache shared coherently between worker processes.
+
+Every worker keeps a bounded LRU of sidebar infos. Coherence comes from the name_changes table in the
+database, which all workers see: renames, group creation and group deletion append a row to it in the same
+transaction as the change. The row's seq is the version of that entity's name, and the highest seq a worker
+has applied is its watermark. sync() is called at the start of each request and evicts every entry changed
+since the watermark, so a rename is visible to every worker by its next request.
+
+The identity cache behind load_user lives here too, so renames evict it the same way.
+
+name_version() exposes the seqs as versions for caches of things that embed names (see fragments.py)
+'''
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+import threading
+import time
+
+import database
+
+import logging
+log = logging.getLogger("namecache")
+
+class NameCache:
+    '''Thread safe LRU of one kind of entity (users or groups), filled in batches by load_many'''
+    def __init__(self, kind: str, load_many: Callable[[Iterable[int]], Dict[int, object]], maxsize: int = 4096):
+        self.kind = kind
+        self.load_many = load_many
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, ids: Iterable[int]) -> Tuple[Dict[int, object], Set[int]]:
+        '''Splits ids into the infos that are cached and the ids that aren't, without loading anything'''
+        found = {}
+        missing = set()
+        with self.lock:
+            for id in ids:
+                if id in found or id in missing:
+                    continue
+                if id in self.entries:
+                    self.entries.move_to_end(id)
+                    found[id] = self.entries[id]
+                else:
+                    missing.add(id)
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def get_many(self, ids: Iterable[int]) -> Dict[int, object]:
+        '''Returns the infos for ids, loading every miss with a single load_many call. Unknown ids are left out'''
+        found, missing = self.lookup(ids)
+        if missing:
+            loaded = self.load_many(missing)
+            self.put_many(loaded)
+            found.update(loaded)
+
+        return found
+
+    def get(self, id: int):
+        '''Returns the info for a single id, or None if it doesn't exist'''
+        return self.get_many((id,)).get(id)
+
+    def put_many(self, infos: Dict[int, object]):
+        '''Inserts infos, evicting the least recently used entries beyond maxsize'''
+        with self.lock:
+            for id, info in infos.items():
+                self.entries[id] = info
+                self.entries.move_to_end(id)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)
+
+    def invalidate(self, id: int):
+        with self.lock:
+            self.entries.pop(id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class IdentityCache:
+    '''
+    Thread safe cache of the (name, is_teacher) identity load_user needs, keyed by user id. Entries expire
+    after ttl seconds, which bounds staleness for anything the name change log doesn't cover
+    '''
+    def __init__(self, load: Callable[[int], Tuple[str, bool] | None], ttl: float = 60, maxsize: int = 4096):
+        self.load = load
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, id: int) -> Tuple[str, bool] | None:
+        '''Returns the cached identity of a user, or None on a miss, without loading anything'''
+        with self.lock:
+            entry = self.entries.get(id)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, id: int, identity: Tuple[str, bool]):
+        with self.lock:
+            self.entries[id] = (time.monotonic() + self.ttl, identity)
+            self.entries.move_to_end(id)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)
+
+    def get(self, id: int) -> Tuple[str, bool] | None:
+        '''Returns the identity of a user, or None if they don't exist (which is never cached)'''
+        identity = self.lookup(id)
+        if identity is None:
+            identity = self.load(id)
+            if identity is not None:
+                self.put(id, identity)
+        return identity
+
+    def invalidate(self, id: int):
+        with self.lock:
+            self.entries.pop(id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+def stats() -> Dict[str, Dict[str, float]]:
+    '''Hit / miss counts and hit rate of every cache in this worker'''
+    result = {}
+    for name, cache in (("users", users), ("groups", groups), ("identities", identities)):
+        lookups = cache.hits + cache.misses
+        result[name] = {
+            "hits": cache.hits,
+            "misses": cache.misses,
+            "hit_rate": cache.hits / lookups if lookups else 0.0,
+            "size": len(cache.entries)
+        }
+    return result
+
+users = NameCache("user", database.get_sidebar_user_infos)
+groups = NameCache("group", database.get_sidebar_group_infos)
+caches = {cache.kind: cache for cache in (users, groups)}
+identities = IdentityCache(database.grab_info_for)
+
+watermark = None
+watermark_lock = threading.Lock()
+
+# (kind, entity id) -> seq of the newest change to its name this worker has seen. Entities missing from it are at
+# version 0. generation is bumped whenever versions have to be forgotten, which changes every version at once
+MAX_VERSIONS = 65536
+versions: Dict[Tuple[str, int], int] = {}
+generation = 0
+
+def name_version(kind: str, entity_id: int | None) -> Tuple[int, int]:
+    '''The version of a user's or group's name as of the last sync. It changes whenever the name does'''
+    return generation, versions.get((kind, entity_id), 0)
+
+def forget_versions():
+    global generation
+    versions.clear()
+    generation += 1
+
+def sync():
+    '''Evicts every entry whose name changed in any worker since the last sync'''
+    global watermark
+    with watermark_lock:
+        if watermark is None:
+            # Nothing cached yet, so there is nothing to evict: just start from the newest change
+            watermark = database.latest_name_change()
+            return
+
+        apply_changes(database.name_changes_since(watermark))
+
+def apply_changes(changes: List):
+    '''
+    Evicts the entries named by changes (rows of database.name_changes_since(watermark)). Call with
+    watermark_lock held. Changes the watermark has already passed are skipped
+    '''
+    global watermark
+    changes = [change for change in changes if change.seq > watermark]
+    if not changes:
+        return
+
+    if changes[0].seq != watermark + 1:
+        # Old changes were pruned before this worker saw them, so we can't tell what is stale
+        log.info("Name change log was pruned past this worker's watermark, clearing name caches")
+        for cache in caches.values():
+            cache.clear()
+        identities.clear()
+        forget_versions()
+    else:
+        if len(versions) + len(changes) > MAX_VERSIONS:
+            forget_versions()
+        for change in changes:
+            caches[change.kind].invalidate(change.entity_id)
+            versions[(change.kind, change.entity_id)] = change.seq
+            if change.kind == "user":
+                identities.invalidate(change.entity_id)
+
+    watermark = changes[-1].seq
+
+def warm(limit: int = 1024):
+    '''Pre-fills the caches with up to limit users and groups, e.g. at startup'''
+    sync()
+    users.put_many(database.get_sidebar_user_infos(database.some_user_ids(limit)))
+    groups.put_many(database.get_sidebar_group_infos(database.some_group_ids(limit)))
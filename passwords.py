@@ -0,0 +1,141 @@
+'''
+Argon2 password hashing off the request threads.
+
+Hashing and verifying run on a bounded pool of worker threads (argon2-cffi releases the GIL while it works),
+so a burst of logins can only ever occupy POOL_SIZE cores and the rest of the site keeps serving. Requests
+beyond MAX_PENDING waiting jobs are refused straight away with HashingOverloaded instead of queueing behind
+each other. The Argon2 parameters come from .argon2_params (written by `flask calibrate-argon2`) when it exists
+'''
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Callable, List
+import multiprocessing
+import json
+import os
+import threading
+import time
+
+from argon2 import PasswordHasher
+import argon2.exceptions as exceptions
+
+import metrics
+
+import logging
+log = logging.getLogger("passwords")
+
+PARAMS_FILE = ".argon2_params"
+
+POOL_SIZE = int(os.environ.get("SOCIALITE_HASH_THREADS", os.cpu_count() or 1))
+MAX_PENDING = int(os.environ.get("SOCIALITE_HASH_QUEUE", POOL_SIZE * 4))
+
+class HashingOverloaded(Exception):
+    '''Raised when too many hashing jobs are already waiting'''
+    pass
+
+def load_hasher(path: str = PARAMS_FILE) -> PasswordHasher:
+    '''A PasswordHasher using the calibrated parameters in path, or argon2's defaults if there aren't any'''
+    try:
+        with open(path, "r") as f:
+            params = json.load(f)
+    except FileNotFoundError:
+        return PasswordHasher()
+
+    log.info(f"Using argon2 parameters {params}")
+    return PasswordHasher(**params)
+
+ph = load_hasher()
+pool = ThreadPoolExecutor(max_workers = POOL_SIZE, thread_name_prefix = "argon2")
+slots = threading.BoundedSemaphore(MAX_PENDING)
+
+def run(job: Callable, *args):
+    '''Runs job on the hashing pool and waits for its result, unless MAX_PENDING jobs are already waiting'''
+    if not slots.acquire(blocking = False):
+        raise HashingOverloaded()
+    try:
+        with metrics.timer("hashing"):
+            return pool.submit(job, *args).result()
+    finally:
+        slots.release()
+
+def _verify(password_hash: str, password: str) -> bool:
+    try:
+        return ph.verify(password_hash, password)
+    except exceptions.VerifyMismatchError:
+        return False
+
+def verify(password_hash: str, password: str) -> bool:
+    '''Checks a password against a stored hash'''
+    return run(_verify, password_hash, password)
+
+def hash(password: str) -> str:
+    '''Hashes a password with the current parameters'''
+    return run(ph.hash, password)
+
+def _hash_with(params: dict, password: str) -> str:
+    return PasswordHasher(**params).hash(password)
+
+# Batches up to this size (a class) are hashed on the request pool's threads, so they never wait for bulk_pool to start
+SMALL_BATCH = 32
+BULK_WORKERS = int(os.environ.get("SOCIALITE_BULK_HASH_PROCESSES", os.cpu_count() or 1))
+
+bulk_lock = threading.Lock()
+bulk_processes: ProcessPoolExecutor | None = None
+
+def bulk_pool() -> ProcessPoolExecutor:
+    '''
+    The process pool hash_many uses for large batches, started on first use and kept for the life of the process.
+    It bypasses the request pool and its admission control, so only use it from teacher / admin tools
+    '''
+    global bulk_processes
+    with bulk_lock:
+        if bulk_processes is None:
+            # spawn rather than fork: this can be called from a threaded web server
+            bulk_processes = ProcessPoolExecutor(max_workers = BULK_WORKERS, mp_context = multiprocessing.get_context("spawn"))
+        return bulk_processes
+
+def hash_many(passwords: List[str]) -> List[str]:
+    '''Hashes a batch of passwords with the current parameters, across bulk_pool unless it's a small one'''
+    if len(passwords) <= SMALL_BATCH:
+        return list(pool.map(ph.hash, passwords))
+
+    params = {"time_cost": ph.time_cost, "memory_cost": ph.memory_cost, "parallelism": ph.parallelism,
+              "hash_len": ph.hash_len, "salt_len": ph.salt_len}
+    chunksize = max(1, len(passwords) // (BULK_WORKERS * 4))
+    return list(bulk_pool().map(_hash_with, [params] * len(passwords), passwords, chunksize = chunksize))
+
+def needs_rehash(password_hash: str) -> bool:
+    '''Checks if a stored hash was made with different parameters than the current ones. Cheap, no hashing'''
+    return ph.check_needs_rehash(password_hash)
+
+def calibrate(target_ms: float, parallelism: int | None = None, max_memory_kib: int = 262144) -> dict:
+    '''
+    Picks the strongest Argon2 parameters whose verify takes no longer than target_ms on this machine.
+    Memory is the main cost: it is doubled up to max_memory_kib while a single pass stays under target,
+    then extra passes (time_cost) are added while they fit
+    '''
+    parallelism = parallelism or min(4, os.cpu_count() or 1)
+
+    def measure(time_cost: int, memory_cost: int) -> float:
+        hasher = PasswordHasher(time_cost = time_cost, memory_cost = memory_cost, parallelism = parallelism)
+        password_hash = hasher.hash("calibration")
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            hasher.verify(password_hash, "calibration")
+            elapsed = (time.perf_counter() - start) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    memory_cost = 8192
+    while memory_cost * 2 <= max_memory_kib and measure(1, memory_cost * 2) <= target_ms:
+        memory_cost *= 2
+
+    time_cost = 1
+    while measure(time_cost + 1, memory_cost) <= target_ms:
+        time_cost += 1
+
+    return {"time_cost": time_cost, "memory_cost": memory_cost, "parallelism": parallelism}
+
+def save_params(params: dict, path: str = PARAMS_FILE):
+    '''Writes parameters for load_hasher to pick up on the next start'''
+    with open(path, "w") as f:
+        json.dump(params, f)
@@ -0,0 +1,102 @@
+'''
+Bulk account creation from a CSV of names, for teachers setting up a class or a whole school.
+
+The CSV is streamed in batches of BATCH_SIZE rows. Each batch gets generated initial passwords, hashed together
+(see passwords.hash_many), and is inserted in a single transaction. Problems are reported per row rather than
+aborting the import
+'''
+from typing import Iterable, Iterator, List, TextIO, Tuple
+import csv
+import secrets
+
+import database
+import passwords
+
+import logging
+log = logging.getLogger("provisioning")
+
+BATCH_SIZE = 500
+
+class ImportResult:
+    '''The outcome of one CSV row: the account's initial password, or why it wasn't created'''
+    def __init__(self, line: int, name: str, password: str | None = None, error: str | None = None, is_teacher: bool = False):
+        self.line = line
+        self.name = name
+        self.is_teacher = is_teacher
+        self.password = password
+        self.error = error
+
+def read_rows(stream: TextIO) -> Iterator[Tuple[int, str, bool]]:
+    '''
+    Yields (line, name, is_teacher) for each row of a CSV whose first column is the name and whose optional
+    second column marks teachers (yes / true / 1). A header row starting with "name" is skipped
+    '''
+    for line, row in enumerate(csv.reader(stream), start = 1):
+        if not row or not "".join(row).strip():
+            continue
+        if line == 1 and row[0].strip().lower() == "name":
+            continue
+
+        is_teacher = len(row) > 1 and row[1].strip().lower() in ("yes", "true", "1", "teacher")
+        yield line, row[0].strip(), is_teacher
+
+def generate_password() -> str:
+    '''A random initial password for a new account, handed out in the import report'''
+    return secrets.token_urlsafe(9)
+
+def batched(rows: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def import_users(stream: TextIO) -> List[ImportResult]:
+    '''Creates an account for every row of a CSV (see read_rows). Returns one result per row'''
+    results = []
+    seen = set()
+
+    for batch in batched(read_rows(stream), BATCH_SIZE):
+        accepted = []
+        taken = database.existing_user_names(name for _, name, _ in batch)
+        for line, name, is_teacher in batch:
+            if not name:
+                results.append(ImportResult(line, name, error = "missing name"))
+            elif name in seen:
+                results.append(ImportResult(line, name, error = "duplicate name in this file"))
+            elif name in taken:
+                results.append(ImportResult(line, name, error = "name already taken"))
+            else:
+                seen.add(name)
+                accepted.append(ImportResult(line, name, password = generate_password(), is_teacher = is_teacher))
+
+        hashes = passwords.hash_many([result.password for result in accepted])
+        rows = [{
+            "name": result.name,
+            "password": password_hash,
+            "password_reset_on_next_login": False,
+            "student_requests_password_change": False,
+            "is_teacher": result.is_teacher
+        } for result, password_hash in zip(accepted, hashes)]
+
+        if not database.insert_users(rows):
+            # Somebody took a name since we checked: insert one by one to find out which
+            for result, row in zip(accepted, rows):
+                if not database.insert_users([row]):
+                    result.password = None
+                    result.error = "could not be created (name taken?)"
+
+        results.extend(accepted)
+        log.info(f"Imported a batch of {len(accepted)} accounts")
+
+    return sorted(results, key = lambda result: result.line)
+
+def write_report(results: List[ImportResult], stream: TextIO):
+    '''Writes a CSV of line, name, initial password and error for handing out the new accounts'''
+    writer = csv.writer(stream)
+    writer.writerow(["line", "name", "password", "error"])
+    for result in results:
+        writer.writerow([result.line, result.name, result.password or "", result.error or ""])
@@ -0,0 +1,152 @@
+'''
+Development mode N+1 and slow query detector.
+
+While a request is being recorded (begin_request / finish_request), every SQL statement it runs is reduced to a
+fingerprint: its text with literals and the lengths of IN lists taken out, so the same query for different ids
+has the same fingerprint. Each statement is attributed to the database.py / aiodatabase.py function that issued
+it, which is the outermost instrumented function running at the time (see metrics.timed), also when the write
+queue runs it on its writer thread.
+
+When the request ends, a summary of its statements per function is logged, with a warning for every fingerprint
+run more than REPEAT_LIMIT times (usually a query in a loop that should be one batched query). Statements
+slower than SLOW_QUERY_MS are logged straight away with their EXPLAIN QUERY PLAN.
+
+It is on under `flask run --debug`, or anywhere with SOCIALITE_SQL_DEBUG=1. The EXPLAINs and logging cost far
+more than the statements themselves, so leave it off in production
+'''
+from sqlalchemy import event, Engine
+from collections import Counter
+from contextvars import ContextVar, Token
+from typing import Dict, List, Tuple
+import os
+import re
+import time
+
+import metrics
+
+import logging
+log = logging.getLogger("sqldebug")
+# Only recorded requests log anything, and their summaries are info
+log.setLevel(logging.INFO)
+
+ENABLED = os.environ.get("SOCIALITE_SQL_DEBUG", "0") == "1"
+REPEAT_LIMIT = int(os.environ.get("SOCIALITE_SQL_REPEAT_LIMIT", 5))
+SLOW_QUERY_MS = float(os.environ.get("SOCIALITE_SLOW_QUERY_MS", 25))
+
+# What statements issued outside any instrumented database function are attributed to
+NO_FUNCTION = "(no database function)"
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+WHITESPACE = re.compile(r"\s+")
+
+def fingerprint(statement: str) -> str:
+    '''statement without its literals, IN list lengths and formatting: the same for every run of the same query'''
+    statement = STRING_LITERAL.sub("?", statement)
+    statement = NUMBER_LITERAL.sub("?", statement)
+    statement = PLACEHOLDER_LIST.sub("(?, ...)", statement)
+    return WHITESPACE.sub(" ", statement).strip()
+
+class Statements:
+    '''The statements one request has run so far'''
+    __slots__ = ("counts", "functions", "seconds", "started", "explaining")
+
+    def __init__(self):
+        # fingerprint -> times run
+        self.counts = Counter()
+        # fingerprint -> Counter of the functions that ran it
+        self.functions: Dict[str, Counter] = {}
+        # function -> [statements, seconds]
+        self.seconds: Dict[str, List] = {}
+        self.started = None
+        self.explaining = False
+
+    def record(self, statement: str, function: str, elapsed: float):
+        shape = fingerprint(statement)
+        self.counts[shape] += 1
+        self.functions.setdefault(shape, Counter())[function] += 1
+        spent = self.seconds.setdefault(function, [0, 0.0])
+        spent[0] += 1
+        spent[1] += elapsed
+
+    def repeated(self) -> List[Tuple[str, int]]:
+        '''(fingerprint, times run) of every statement run more than REPEAT_LIMIT times, most repeated first'''
+        return [(shape, count) for shape, count in self.counts.most_common() if count > REPEAT_LIMIT]
+
+    def summary(self, description: str) -> str:
+        total = sum(count for count, _ in self.seconds.values())
+        seconds = sum(elapsed for _, elapsed in self.seconds.values())
+        lines = [f"{description}: {total} statements, {seconds * 1000:.2f} ms of SQL"]
+        for function, (count, elapsed) in sorted(self.seconds.items(), key = lambda item: -item[1][1]):
+            lines.append(f"    {count:>4} statements {elapsed * 1000:>8.2f} ms  {function}")
+        return "\n".join(lines)
+
+# The statements of the request being recorded, if there is one
+current: ContextVar[Statements | None] = ContextVar("sql_statements", default = None)
+
+def begin_request() -> Token:
+    return current.set(Statements())
+
+def finish_request(description: str):
+    '''Logs the current request's summary, and warns about every statement it repeated too often'''
+    statements = current.get()
+    if statements is None or not statements.counts:
+        return
+
+    log.info(statements.summary(description))
+    for shape, count in statements.repeated():
+        functions = ", ".join(f"{function} x{times}" for function, times in statements.functions[shape].most_common())
+        if shape.upper().startswith("BEGIN"):
+            # Every session_scope outside a unit of work is a transaction of its own
+            log.warning(f"{description} began {count} transactions (from {functions}), could they share one session?")
+        else:
+            log.warning(f"{description} ran the same statement {count} times (from {functions}), "
+                        f"is it in a loop that could be one query? {shape}")
+
+def end_request(token: Token):
+    current.reset(token)
+
+def explain(conn, statement: str, parameters) -> str:
+    '''The EXPLAIN QUERY PLAN of a statement, as an indented tree'''
+    rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+    depths = {0: 0}
+    lines = []
+    for id, parent, _, detail in rows:
+        depths[id] = depths.get(parent, 0) + 1
+        lines.append("    " * depths[id] + detail)
+    return "\n".join(lines)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_statement(conn, cursor, statement, parameters, context, executemany):
+    statements = current.get()
+    if statements is not None and not statements.explaining:
+        statements.started = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_statement(conn, cursor, statement, parameters, context, executemany):
+    statements = current.get()
+    if statements is None or statements.explaining or statements.started is None:
+        return
+
+    elapsed = time.perf_counter() - statements.started
+    statements.started = None
+    timings = metrics.current.get()
+    function = timings.function if timings is not None and timings.function is not None else NO_FUNCTION
+    statements.record(statement, function, elapsed)
+
+    if elapsed * 1000 < SLOW_QUERY_MS or executemany:
+        return
+    if not statement.lstrip().upper().startswith(("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")):
+        log.warning(f"Slow statement ({elapsed * 1000:.1f} ms) in {function}: {statement}")
+        return
+
+    # The EXPLAIN is a statement too, which mustn't be recorded
+    statements.explaining = True
+    try:
+        plan = explain(conn, statement, parameters)
+    except Exception as error:
+        plan = f"    (couldn't explain: {error})"
+    finally:
+        statements.explaining = False
+    log.warning(f"Slow statement ({elapsed * 1000:.1f} ms) in {function}: {fingerprint(statement)}\n{plan}")
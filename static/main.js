@@ -44,10 +44,10 @@ function try_group_delete(id) {
     }
 }
 
-function try_delete_post(target_t, post_id) {
+function try_delete_post(post_id) {
     if (window.confirm("Are you sure want to delete this post? THIS CANNOT BE UNDONE")) {
         fetch("/delete_post", { method: "POST",
-            body: JSON.stringify({"target_t": target_t, "post_id": post_id}),
+            body: JSON.stringify({"post_id": post_id}),
             headers: {
                 "Content-Type": "application/json"
             }
@@ -60,3 +60,71 @@ function try_delete_post(target_t, post_id) {
         })
     }
 }
+
+function init_infinite_scroll() {
+    let more = document.getElementById("feed-more");
+    if (more === null) {
+        return;
+    }
+
+    let loading = false;
+    let observer = new IntersectionObserver((entries) => {
+        if (loading || !entries.some((entry) => entry.isIntersecting)) {
+            return;
+        }
+
+        loading = true;
+        fetch(more.dataset.next).then((resp) => {
+            if (resp.ok) {
+                resp.json().then((map) => {
+                    const e = document.createElement('template');
+                    e.innerHTML = map["elem"].trim();
+                    document.getElementById("feed-parent").append(e.content);
+
+                    if (map["next"]) {
+                        more.dataset.next = map["next"];
+                        loading = false;
+                    } else {
+                        observer.disconnect();
+                        more.remove();
+                    }
+                })
+            }
+        });
+    });
+
+    observer.observe(more);
+}
+document.addEventListener('DOMContentLoaded', init_infinite_scroll, false);
+
+function try_delete_comment(comment_id) {
+    if (window.confirm("Are you sure want to delete this comment? THIS CANNOT BE UNDONE")) {
+        fetch("/delete_comment", { method: "POST",
+            body: JSON.stringify({"comment_id": comment_id}),
+            headers: {
+                "Content-Type": "application/json"
+            }
+        }).then((resp) => {
+            if (resp.ok) {
+                window.location.reload()
+            } else {
+                alert("Failed to delete")
+            }
+        })
+    }
+}
+
+function init_live_updates() {
+    let parent = document.getElementById("feed-parent");
+    if (parent === null || !parent.dataset.events) {
+        return;
+    }
+
+    let source = new EventSource(parent.dataset.events);
+    source.onmessage = (message) => {
+        const e = document.createElement('template');
+        e.innerHTML = JSON.parse(message.data)["elem"].trim();
+        parent.prepend(e.content);
+    };
+}
+document.addEventListener('DOMContentLoaded', init_live_updates, false);
@@ -0,0 +1,65 @@
+'''
+Shared fixtures. Every test gets a database of its own, at the latest schema version, that every function in
+database.py is pointed at
+'''
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import migrations
+
+@pytest.fixture
+def db_path(tmp_path) -> str:
+    '''Path of an empty database at the latest schema version, which database.py uses for the test'''
+    path = str(tmp_path / "test.db")
+    migrations.migrate(path)
+    database.use_engine(f"sqlite:///{path}")
+    yield path
+    database.engine.dispose()
+
+def add_users(*names: str) -> list:
+    '''Inserts users (with their walls) called names, returning their ids in the same order'''
+    assert database.insert_users([{
+        "name": name,
+        "password": "not a real hash",
+        "password_reset_on_next_login": False,
+        "student_requests_password_change": False,
+        "is_teacher": False,
+    } for name in names])
+    return [database.get_user_id_by_name(name) for name in names]
+
+def befriend(a: int, b: int, accept: bool = True):
+    assert database.friend_request(a, database.get_sidebar_user_info(b).name)
+    if accept:
+        assert database.accept_friend_request(b, a)
+
+def new_group(owner: int, name: str) -> int:
+    assert database.create_group(owner, name)
+    return max(database.some_group_ids(1))
+
+@pytest.fixture
+def client(db_path, tmp_path, monkeypatch):
+    '''A test client of the Flask app, serving from the test's database with every per process cache empty'''
+    # app.py reads its secret key from the working directory when it is first imported
+    (tmp_path / ".flask_key").write_text("test key")
+    monkeypatch.chdir(tmp_path)
+    import app as webapp
+    import fragments
+    import namecache
+
+    webapp.app.config.update(TESTING = True, WTF_CSRF_ENABLED = False, PROPAGATE_EXCEPTIONS = False)
+    monkeypatch.setattr(webapp, "schema_checked", False)
+    monkeypatch.setattr(namecache, "watermark", None)
+    for cache in (*namecache.caches.values(), namecache.identities, fragments.posts):
+        cache.clear()
+    namecache.forget_versions()
+    return webapp.app.test_client()
+
+def log_in(client, user_id: int):
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user_id)
+        session["_fresh"] = True
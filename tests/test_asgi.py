@@ -0,0 +1,79 @@
+'''The async serving mode serves logged in next page requests natively, and hands Flask what only Flask can log in'''
+import asyncio
+
+import flask_login
+import pytest
+from flask import session
+
+from conftest import add_users
+
+USER_AGENT = "pytest"
+
+@pytest.fixture
+def served(client, db_path, monkeypatch):
+    '''Calls asgi.app like a server would. Returns the call, and the paths it handed to the Flask app'''
+    import aiodatabase
+    import asgi
+
+    fallbacks = []
+    wsgi = asgi.wsgi
+    async def counting_wsgi(scope, receive, send):
+        fallbacks.append(scope["path"])
+        await wsgi(scope, receive, send)
+    monkeypatch.setattr(asgi, "wsgi", counting_wsgi)
+
+    async def call(path: str, cookie: str | None = None) -> int:
+        aiodatabase.use_engine(f"sqlite:///{db_path}")
+        status = []
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+        async def send(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+        headers = [(b"host", b"localhost"), (b"user-agent", USER_AGENT.encode())]
+        if cookie is not None:
+            headers.append((b"cookie", cookie.encode()))
+        scope = {"type": "http", "http_version": "1.1", "scheme": "http", "server": ("localhost", 80),
+                 "client": ("127.0.0.1", 50000), "root_path": "", "method": "GET", "path": path,
+                 "query_string": b"", "headers": headers}
+        try:
+            await asgi.app(scope, receive, send)
+        finally:
+            await aiodatabase.engine.dispose()
+        return status[0]
+
+    # The first request does the Flask app's cold start check
+    asyncio.run(call("/feed"))
+    fallbacks.clear()
+    return lambda *args: asyncio.run(call(*args)), fallbacks
+
+def login_cookies(user_id: int, remember: bool = False, **session_values) -> str:
+    '''The cookies flask-login sets when the user logs in from the test's client'''
+    import app as webapp
+
+    with webapp.app.test_request_context(headers = {"User-Agent": USER_AGENT}, environ_base = {"REMOTE_ADDR": "127.0.0.1"}):
+        flask_login.login_user(webapp.LoginDummy(user_id), remember = remember)
+        session.update(session_values)
+        response = webapp.app.process_response(webapp.app.make_response(""))
+    return "; ".join(value.split(";")[0] for value in response.headers.getlist("Set-Cookie"))
+
+def test_session_login_is_served_natively(served):
+    call, fallbacks = served
+    ann, = add_users("ann")
+    assert call("/feed", login_cookies(ann)) == 200
+    assert fallbacks == []
+
+def test_anonymous_request_is_handed_to_flask(served):
+    call, fallbacks = served
+    assert call("/feed") == 401
+    assert call("/feed", "session=forged") == 401
+    assert fallbacks == ["/feed", "/feed"]
+
+def test_logins_flask_login_must_update_are_handed_to_flask(served):
+    call, fallbacks = served
+    ann, = add_users("ann")
+    remember_me = "; ".join(cookie for cookie in login_cookies(ann, remember = True).split("; ") if not cookie.startswith("session="))
+    assert call("/feed", remember_me) == 200
+    # Session protection marks a session from another client as no longer fresh
+    assert call("/feed", login_cookies(ann, _id = "another client")) == 200
+    assert fallbacks == ["/feed", "/feed"]
@@ -0,0 +1,79 @@
+'''Deleting a group or account whose wall is too big to delete in one go detaches the wall, then reclaims it'''
+import pytest
+from sqlalchemy import func, select
+
+import database
+from conftest import add_users, befriend, new_group
+
+POSTS = 8
+
+def count(model, *conditions) -> int:
+    with database.session_scope() as session:
+        return session.scalar(select(func.count()).select_from(model).where(*conditions))
+
+def feed_ids(user_id: int, timeline: bool, monkeypatch) -> set:
+    monkeypatch.setattr(database, "TIMELINE_ENABLED", timeline)
+    return {post.id for post in database.generate_feed(user_id, limit = 1000).items}
+
+@pytest.fixture
+def big_wall(db_path, monkeypatch, request):
+    '''
+    A group's or a user's wall holding more than RECLAIM_CHUNK posts, with comments, seen by a viewer. Returns
+    (viewer, wall id, post ids, delete, whether deleting started a reclaim, and the real reclaim_in_background)
+    '''
+    monkeypatch.setattr(database, "RECLAIM_CHUNK", 5)
+    monkeypatch.setattr(database, "CHUNK_PAUSE", 0)
+    monkeypatch.setattr(database, "TIMELINE_ENABLED", True)
+    ann, ben, cat = add_users("ann", "ben", "cat")
+
+    if request.param == "group":
+        group = new_group(ann, "big")
+        database.join_group(ben, group)
+        wall = database.get_group_wall(group)
+        viewer, author, delete = ben, ann, lambda: database.delete_group(group)
+    else:
+        befriend(ann, ben)
+        wall = database.get_user_wall(ann)
+        # Deleting ann deletes what she wrote at once, wherever it is, so her wall is filled by ben
+        viewer, author, delete = ben, ben, lambda: database.delete_user(ann)
+
+    posts = [database.post_to_wall(author, f"zebra {n}", wall).id for n in range(POSTS)]
+    database.comment_on_post(viewer, "zebra comment", posts[0])
+    database.comment_on_post(cat, "zebra comment", posts[1])
+
+    reclaim = database.reclaim_in_background
+    started = []
+    # Hold the reclaim back, to see the wall as it is between the delete and the reclaim
+    monkeypatch.setattr(database, "reclaim_in_background", lambda: started.append(True))
+    yield viewer, wall.id, posts, delete, started, reclaim
+    database.wait_for_reclaim()
+
+@pytest.mark.parametrize("big_wall", ["group", "user"], indirect = True)
+def test_detached_wall_is_gone_straight_away(big_wall, monkeypatch):
+    viewer, wall_id, posts, delete, started, _ = big_wall
+    assert set(posts) <= feed_ids(viewer, True, monkeypatch)
+
+    assert delete()
+    assert started == [True]
+    # Nothing has been reclaimed yet
+    assert count(database.Post, database.Post.wall_id == wall_id) == POSTS
+
+    context = database.load_viewer_context(viewer)
+    assert not context.groups and not context.friends
+    assert not set(posts) & feed_ids(viewer, True, monkeypatch)
+    assert not set(posts) & feed_ids(viewer, False, monkeypatch)
+    assert database.search(viewer, "zebra").items == []
+    assert [database.get_post(id) for id in posts] == [None] * POSTS
+
+@pytest.mark.parametrize("big_wall", ["group", "user"], indirect = True)
+def test_detached_wall_is_reclaimed(big_wall):
+    viewer, wall_id, posts, delete, started, reclaim = big_wall
+    assert delete()
+    reclaim()
+    database.wait_for_reclaim()
+
+    assert count(database.Post, database.Post.wall_id == wall_id) == 0
+    assert count(database.Comment, database.Comment.post_id.in_(posts)) == 0
+    assert count(database.TimelineEntry, database.TimelineEntry.post_id.in_(posts)) == 0
+    assert count(database.Wall, database.Wall.id == wall_id) == 0
+    assert count(database.Wall, database.Wall.type == database.DELETED_WALL) == 0
@@ -0,0 +1,109 @@
+'''The /events stream only subscribes its viewer to what they may see, and only hears about committed writes'''
+import json
+
+import pytest
+
+import database
+import events
+from conftest import add_users, befriend, log_in, new_group
+
+@pytest.fixture
+def people(client, monkeypatch):
+    '''ann and ben are friends in ann's group, and eve is a stranger with a post on her wall'''
+    import app as webapp
+    # Lets a stream with nothing to send come back with a keepalive straight away
+    monkeypatch.setattr(webapp, "EVENT_KEEPALIVE", 0.05)
+    ann, ben, eve = add_users("ann", "ben", "eve")
+    befriend(ann, ben)
+    group = new_group(ann, "club")
+    database.join_group(ben, group)
+    secret = database.post_to_wall(eve, "secret", database.get_user_wall(eve))
+    return {"ann": ann, "ben": ben, "eve": eve, "group": group, "secret": secret.id}
+
+@pytest.fixture
+def subscribed(monkeypatch) -> list:
+    '''The topics of every subscription the test makes'''
+    topics = []
+    subscribe = events.subscribe
+    def recording_subscribe(topic_list):
+        subscription = subscribe(topic_list)
+        topics.append(subscription.topics)
+        return subscription
+    monkeypatch.setattr(events, "subscribe", recording_subscribe)
+    return topics
+
+def open_stream(client, query: str = ""):
+    response = client.get(f"/events{query}", buffered = False)
+    assert response.status_code == 200
+    chunks = iter(response.response)
+    assert next(chunks) == b": open\n\n"
+    return response, chunks
+
+def next_post(chunks) -> str | None:
+    '''The content of the next post the stream sends, or None if it has nothing to send'''
+    chunk = next(chunks).decode()
+    if chunk.startswith(":"):
+        return None
+    elem = json.loads(chunk.removeprefix("data: "))["elem"]
+    return next(content for content in ("from ann", "from ben", "uncommitted", "rolled back") if content in elem)
+
+def test_feed_stream_subscribes_to_visible_walls_only(client, people, subscribed):
+    log_in(client, people["ann"])
+    response, _ = open_stream(client)
+    response.close()
+    walls = [database.get_user_wall(people["ann"]), database.get_user_wall(people["ben"]), database.get_group_wall(people["group"])]
+    assert subscribed == [{events.wall_topic(wall.id) for wall in walls}]
+
+def test_stream_of_something_unseen_is_refused(client, people, subscribed):
+    log_in(client, people["ann"])
+    other_group = new_group(people["eve"], "other")
+    for query in (f"?wall={database.get_user_wall(people['eve']).id}", f"?wall={database.get_group_wall(other_group).id}",
+                  f"?post={people['secret']}", "?wall=1000000", "?post=1000000"):
+        assert client.get(f"/events{query}").status_code == 403, query
+    assert subscribed == []
+
+def test_friend_receives_a_post_once_it_commits(client, people):
+    ben_wall = database.get_user_wall(people["ben"])
+    log_in(client, people["eve"])
+    assert client.get(f"/events?wall={ben_wall.id}").status_code == 403
+
+    log_in(client, people["ann"])
+    response, chunks = open_stream(client, f"?wall={ben_wall.id}")
+    try:
+        token = database.begin_unit_of_work(write = True)
+        try:
+            assert database.post_to_wall(people["ben"], "uncommitted", ben_wall)
+            assert next_post(chunks) is None
+            database.commit_unit_of_work()
+        finally:
+            database.end_unit_of_work(token)
+        assert next_post(chunks) == "uncommitted"
+    finally:
+        response.close()
+
+def test_rolled_back_post_is_never_sent(client, people):
+    ben_wall = database.get_user_wall(people["ben"])
+    log_in(client, people["ann"])
+    response, chunks = open_stream(client, f"?wall={ben_wall.id}")
+    try:
+        token = database.begin_unit_of_work(write = True)
+        try:
+            assert database.post_to_wall(people["ben"], "rolled back", ben_wall)
+        finally:
+            database.end_unit_of_work(token)
+        assert next_post(chunks) is None
+        assert database.post_to_wall(people["ben"], "from ben", ben_wall)
+        assert next_post(chunks) == "from ben"
+    finally:
+        response.close()
+
+def test_own_posts_are_not_sent_back(client, people):
+    group_wall = database.get_group_wall(people["group"])
+    log_in(client, people["ann"])
+    response, chunks = open_stream(client)
+    try:
+        assert database.post_to_wall(people["ann"], "from ann", group_wall)
+        assert database.post_to_wall(people["ben"], "from ben", group_wall)
+        assert next_post(chunks) == "from ben"
+    finally:
+        response.close()
@@ -0,0 +1,22 @@
+'''Per-request timings of the database functions a request calls (metrics.py)'''
+import pytest
+
+import database
+import metrics
+import writequeue
+from conftest import add_users, log_in
+
+def samples(function: str) -> int:
+    series = metrics.database_seconds.series.get((function,))
+    return series[2] if series is not None else 0
+
+@pytest.mark.parametrize("queued", [False, True])
+def test_posting_records_a_post_to_wall_sample(client, monkeypatch, queued):
+    monkeypatch.setattr(database, "write_queue", writequeue.WriteQueue(database.write_session) if queued else None)
+    ann, = add_users("ann")
+    log_in(client, ann)
+    wall = database.get_user_wall(ann)
+
+    before = samples("post_to_wall")
+    assert client.post(f"/post/{wall.id}", data = {"content": "timed"}).status_code == 200
+    assert samples("post_to_wall") == before + 1
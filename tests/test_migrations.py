@@ -0,0 +1,182 @@
+'''Creating databases, and the checks the app makes before serving from one'''
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+import database
+import migrations
+
+def test_missing_database_is_not_created(tmp_path):
+    path = str(tmp_path / "missing.db")
+    with pytest.raises(FileNotFoundError):
+        migrations.is_current(path)
+    assert not (tmp_path / "missing.db").exists()
+
+@pytest.mark.parametrize("touch", [False, True])
+def test_migrate_creates_a_current_database(tmp_path, touch):
+    path = tmp_path / "new.db"
+    if touch:
+        path.touch()
+    assert migrations.migrate(str(path)) == (0, migrations.LATEST_VERSION)
+    assert migrations.is_current(str(path))
+
+    db = sqlite3.connect(path)
+    tables = {name for name, in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    triggers = {name for name, in db.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    assert {"users", "walls", "posts", "comments", "timeline_entries", "posts_search", "comments_search"} <= tables
+    assert "posts_search_insert" in triggers
+    # Migrating it again has nothing to do
+    assert migrations.migrate(str(path)) == (migrations.LATEST_VERSION, migrations.LATEST_VERSION)
+
+# (table, columns, rows) of a small version 0 database. The post tables' columns are in different orders, as they
+# are in the main.db these migrations were written for
+VERSION_0_ROWS = [
+    ("users", "id, name, password, password_reset_on_next_login, student_requests_password_change, is_teacher",
+        [(1, "ann", "x", 0, 0, 0), (2, "ben", "x", 0, 0, 0), (3, "cat", "x", 0, 0, 1)]),
+    ("groups", "id, name", [(1, "class"), (2, "club")]),
+    ("friendships", "first, second, is_request", [(2, 1, 0), (1, 3, 1)]),
+    ("group_memberships", "member_id, group_id, is_admin", [(1, 1, 1), (2, 1, 0), (1, 2, 1)]),
+    ("private_messages", "id, author_id, recipient_id, content", [(1, 1, 2, "hello")]),
+    ("wall_posts", "id, content, author_id, wall_id, publish_datetime",
+        [(1, "ben on ann", 2, 1, 10), (2, "ann on cat", 1, 3, 20), (3, "cat on cat", 3, 3, 30)]),
+    ("group_posts", "id, author_id, group_id, content, publish_datetime",
+        [(1, 1, 2, "ann in club", 40), (2, 2, 1, "ben in class", 50)]),
+    ("wall_post_comments", "id, content, author_id, post_id, publish_datetime",
+        [(1, "cat on ben's post", 3, 1, 11), (2, "ann on ben's post", 1, 1, 12)]),
+    ("group_post_comments", "id, content, author_id, post_id, publish_datetime", [(1, "ann on ben's group post", 1, 2, 51)]),
+]
+
+@pytest.fixture
+def version_0_path(tmp_path) -> str:
+    '''A copy of the shipped main.db (at schema version 0) holding only VERSION_0_ROWS'''
+    path = str(tmp_path / "old.db")
+    shutil.copy(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.db"), path)
+    db = sqlite3.connect(path)
+    assert migrations.schema_version(db) == 0
+    with db:
+        for table, _, _ in VERSION_0_ROWS:
+            db.execute(f"DELETE FROM {table}")
+        for table, columns, rows in VERSION_0_ROWS:
+            placeholders = ", ".join("?" * len(rows[0]))
+            db.executemany(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", rows)
+    db.close()
+    return path
+
+def test_canonical_friendships_keeps_each_pairs_requester(version_0_path):
+    db = sqlite3.connect(version_0_path)
+    with db:
+        # Requests the other way round to VERSION_0_ROWS' (2, 1) and (1, 3), a pending request answered by an
+        # accepted one, and a friendship with oneself
+        db.executemany("INSERT INTO friendships (first, second, is_request) VALUES (?, ?, ?)",
+                       [(1, 2, 1), (3, 1, 1), (3, 2, 1), (2, 3, 0), (3, 3, 0)])
+    db.close()
+
+    assert migrations.migrate(version_0_path, 3) == (0, 3)
+    db = sqlite3.connect(version_0_path)
+    # An accepted friendship wins over a request, and otherwise the earlier request does
+    assert db.execute("SELECT first, second, requester_id, is_request FROM friendships ORDER BY first, second").fetchall() == [
+        (1, 2, 2, 0),
+        (1, 3, 1, 1),
+        (2, 3, 2, 0),
+    ]
+    with pytest.raises(sqlite3.IntegrityError):
+        db.execute("INSERT INTO friendships (first, second, requester_id, is_request) VALUES (2, 1, 2, 1)")
+
+def test_unify_walls_keeps_every_post_on_its_owners_wall(version_0_path):
+    assert migrations.migrate(version_0_path, 5) == (0, 5)
+    assert migrations.migrate(version_0_path, 6) == (5, 6)
+    db = sqlite3.connect(version_0_path)
+
+    walls = {id: (type, user_id, group_id) for id, type, user_id, group_id in db.execute("SELECT id, type, user_id, group_id FROM walls")}
+    assert sorted(walls.values()) == [("group", None, 1), ("group", None, 2), ("user", 1, None), ("user", 2, None), ("user", 3, None)]
+
+    # Group posts and comments are moved past the wall ones: 3 wall posts and 2 wall post comments
+    posts = {id: (content, author_id, walls[wall_id], publish_datetime, comment_count)
+             for id, content, author_id, wall_id, publish_datetime, comment_count in db.execute("SELECT * FROM posts")}
+    assert posts == {
+        1: ("ben on ann", 2, ("user", 1, None), 10, 2),
+        2: ("ann on cat", 1, ("user", 3, None), 20, 0),
+        3: ("cat on cat", 3, ("user", 3, None), 30, 0),
+        4: ("ann in club", 1, ("group", None, 2), 40, 0),
+        5: ("ben in class", 2, ("group", None, 1), 50, 1),
+    }
+    comments = set(db.execute("SELECT id, content, author_id, post_id, publish_datetime FROM comments"))
+    assert comments == {
+        (1, "cat on ben's post", 3, 1, 11),
+        (2, "ann on ben's post", 1, 1, 12),
+        (3, "ann on ben's group post", 1, 5, 51),
+    }
+    tables = {name for name, in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert not tables & {"wall_posts", "group_posts", "wall_post_comments", "group_post_comments"}
+
+def reorder_columns(db: sqlite3.Connection, table: str, columns: str):
+    '''Recreates a table with its columns in another order, as hand edits of main.db did'''
+    definition = db.execute("SELECT sql FROM sqlite_master WHERE name = ?", (table,)).fetchone()[0]
+    types = {name: type for _, name, type, *_ in db.execute(f"PRAGMA table_info({table})")}
+    db.execute(f"CREATE TABLE {table}_reordered ({', '.join(f'{name} {types[name]}' for name in columns.split(', '))})")
+    db.execute(f"INSERT INTO {table}_reordered ({columns}) SELECT {columns} FROM {table}")
+    db.execute(f"DROP TABLE {table}")
+    db.execute(f"ALTER TABLE {table}_reordered RENAME TO {table}")
+    assert definition != db.execute("SELECT sql FROM sqlite_master WHERE name = ?", (table,)).fetchone()[0]
+
+CASCADED_TABLES = ("users", "groups", "walls", "posts", "comments", "friendships", "group_memberships",
+                   "private_messages", "timeline_entries")
+
+def contents(db: sqlite3.Connection, table: str) -> set:
+    '''A table's rows, as (column, value) pairs so the order of its columns doesn't matter'''
+    db.row_factory = sqlite3.Row
+    try:
+        return {tuple(sorted(dict(row).items())) for row in db.execute(f"SELECT * FROM {table}")}
+    finally:
+        db.row_factory = None
+
+@pytest.fixture
+def version_7_path(version_0_path) -> str:
+    '''The version 0 database migrated to 7, with a timeline and some of its columns out of order'''
+    assert migrations.migrate(version_0_path, 7) == (0, 7)
+    db = migrations.connect(version_0_path)
+    db.execute("BEGIN")
+    reorder_columns(db, "private_messages", "id, content, recipient_id, author_id")
+    reorder_columns(db, "posts", "id, wall_id, publish_datetime, author_id, comment_count, content")
+    db.executemany("INSERT INTO timeline_entries (user_id, publish_datetime, post_id) VALUES (?, ?, ?)",
+                   [(1, 10, 1), (1, 40, 4), (1, 50, 5), (2, 10, 1), (2, 50, 5), (3, 20, 2)])
+    db.execute("COMMIT")
+    db.close()
+    return version_0_path
+
+def test_cascade_deletes_keeps_every_row(version_7_path):
+    db = sqlite3.connect(version_7_path)
+    before = {table: contents(db, table) for table in CASCADED_TABLES}
+    db.close()
+
+    assert migrations.migrate(version_7_path) == (7, 8)
+    db = sqlite3.connect(version_7_path)
+    assert {table: contents(db, table) for table in CASCADED_TABLES} == before
+    assert db.execute("PRAGMA foreign_key_check").fetchall() == []
+    assert db.execute("SELECT rowid FROM posts_search WHERE posts_search MATCH 'club'").fetchall() == [(4,)]
+
+def test_deletes_cascade_after_migrating(version_7_path):
+    migrations.migrate(version_7_path)
+    database.use_engine(f"sqlite:///{version_7_path}")
+    try:
+        assert database.delete_user(2)
+        assert database.delete_group(2)
+    finally:
+        database.engine.dispose()
+
+    db = sqlite3.connect(version_7_path)
+    # Ben's posts take ann's comment with them, and club's post goes with its wall
+    assert [id for id, in db.execute("SELECT id FROM users ORDER BY id")] == [1, 3]
+    assert [id for id, in db.execute("SELECT id FROM groups")] == [1]
+    assert {(type, user_id, group_id) for type, user_id, group_id in db.execute("SELECT type, user_id, group_id FROM walls")} == {
+        ("user", 1, None), ("user", 3, None), ("group", None, 1)}
+    assert [id for id, in db.execute("SELECT id FROM posts ORDER BY id")] == [2, 3]
+    assert db.execute("SELECT count(*) FROM comments").fetchone() == (0,)
+    assert db.execute("SELECT first, second FROM friendships").fetchall() == [(1, 3)]
+    assert db.execute("SELECT member_id, group_id FROM group_memberships").fetchall() == [(1, 1)]
+    assert db.execute("SELECT count(*) FROM private_messages").fetchone() == (0,)
+    assert db.execute("SELECT user_id, post_id FROM timeline_entries").fetchall() == [(3, 2)]
+    assert db.execute("SELECT rowid FROM posts_search WHERE posts_search MATCH 'ben OR club'").fetchall() == []
+    assert db.execute("SELECT rowid FROM comments_search WHERE comments_search MATCH 'ann'").fetchall() == []
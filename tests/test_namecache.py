@@ -0,0 +1,49 @@
+'''Names cached by one worker follow renames and deletions committed anywhere, through the name_changes log'''
+import threading
+
+import pytest
+
+import database
+import namecache
+from conftest import add_users, log_in, new_group
+
+def in_another_thread(run):
+    thread = threading.Thread(target = run)
+    thread.start()
+    thread.join()
+
+def test_rename_in_another_thread_is_seen_after_sync(client):
+    ann, = add_users("ann")
+    group = new_group(ann, "club")
+    namecache.warm()
+    assert namecache.users.get(ann).name == "ann" and namecache.identities.get(ann) is not None
+    assert namecache.groups.get(group) is not None
+
+    in_another_thread(lambda: database.rename(ann, "anna"))
+    in_another_thread(lambda: database.delete_group(group))
+    # Nothing has told this worker yet
+    assert namecache.users.get(ann).name == "ann"
+
+    namecache.sync()
+    assert namecache.users.get(ann).name == "anna"
+    assert namecache.identities.get(ann)[0] == "anna"
+    assert namecache.groups.get(group) is None
+
+def test_rename_is_seen_by_the_next_request(client):
+    ann, = add_users("ann")
+    log_in(client, ann)
+    assert client.get("/feed").status_code == 200
+    assert client.post("/rename", data = {"name": "anna"}).status_code == 302
+    assert namecache.users.get(ann).name == "ann"
+    client.get("/feed")
+    assert namecache.users.get(ann).name == "anna"
+
+def test_failed_warm_is_retried(client, monkeypatch):
+    import app as webapp
+
+    def fail():
+        raise RuntimeError("warm failed")
+    monkeypatch.setattr(namecache, "warm", fail)
+    with pytest.raises(RuntimeError):
+        webapp.refuse_unmigrated_database()
+    assert not webapp.schema_checked
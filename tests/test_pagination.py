@@ -0,0 +1,72 @@
+'''Keyset pages of wall posts and comments, and the comment_count kept on each post'''
+import time
+
+import pytest
+from sqlalchemy import func, select
+
+import database
+from conftest import add_users, befriend
+
+ROWS = 7
+
+def all_pages(load, limit: int = 3) -> list:
+    '''The ids on every page load(cursor, limit) returns, following the cursors to the last one'''
+    ids, cursor = [], None
+    while True:
+        page = load(cursor, limit)
+        assert len(page.items) <= limit
+        ids.extend(item.id for item in page.items)
+        if page.cursor is None:
+            return ids
+        cursor = page.cursor
+
+@pytest.fixture
+def same_time(monkeypatch):
+    '''Everything written during the test gets the same publish_datetime, so only ids tell the rows apart'''
+    now = time.time_ns()
+    monkeypatch.setattr(time, "time_ns", lambda: now)
+
+def test_wall_pages_of_posts_published_at_once(db_path, same_time):
+    ann, = add_users("ann")
+    wall = database.get_user_wall(ann)
+    posts = [database.post_to_wall(ann, f"post {n}", wall).id for n in range(ROWS)]
+    assert len({database.get_post(id).publish_datetime for id in posts}) == 1
+    assert all_pages(lambda cursor, limit: database.posts_to_wall(wall.id, cursor, limit)) == posts[::-1]
+
+def test_comment_pages_of_comments_published_at_once(db_path, same_time):
+    ann, = add_users("ann")
+    post = database.post_to_wall(ann, "post", database.get_user_wall(ann)).id
+    comments = [database.comment_on_post(ann, f"comment {n}", post).id for n in range(ROWS)]
+    assert all_pages(lambda cursor, limit: database.get_post_comments(post, cursor, limit)) == comments[::-1]
+
+def comment_counts(*posts: int) -> list:
+    '''Each post's comment_count, checked against the comments it has'''
+    counts = []
+    for id in posts:
+        with database.session_scope() as session:
+            assert session.scalar(select(func.count()).where(database.Comment.post_id == id)) == database.get_post(id).comment_count
+        counts.append(database.get_post(id).comment_count)
+    return counts
+
+def test_comment_count_follows_comments(db_path):
+    ann, ben, cat = add_users("ann", "ben", "cat")
+    befriend(ann, ben)
+    befriend(ann, cat)
+    wall = database.get_user_wall(ann)
+    first, second = (database.post_to_wall(ann, "post", wall).id for _ in range(2))
+
+    for author in (ann, ben, ben, cat):
+        database.comment_on_post(author, "comment", first)
+    bens = database.comment_on_post(ben, "comment", second).id
+    database.comment_on_post(cat, "comment", second)
+    assert comment_counts(first, second) == [4, 2]
+    assert [post.comment_count for post in database.posts_to_wall(wall.id).items] == [2, 4]
+
+    assert database.delete_comment(bens)
+    assert not database.delete_comment(bens)
+    assert comment_counts(first, second) == [4, 1]
+
+    assert database.delete_user(ben)
+    assert comment_counts(first, second) == [2, 1]
+    assert database.delete_user(cat)
+    assert comment_counts(first, second) == [1, 0]
@@ -0,0 +1,54 @@
+'''Who may see walls and groups, and delete posts and comments, as the viewer context answers it'''
+import pytest
+
+import database
+from conftest import add_users, befriend, log_in, new_group
+
+@pytest.fixture
+def people(client):
+    '''ann owns a wall and a group, ben is her friend and in her group, eve is a stranger and tom is a teacher'''
+    ann, ben, eve = add_users("ann", "ben", "eve")
+    assert database.insert_users([{
+        "name": "tom",
+        "password": "not a real hash",
+        "password_reset_on_next_login": False,
+        "student_requests_password_change": False,
+        "is_teacher": True,
+    }])
+    befriend(ann, ben)
+    group = new_group(ann, "club")
+    database.join_group(ben, group)
+    return {"ann": ann, "ben": ben, "eve": eve, "tom": database.get_user_id_by_name("tom"), "group": group}
+
+def new_post(people: dict, on: str) -> int:
+    '''A post by ben on ann's wall or in her group'''
+    wall = database.get_user_wall(people["ann"]) if on == "wall" else database.get_group_wall(people["group"])
+    return database.post_to_wall(people["ben"], "a post", wall).id
+
+@pytest.mark.parametrize("name, allowed", [("ann", True), ("ben", True), ("eve", False), ("tom", False)])
+def test_wall_page(client, people, name, allowed):
+    log_in(client, people[name])
+    assert client.get(f"/wall/{people['ann']}").status_code == (200 if allowed else 403)
+
+@pytest.mark.parametrize("name, allowed", [("ann", True), ("ben", True), ("eve", False), ("tom", False)])
+def test_group_page(client, people, name, allowed):
+    log_in(client, people[name])
+    assert client.get(f"/group/{people['group']}").status_code == (200 if allowed else 403)
+
+# ben wrote the posts, but only the wall's owner, the group's admins and teachers may delete them
+@pytest.mark.parametrize("on", ["wall", "group"])
+@pytest.mark.parametrize("name, allowed", [("ann", True), ("ben", False), ("eve", False), ("tom", True)])
+def test_delete_post(client, people, on, name, allowed):
+    post = new_post(people, on)
+    log_in(client, people[name])
+    assert client.post("/delete_post", json = {"post_id": post}).status_code == (200 if allowed else 500)
+    assert (database.get_post(post) is None) == allowed
+
+# The comment is by eve, who can't see the post it is on: its author may delete it all the same
+@pytest.mark.parametrize("on", ["wall", "group"])
+@pytest.mark.parametrize("name, allowed", [("ann", True), ("ben", False), ("eve", True), ("tom", True)])
+def test_delete_comment(client, people, on, name, allowed):
+    comment = database.comment_on_post(people["eve"], "a comment", new_post(people, on)).id
+    log_in(client, people[name])
+    assert client.post("/delete_comment", json = {"comment_id": comment}).status_code == (200 if allowed else 500)
+    assert (database.get_comment(comment) is None) == allowed
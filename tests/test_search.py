@@ -0,0 +1,56 @@
+'''Search only ever finds what its user may see, and marks what it matched safely'''
+import pytest
+
+import database
+from conftest import add_users, befriend, log_in, new_group
+
+def hits(user_id: int, terms: str) -> set:
+    return {(hit.kind, hit.id) for hit in database.search(user_id, terms).items}
+
+@pytest.fixture
+def network(db_path):
+    '''ann is friends with ben and in ann's group. eve is a stranger with a group of her own that ben is in'''
+    ann, ben, eve = add_users("ann", "ben", "eve")
+    befriend(ann, ben)
+    mine, theirs = new_group(ann, "mine"), new_group(eve, "theirs")
+    database.join_group(ben, theirs)
+
+    posts = {
+        "friend": database.post_to_wall(ben, "walrus on ben's wall", database.get_user_wall(ben)).id,
+        "group": database.post_to_wall(ben, "walrus in ann's group", database.get_group_wall(mine)).id,
+        "stranger": database.post_to_wall(eve, "walrus on eve's wall", database.get_user_wall(eve)).id,
+        "other group": database.post_to_wall(eve, "walrus in eve's group", database.get_group_wall(theirs)).id,
+    }
+    comments = {name: database.comment_on_post(ben, f"walrus comment on {name}", id).id for name, id in posts.items()}
+    return ann, posts, comments
+
+def test_search_only_finds_visible_posts_and_comments(network):
+    ann, posts, comments = network
+    visible = ("friend", "group")
+    assert hits(ann, "walrus") == {("post", posts[name]) for name in visible} | {("comment", comments[name]) for name in visible}
+    # Not even when their own words are searched for
+    assert hits(ann, "eve's") == set()
+    assert hits(ann, "stranger") == set()
+
+def test_deleted_post_is_no_longer_found(network):
+    ann, posts, comments = network
+    assert database.delete_post(posts["friend"])
+    assert hits(ann, "walrus") == {("post", posts["group"]), ("comment", comments["group"])}
+
+def test_posted_snippet_markers_are_stripped(client):
+    ann, = add_users("ann")
+    log_in(client, ann)
+    wall = database.get_user_wall(ann)
+    crafted = f"{database.SNIPPET_END}<i> walrus {database.SNIPPET_START}"
+    assert client.post(f"/post/{wall.id}", data = {"content": crafted}).status_code == 200
+
+    post, = database.posts_to_wall(wall.id).items
+    assert post.content == "<i> walrus "
+    page = client.get("/search/results?q=walrus").get_data(as_text = True)
+    assert "&lt;i&gt; <mark>walrus</mark>" in page
+    assert page.count("<mark>") == page.count("</mark>") == 1
+
+def test_highlight_drops_unpaired_markers(client):
+    import app as webapp
+    start, end = database.SNIPPET_START, database.SNIPPET_END
+    assert webapp.highlight(f"{end}a {start}b{end} {start}c <d>") == "a <mark>b</mark> c &lt;d&gt;"
@@ -0,0 +1,48 @@
+'''The development mode N+1 detector attributes repeated statements to the database.py function that ran them'''
+import logging
+
+import pytest
+
+import database
+import metrics
+import sqldebug
+import writequeue
+from conftest import add_users
+
+def record(run, caplog) -> list:
+    '''Runs run as one recorded request. Returns the warnings sqldebug logged about it'''
+    timings_token = metrics.begin_request()
+    statements_token = sqldebug.begin_request()
+    try:
+        run()
+        caplog.clear()
+        sqldebug.finish_request("GET /test")
+    finally:
+        sqldebug.end_request(statements_token)
+        metrics.end_request(timings_token)
+    return [record.getMessage() for record in caplog.records if record.name == "sqldebug" and record.levelno == logging.WARNING]
+
+def test_query_per_post_is_reported_against_its_function(db_path, caplog):
+    ann, = add_users("ann")
+    wall = database.get_user_wall(ann)
+    posts = [database.post_to_wall(ann, f"post {n}", wall) for n in range(sqldebug.REPEAT_LIMIT + 3)]
+
+    # A page that loads each of its posts on its own instead of in one query
+    warnings = record(lambda: [database.get_post(post.id) for post in posts], caplog)
+    repeated = [warning for warning in warnings if "ran the same statement" in warning]
+    assert len(repeated) == 1
+    assert f"ran the same statement {len(posts)} times (from get_post x{len(posts)})" in repeated[0]
+    assert "FROM posts" in repeated[0]
+
+@pytest.mark.parametrize("queued", [False, True])
+def test_writes_are_reported_against_their_function(db_path, monkeypatch, caplog, queued):
+    monkeypatch.setattr(database, "write_queue", writequeue.WriteQueue(database.write_session) if queued else None)
+    ann, = add_users("ann")
+    wall = database.get_user_wall(ann)
+    count = sqldebug.REPEAT_LIMIT + 1
+
+    warnings = record(lambda: [database.post_to_wall(ann, f"post {n}", wall) for n in range(count)], caplog)
+    inserts = [warning for warning in warnings if "INSERT INTO posts" in warning]
+    assert len(inserts) == 1
+    assert f"(from post_to_wall x{count})" in inserts[0]
+    assert sqldebug.NO_FUNCTION not in "".join(warnings)
@@ -0,0 +1,71 @@
+'''The materialized timeline must give every reader the same feed as feed_query over the base tables'''
+import pytest
+
+import database
+from conftest import add_users, befriend, new_group
+
+def feed_ids(user_id: int, timeline: bool, monkeypatch) -> list:
+    monkeypatch.setattr(database, "TIMELINE_ENABLED", timeline)
+    return [post.id for post in database.generate_feed(user_id, limit = 1000).items]
+
+def assert_feeds_match(user_ids: list, monkeypatch):
+    for user_id in user_ids:
+        assert feed_ids(user_id, True, monkeypatch) == feed_ids(user_id, False, monkeypatch), f"feed of user {user_id}"
+
+@pytest.fixture
+def network(db_path):
+    '''Five users: ann and ben are friends, cat has asked ann, ann and dan share a group, eve knows nobody'''
+    ann, ben, cat, dan, eve = users = add_users("ann", "ben", "cat", "dan", "eve")
+    befriend(ann, ben)
+    befriend(cat, ann, accept = False)
+    group = new_group(ann, "class")
+    assert database.join_group(dan, group)
+
+    for author, wall in ((ann, ann), (ben, ann), (ann, ben), (cat, cat), (dan, dan), (eve, eve)):
+        database.post_to_wall(author, f"{author} on {wall}", database.get_user_wall(wall))
+    database.post_to_wall(dan, "to the group", database.get_group_wall(group))
+    return users, group
+
+def test_rebuilt_timeline_matches_feed_query(network, monkeypatch):
+    users, _ = network
+    monkeypatch.setattr(database, "TIMELINE_REBUILD_CHUNK", 2)
+    assert database.rebuild_timeline() > 0
+    assert_feeds_match(users, monkeypatch)
+    assert len(feed_ids(users[0], True, monkeypatch)) == 4
+
+def test_rebuild_replaces_stale_entries(network, monkeypatch):
+    users, _ = network
+    database.rebuild_timeline()
+    # Written while the timeline is off, so only a rebuild can catch the timeline up
+    ann, ben = users[:2]
+    assert database.end_friendship(ann, ben)
+    database.post_to_wall(ben, "after the friendship", database.get_user_wall(ben))
+    assert database.rebuild_timeline() > 0
+    assert_feeds_match(users, monkeypatch)
+
+def test_timeline_stays_in_step_with_writes(network, monkeypatch):
+    users, group = network
+    ann, ben, cat, dan, eve = users
+    database.rebuild_timeline()
+    monkeypatch.setattr(database, "TIMELINE_ENABLED", True)
+
+    database.post_to_wall(ben, "new", database.get_user_wall(ben))
+    assert database.accept_friend_request(ann, cat)
+    assert database.join_group(eve, group)
+    assert database.end_friendship(ann, ben)
+    database.post_to_wall(eve, "to the group", database.get_group_wall(group))
+    assert database.delete_post(database.generate_feed(dan).items[0].id)
+
+    assert_feeds_match(users, monkeypatch)
+
+def test_generated_dataset_has_its_timeline(tmp_path, monkeypatch):
+    import datagen
+    monkeypatch.setitem(datagen.SCALES, "tiny", {"users": 60, "groups": 2, "friends": 4, "posts_per_user": 3, "comments_per_post": 1, "days": 5})
+    path = str(tmp_path / "generated.db")
+    datagen.generate(path, "tiny")
+    database.use_engine(f"sqlite:///{path}")
+    try:
+        assert_feeds_match(range(1, 61), monkeypatch)
+        assert any(feed_ids(user_id, True, monkeypatch) for user_id in range(1, 61))
+    finally:
+        database.engine.dispose()
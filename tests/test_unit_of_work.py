@@ -0,0 +1,94 @@
+'''A request's database calls share one session: one snapshot for its reads, and one commit for its writes'''
+import threading
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+import database
+from conftest import add_users, log_in, new_group
+
+def post_count(content: str) -> int:
+    with Session(database.engine) as session:
+        return session.scalar(select(func.count()).select_from(database.Post).where(database.Post.content == content))
+
+def in_another_thread(function, *args):
+    '''Runs function outside of the current unit of work, as another request or worker would'''
+    result = []
+    thread = threading.Thread(target = lambda: result.append(function(*args)))
+    thread.start()
+    thread.join()
+    return result[0]
+
+def test_request_commits_its_writes(client):
+    ann, = add_users("ann")
+    log_in(client, ann)
+    wall = database.get_user_wall(ann)
+    assert client.post(f"/post/{wall.id}", data = {"content": "kept"}).status_code == 200
+    assert post_count("kept") == 1
+
+def test_request_that_fails_midway_rolls_back(client, monkeypatch):
+    ann, = add_users("ann")
+    log_in(client, ann)
+    wall = database.get_user_wall(ann)
+
+    import app as webapp
+    def fail(*args, **kwargs):
+        raise RuntimeError("rendering failed")
+    # The post has been flushed by the time the response is rendered
+    monkeypatch.setattr(webapp, "render_template", fail)
+
+    assert client.post(f"/post/{wall.id}", data = {"content": "lost"}).status_code == 500
+    assert post_count("lost") == 0
+    assert database.unit_of_work.get() is None
+
+def test_writes_are_invisible_to_others_until_committed(db_path):
+    database.use_engine(f"sqlite:///{db_path}", "production")
+    ann, = add_users("ann")
+
+    token = database.begin_unit_of_work(write = True)
+    try:
+        post = database.post_to_wall(ann, "pending", database.get_user_wall(ann))
+        # commit() only flushes inside a unit of work
+        assert in_another_thread(database.get_post, post.id) is None
+        assert database.get_post(post.id) is not None
+        database.commit_unit_of_work()
+        assert in_another_thread(database.get_post, post.id) is not None
+    finally:
+        database.end_unit_of_work(token)
+
+def test_request_reads_one_snapshot(db_path):
+    # Under WAL other connections can commit while the unit of work is reading
+    database.use_engine(f"sqlite:///{db_path}", "production")
+    ann, ben = add_users("ann", "ben")
+    group = new_group(ann, "before")
+
+    token = database.begin_unit_of_work()
+    try:
+        assert database.get_sidebar_group_info(group).name == "before"
+        assert in_another_thread(database.rename, ben, "ben renamed")
+        assert in_another_thread(database.join_group, ben, group)
+        assert database.get_sidebar_user_info(ben).name == "ben"
+        assert not database.is_group_member(ben, group)
+    finally:
+        database.end_unit_of_work(token)
+
+    assert database.get_sidebar_user_info(ben).name == "ben renamed"
+    assert database.is_group_member(ben, group)
+
+@pytest.mark.parametrize("profile", ["development", "production"])
+def test_concurrent_writes_outside_a_request_all_commit(db_path, monkeypatch, profile):
+    # Each write takes the write lock before it reads, so a burst of them queues up instead of failing
+    database.use_engine(f"sqlite:///{db_path}", profile)
+    monkeypatch.setattr(database, "write_queue", None)
+    ann, = add_users("ann")
+    wall = database.get_user_wall(ann)
+
+    posted = []
+    threads = [threading.Thread(target = lambda n = n: posted.append(database.post_to_wall(ann, f"burst {n}", wall))) for n in range(32)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert None not in posted and len(posted) == 32
+    assert sum(post_count(f"burst {n}") for n in range(32)) == 32
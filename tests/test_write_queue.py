@@ -0,0 +1,71 @@
+'''The write queue runs the jobs waiting for it in one transaction, each in a savepoint of its own'''
+from concurrent.futures import Future
+from contextvars import copy_context
+
+import pytest
+from sqlalchemy import select
+
+import database
+import events
+import writequeue
+from conftest import add_users
+
+def queue_jobs(queue: writequeue.WriteQueue, jobs: list) -> list:
+    '''Queues jobs without waiting for them, so the writer finds them all waiting. Returns their futures'''
+    futures = []
+    for job in jobs:
+        future = Future()
+        queue.jobs.put((job, copy_context(), future))
+        futures.append(future)
+    return futures
+
+def post_ids() -> set:
+    with database.session_scope() as session:
+        return set(session.scalars(select(database.Post.id)))
+
+def test_waiting_jobs_are_written_in_one_batch(db_path):
+    ann, = add_users("ann")
+    wall = database.get_user_wall(ann)
+    queue = writequeue.WriteQueue(database.write_session)
+
+    futures = queue_jobs(queue, [lambda session, n = n: database.insert_post(session, ann, f"post {n}", wall) for n in range(10)])
+    queue.start()
+    posts = [future.result(timeout = 10) for future in futures]
+
+    assert queue.batches == 1 and queue.written == 10
+    assert {post.id for post in posts} == post_ids()
+    assert [post.content for post in posts] == [f"post {n}" for n in range(10)]
+
+def test_failed_job_leaves_the_rest_of_its_batch(db_path):
+    ann, ben = add_users("ann", "ben")
+    wall = database.get_user_wall(ann)
+    queue = writequeue.WriteQueue(database.write_session)
+    subscription = events.subscribe([events.wall_topic(wall.id)])
+    called = []
+
+    def fail(session):
+        database.insert_post(session, ben, "rolled back", wall)
+        database.call_after_commit(session, lambda: called.append("failed job"))
+        raise RuntimeError("job failed")
+
+    def post(content: str):
+        def job(session):
+            database.call_after_commit(session, lambda: called.append(content))
+            return database.insert_post(session, ann, content, wall)
+        return job
+
+    try:
+        futures = queue_jobs(queue, [post("first"), fail, post("last")])
+        queue.write(queue.next_batch())
+
+        first, last = futures[0].result(timeout = 0), futures[2].result(timeout = 0)
+        with pytest.raises(RuntimeError):
+            futures[1].result(timeout = 0)
+        assert post_ids() == {first.id, last.id}
+        assert called == ["first", "last"]
+        published = []
+        while (event := subscription.get(timeout = 0.1)) is not None:
+            published.append(event.item.content)
+        assert published == ["first", "last"]
+    finally:
+        subscription.close()
@@ -0,0 +1,117 @@
+'''
+Single writer with group commit, for the inserts lots of people make at once: posts and comments.
+
+SQLite lets one connection write at a time, and every commit waits for the disk. When a whole class posts at
+once, each request's transaction queues for the write lock, and the ones that wait longer than busy_timeout
+fail. With the queue on (SOCIALITE_WRITE_QUEUE=1), database.post_to_wall and comment_on_post hand their insert
+to one writer thread instead. The writer takes every job waiting (up to MAX_BATCH), runs them all in one
+transaction and commits once. Then it hands each caller its own result, e.g. the new post with its id. Each job
+runs in a savepoint, so one that fails (say, it comments on a post that was just deleted) doesn't take the rest
+of its batch down with it.
+
+A job must not be queued from inside a unit of work, which may hold the write lock the writer is waiting for
+'''
+from concurrent.futures import Future
+from contextvars import Context, copy_context
+from typing import Callable, List, Tuple
+import os
+import queue
+import threading
+import time
+
+from sqlalchemy.orm import Session
+
+import logging
+log = logging.getLogger("writequeue")
+
+ENABLED = os.environ.get("SOCIALITE_WRITE_QUEUE", "0") == "1"
+MAX_BATCH = int(os.environ.get("SOCIALITE_WRITE_QUEUE_BATCH", 64))
+# How long the writer waits for more jobs after the first one of a batch. Jobs that arrive while a batch is
+# committing are in the next batch anyway, so by default it doesn't wait: that would only delay lone writes
+MAX_DELAY_MS = float(os.environ.get("SOCIALITE_WRITE_QUEUE_DELAY_MS", 0))
+
+class WriteQueue:
+    '''
+    A writer thread running jobs (functions of a session) in batches, each batch in one transaction of a session
+    from begin(), which should already hold the write lock
+    '''
+    def __init__(self, begin: Callable[[], Session], max_batch: int = MAX_BATCH, max_delay_ms: float = MAX_DELAY_MS):
+        self.begin = begin
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.jobs = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.batches = 0
+        self.written = 0
+
+    def submit(self, job: Callable[[Session], object]):
+        '''Queues job and waits until its batch has committed. Returns what job returned, or raises what it raised'''
+        future = Future()
+        # The job runs in the caller's context, so its statements count towards the caller's request (see metrics.py)
+        self.jobs.put((job, copy_context(), future))
+        self.start()
+        return future.result()
+
+    def start(self):
+        '''Starts the writer if it isn't running, e.g. on first use, or in a worker forked from a process that had one'''
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target = self.work, name = "writer", daemon = True)
+                self.thread.start()
+
+    def next_batch(self) -> List[Tuple[Callable, Context, Future]]:
+        batch = [self.jobs.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.jobs.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.jobs.get(timeout = remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def work(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                self.write(batch)
+            except Exception as error:
+                log.exception(f"Failed to commit a batch of {len(batch)} writes")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def write(self, batch: List[Tuple[Callable, Context, Future]]):
+        '''Runs a batch of jobs in one transaction, then hands each its result'''
+        results = []
+        with self.begin() as session:
+            for job, context, future in batch:
+                savepoint = session.begin_nested()
+                # Events the job publishes and callbacks it adds (see database.publish_after_commit and
+                # call_after_commit) mustn't run if it fails
+                published = len(session.info.get("events", ()))
+                callbacks = len(session.info.get("after_commit", ()))
+                try:
+                    result = context.run(job, session)
+                    savepoint.commit()
+                except Exception as error:
+                    savepoint.rollback()
+                    del session.info.get("events", [])[published:]
+                    del session.info.get("after_commit", [])[callbacks:]
+                    future.set_exception(error)
+                else:
+                    results.append((future, result))
+            session.commit()
+
+        self.batches += 1
+        self.written += len(results)
+        for future, result in results:
+            future.set_result(result)